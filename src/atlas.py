@@ -0,0 +1,116 @@
+"""
+   Extracts many ROI masks from a segmentation in one go.
+
+   misc.PickAtlas loads the atlas once for every mask it produces.
+   MultiPickAtlas loads it once, builds a lookup table (mask x label ->
+   in mask) and turns the atlas into every mask by indexing the table
+   with the atlas.
+"""
+import os
+from copy import deepcopy
+
+import numpy as np
+import nifti as ni
+from scipy import ndimage
+from nipype.interfaces.base import Interface, InterfaceResult, Bunch
+
+
+def save_if_changed(data, header, fname):
+    """Saves data unless fname already holds exactly the same data, so
+    that nodes downstream see an unchanged file when the result is the
+    same as in the previous run."""
+    if os.path.exists(fname):
+        if np.array_equal(ni.NiftiImage(fname).data, data):
+            return
+    ni.NiftiImage(data, header).save(fname)
+
+
+def label_masks(data, label_sets):
+    """Yields one boolean mask per set of labels.
+
+    Masks are produced one at a time so that memory does not grow with
+    the number of label sets.
+    """
+    data = np.clip(np.asarray(data).astype(np.int64), 0, None)
+    lut = np.zeros((len(label_sets), data.max() + 1), dtype=bool)
+    for i, labels in enumerate(label_sets):
+        labels = np.atleast_1d(labels)
+        labels = labels[(labels >= 0) & (labels < lut.shape[1])]
+        lut[i, labels] = True
+    for row in lut:
+        yield row[data]
+
+
+class MultiPickAtlas(Interface):
+    '''
+    Returns one ROI mask per entry of label_sets (an int or a list of
+    ints each) from a single read of the atlas. Masks are dilated by
+    dilation_size voxels and returned as outputs mask_file0,
+    mask_file1, ... as well as the list mask_files.
+    '''
+    def __init__(self, *args, **inputs):
+        self._populate_inputs()
+        self.inputs.update(**inputs)
+
+    def inputs_help(self):
+        """
+        Parameters
+        --------------------
+        atlas : file
+            segmentation (e.g. aparc+aseg)
+        label_sets : list
+            labels of each mask, an int or a list of ints per mask
+        names : list of str
+            file names (without extension) of the masks (optional)
+        dilation_size : int
+            number of binary dilation iterations (default 0)
+        """
+        print(self.inputs_help.__doc__)
+
+    def _populate_inputs(self):
+        self.inputs = Bunch(atlas=None,
+                            label_sets=None,
+                            names=None,
+                            dilation_size=0)
+
+    def outputs_help(self):
+        """
+        Parameters
+        --------------------
+        mask_files : list of files
+            one mask per label set
+        mask_file0, mask_file1, ... : file
+            the same masks as separate outputs
+        """
+        print(self.outputs_help.__doc__)
+
+    def outputs(self):
+        outputs = Bunch(mask_files=None)
+        for i in range(len(self.inputs.label_sets)):
+            setattr(outputs, 'mask_file%d' % i, None)
+        return outputs
+
+    def aggregate_outputs(self):
+        outputs = self.outputs()
+        outputs.mask_files = self._gen_output_filenames()
+        for i, fname in enumerate(outputs.mask_files):
+            setattr(outputs, 'mask_file%d' % i, fname)
+        return outputs
+
+    def _gen_output_filenames(self):
+        names = self.inputs.names
+        if not names:
+            names = ['mask%d' % i for i in range(len(self.inputs.label_sets))]
+        return [os.path.abspath(name + '.nii') for name in names]
+
+    def run(self, cwd=None):
+        image = ni.NiftiImage(self.inputs.atlas)
+        masks = label_masks(image.data, self.inputs.label_sets)
+        for mask, fname in zip(masks, self._gen_output_filenames()):
+            if self.inputs.dilation_size:
+                mask = ndimage.binary_dilation(mask, iterations=self.inputs.dilation_size)
+            save_if_changed(mask.astype(np.uint8), image.header, fname)
+
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        outputs = self.aggregate_outputs()
+        return InterfaceResult(deepcopy(self), runtime, outputs=outputs)
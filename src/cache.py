@@ -0,0 +1,295 @@
+"""
+   A result cache keyed on content rather than on directory layout.
+
+   The working directory of the pipeline is only reused when the same
+   graph is run again in the same place. ResultCache instead keys the
+   result of an interface on its class, its parameters and the
+   digests of its input files, so identical work (skull stripping the
+   same structural, extracting the same atlas labels) is found again
+   after the graph has been rebuilt, tasks were added or unrelated
+   parameters changed::
+
+       cache = ResultCache('/scratch/fmri_cache', max_bytes=20 * 2 ** 30)
+       skullstrip = nw.NodeWrapper(interface=cache.wrap(fsl.Bet()), diskbased=True)
+
+   Output files are stored in the cache directory and copied back into
+   the node directory on a hit, at the same path relative to it. The
+   least recently used entries are removed once the cache grows over
+   max_bytes; an entry is only removed while no process is loading it
+   (a lock file per entry). Hits and misses are
+   counted in a file so that all worker processes add to the same
+   totals (see report()).
+"""
+import os
+import fcntl
+import shutil
+import hashlib
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from copy import deepcopy
+
+from nipype.interfaces.base import Interface, InterfaceResult, Bunch
+
+_digests = {}
+
+
+def file_digest(fname):
+    """sha1 of the content of fname, remembered per (size, mtime)."""
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime)
+    if key not in _digests:
+        sha = hashlib.sha1()
+        f = open(fname, 'rb')
+        try:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                sha.update(block)
+        finally:
+            f.close()
+        _digests[key] = sha.hexdigest()
+    return _digests[key]
+
+
+def describe(value):
+    """Replaces every existing file (or 'file,N' frame of one) in value
+    by its content digest."""
+    if isinstance(value, (list, tuple)):
+        return [describe(v) for v in value]
+    if isinstance(value, dict):
+        return sorted([(k, describe(v)) for k, v in value.items()])
+    if isinstance(value, str) and os.path.isfile(value):
+        return 'file:' + file_digest(value)
+    if isinstance(value, str) and ',' in value:
+        fname, frame = value.rsplit(',', 1)
+        if frame.isdigit() and os.path.isfile(fname):
+            return 'file:%s,%s' % (file_digest(fname), frame)
+    return repr(value)
+
+
+def _map_files(value, function, isfile=os.path.isfile):
+    if isinstance(value, list):
+        return [_map_files(v, function, isfile) for v in value]
+    if isinstance(value, tuple):
+        return tuple([_map_files(v, function, isfile) for v in value])
+    if isinstance(value, str) and isfile(value):
+        return function(value)
+    return value
+
+
+class ResultCache(object):
+    """Content addressed, size bounded store of interface results."""
+
+    def __init__(self, directory, max_bytes=10 * 2 ** 30):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def __repr__(self):
+        return 'ResultCache(%r, max_bytes=%d)' % (self.directory, self.max_bytes)
+
+    def wrap(self, interface):
+        return CachedInterface(interface, self)
+
+    def key(self, interface):
+        inputs = sorted([(name, describe(value))
+                         for name, value in interface.inputs.__dict__.items()])
+        sha = hashlib.sha1()
+        sha.update((interface.__class__.__module__ + '.' +
+                    interface.__class__.__name__).encode('utf-8'))
+        sha.update(repr(inputs).encode('utf-8'))
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def _count(self, event):
+        f = open(os.path.join(self.directory, 'stats'), 'a')
+        f.write(event + '\n')
+        f.close()
+
+    def _lock(self, entry, mode):
+        """Opens the lock file of entry and locks it (fcntl.LOCK_SH or
+        LOCK_EX). Returns the file or None if the lock is not free."""
+        try:
+            f = open(os.path.join(entry, '.lock'), 'a')
+        except IOError:
+            return None
+        try:
+            fcntl.flock(f.fileno(), mode)
+        except IOError:
+            f.close()
+            return None
+        return f
+
+    def load(self, key, cwd):
+        """Copies the stored files into cwd and returns the outputs, or
+        None when key is not in the cache."""
+        entry = self._entry(key)
+        lock = self._lock(entry, fcntl.LOCK_SH)
+        if lock is None:
+            self._count('miss')
+            return None
+        try:
+            try:
+                # evict() moves an entry aside before removing it
+                f = open(os.path.join(entry, 'outputs.pklz'), 'rb')
+            except IOError:
+                self._count('miss')
+                return None
+            outputs = pickle.load(f)
+            f.close()
+            os.utime(entry, None)
+
+            def stored(fname):
+                return os.path.isfile(os.path.join(entry, 'files', fname))
+
+            def restore(fname):
+                target = os.path.join(cwd, fname)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                shutil.copy2(os.path.join(entry, 'files', fname), target)
+                return target
+            for name, value in outputs.__dict__.items():
+                setattr(outputs, name, _map_files(value, restore, stored))
+        finally:
+            lock.close()
+        self._count('hit')
+        return outputs
+
+    def store(self, key, outputs, cwd):
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        os.mkdir(os.path.join(tmp, 'files'))
+        open(os.path.join(tmp, '.lock'), 'w').close()
+        stored = deepcopy(outputs)
+        outside = []
+
+        def save(fname):
+            # kept as a path relative to the entry so that it exists on
+            # load; files outside cwd get a directory of their own
+            fname = os.path.abspath(fname)
+            path = os.path.relpath(fname, cwd)
+            if path.startswith(os.pardir):
+                outside.append(fname)
+                path = os.path.join('_%d' % len(outside), os.path.basename(fname))
+            target = os.path.join(tmp, 'files', path)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copy2(fname, target)
+            return path
+        for name, value in outputs.__dict__.items():
+            setattr(stored, name, _map_files(value, save))
+        f = open(os.path.join(tmp, 'outputs.pklz'), 'wb')
+        pickle.dump(stored, f, 2)
+        f.close()
+        try:
+            os.rename(tmp, self._entry(key))
+        except OSError:
+            # another process stored the same result first
+            shutil.rmtree(tmp)
+        self.evict()
+
+    def _size(self, path):
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for fname in files:
+                total += os.path.getsize(os.path.join(root, fname))
+        return total
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits
+        into max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path) and not name.startswith('.'):
+                entries.append((os.path.getmtime(path), self._size(path), path))
+        entries.sort()
+        total = sum([e[1] for e in entries])
+        while entries and total > self.max_bytes:
+            _, size, path = entries.pop(0)
+            lock = self._lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if lock is None:
+                # being loaded (or already gone)
+                continue
+            aside = os.path.join(self.directory, '.evict-%s-%d' % (os.path.basename(path),
+                                                                   os.getpid()))
+            try:
+                os.rename(path, aside)
+            except OSError:
+                lock.close()
+                continue
+            lock.close()
+            shutil.rmtree(aside, ignore_errors=True)
+            total -= size
+
+    def report(self):
+        """Returns (hits, misses) counted so far."""
+        counts = {'hit': 0, 'miss': 0}
+        try:
+            f = open(os.path.join(self.directory, 'stats'))
+        except IOError:
+            return 0, 0
+        for line in f:
+            if line.strip() in counts:
+                counts[line.strip()] += 1
+        f.close()
+        return counts['hit'], counts['miss']
+
+
+class InterfaceWrapper(Interface):
+    '''
+    Base of interfaces which add behaviour around another interface.
+    inputs and outputs are those of the wrapped interface, so the
+    wrapper can be used wherever the interface was.
+    '''
+    def __init__(self, interface):
+        self.interface = interface
+
+    def _get_inputs(self):
+        return self.interface.inputs
+
+    def _set_inputs(self, inputs):
+        self.interface.inputs = inputs
+
+    inputs = property(_get_inputs, _set_inputs)
+
+    def inputs_help(self):
+        self.interface.inputs_help()
+
+    def outputs_help(self):
+        self.interface.outputs_help()
+
+    def outputs(self):
+        return self.interface.outputs()
+
+    def aggregate_outputs(self):
+        return self.interface.aggregate_outputs()
+
+    def run(self, cwd=None):
+        return self.interface.run(cwd=cwd)
+
+
+class CachedInterface(InterfaceWrapper):
+    '''
+    Runs interface through a ResultCache.
+    '''
+    def __init__(self, interface, cache):
+        InterfaceWrapper.__init__(self, interface)
+        self.cache = cache
+
+    def run(self, cwd=None):
+        if cwd is None:
+            cwd = os.getcwd()
+        key = self.cache.key(self.interface)
+        outputs = self.cache.load(key, cwd)
+        if outputs is not None:
+            runtime = Bunch(returncode=0, messages='result taken from cache %s' % key,
+                            errmessages=None)
+            return InterfaceResult(deepcopy(self.interface), runtime, outputs=outputs)
+        result = self.interface.run(cwd=cwd)
+        if result.runtime.returncode == 0 and result.outputs is not None:
+            self.cache.store(key, result.outputs, cwd)
+        return result
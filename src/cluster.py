@@ -0,0 +1,407 @@
+"""
+   Runs the (subject, task) branches on many hosts through a job queue
+   kept in a shared directory.
+
+   The queue is a directory on a file system all hosts can see (the
+   working directory is shared the same way)::
+
+       queue/pending/   jobs waiting for a worker
+       queue/running/   jobs claimed by a worker (renamed, so only one
+                        worker can claim a job)
+       queue/done/      finished jobs
+       queue/failed/    jobs that failed max_attempts times
+       queue/slots/     lock files of limited resources, e.g. MATLAB
+                        licenses
+
+   submit() writes one job per branch, every host runs worker() (e.g.
+   ``python cluster.py worker /shared/queue``) and wait() blocks until
+   the queue is empty. A failed job goes back to pending until it has
+   been tried max_attempts times. A worker touches the file of its
+   running job every lease / 10 seconds; a running job not touched for
+   lease seconds (its worker or host died) counts as a failed attempt.
+   A worker that finds its job gone (e.g. it stalled beyond the lease)
+   stops the job and drops its result.
+   A job can request resources (e.g. {'matlab': 2}); every MATLAB node
+   then holds one of that many slots while it runs, across all workers
+   and hosts. A slot whose owner died is taken over: at once on the
+   same host, after lease seconds without a touch on another.
+   The MATLAB command of the submitting process (e.g. the client of a
+   matlab_server) is passed on to the jobs; the server listens on a unix
+   socket, so its client only works for the workers of run_local().
+
+   run_local() starts a number of workers as processes on this host,
+   which emulates a cluster for testing.
+"""
+import os
+import sys
+import time
+import socket
+import threading
+import traceback
+import multiprocessing
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import parallel
+from lazy import lazy_import, loaded
+mlab = lazy_import('nipype.interfaces.matlab')        # how to run matlab
+sink = lazy_import('sink')                            # background result export
+
+_states = ['pending', 'running', 'done', 'failed']
+LEASE = 600.
+
+
+def _import(name):
+    """'module:function' -> function."""
+    module, function = name.split(':')
+    __import__(module)
+    return getattr(sys.modules[module], function)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _owner(fname):
+    """(host, pid) written into a lock file, or None."""
+    try:
+        f = open(fname)
+        host, pid = f.read().strip().rsplit(':', 1)
+        f.close()
+        return host, int(pid)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _expired(fname, lease):
+    try:
+        return time.time() - os.path.getmtime(fname) > lease
+    except OSError:
+        return False
+
+
+class FileSlots(object):
+    """n slots of a resource shared by all processes which see
+    directory, taken with exclusive creation of lock files holding
+    host:pid of the owner. The owner touches its locks every lease / 10
+    seconds; the lock of a dead owner is taken over."""
+
+    def __init__(self, directory, n, poll=1., lease=LEASE):
+        self.directory = directory
+        self.n = n
+        self.poll = poll
+        self.lease = lease
+        self.held = []
+        self.heartbeat = None
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+    def _dead(self, lock, owner):
+        if owner is None:
+            # the owner died before it wrote into the lock
+            return _expired(lock, self.lease)
+        host, pid = owner
+        if host == socket.gethostname():
+            return not _alive(pid)
+        return _expired(lock, self.lease)
+
+    def _reclaim(self, lock):
+        """Removes lock if its owner is dead. Returns whether it did."""
+        owner = _owner(lock)
+        if not os.path.exists(lock) or not self._dead(lock, owner):
+            return False
+        # renamed first, so that of several processes reclaiming the
+        # same lock only one removes it
+        aside = '%s.%s-%d' % (lock, socket.gethostname(), os.getpid())
+        try:
+            os.rename(lock, aside)
+        except OSError:
+            return False
+        if _owner(aside) != owner:
+            # taken by a live process in the meantime: put it back
+            try:
+                os.link(aside, lock)
+            except OSError:
+                pass
+            os.remove(aside)
+            return False
+        os.remove(aside)
+        return True
+
+    def _touch(self):
+        while True:
+            time.sleep(self.lease / 10.)
+            for lock in list(self.held):
+                try:
+                    os.utime(lock, None)
+                except OSError:
+                    pass
+
+    def acquire(self):
+        while True:
+            for i in range(self.n):
+                lock = os.path.join(self.directory, 'slot%d' % i)
+                try:
+                    fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except OSError:
+                    self._reclaim(lock)
+                    continue
+                os.write(fd, ('%s:%d\n' % (socket.gethostname(), os.getpid())).encode('utf-8'))
+                os.close(fd)
+                self.held.append(lock)
+                if self.heartbeat is None:
+                    self.heartbeat = threading.Thread(target=self._touch)
+                    self.heartbeat.daemon = True
+                    self.heartbeat.start()
+                return
+            time.sleep(self.poll)
+
+    def release(self):
+        os.remove(self.held.pop())
+
+
+class JobQueue(object):
+
+    def __init__(self, directory, lease=LEASE):
+        self.directory = os.path.abspath(directory)
+        self.lease = lease
+        for state in _states + ['slots']:
+            path = os.path.join(self.directory, state)
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    pass
+
+    def _path(self, state, name=''):
+        return os.path.join(self.directory, state, name)
+
+    def _write(self, state, name, job):
+        tmp = self._path(state, '.' + name)
+        f = open(tmp, 'wb')
+        pickle.dump(job, f, 2)
+        f.close()
+        os.rename(tmp, self._path(state, name))
+
+    def _read(self, state, name):
+        f = open(self._path(state, name), 'rb')
+        job = pickle.load(f)
+        f.close()
+        return job
+
+    def _jobs(self, state):
+        return sorted([name for name in os.listdir(self._path(state))
+                       if not name.startswith('.')])
+
+    def submit(self, build, subjects, task_names, workdir, build_kwargs=None,
+               setup=None, resources=None, max_attempts=3, matlab_cmd=None):
+        """Queues one job per (subject, task).
+
+        build and setup are given as 'module:function' so that workers
+        on other hosts can import them. setup is called once per job
+        before the pipeline is built (e.g. 'pipeline:configure'), and
+        matlab_cmd (if given) is set after it.
+        """
+        names = []
+        for job in parallel.make_jobs(build, subjects, task_names, workdir, build_kwargs):
+            build, subject_id, task_name, workdir, kwargs = job
+            name = '%s__%s' % (subject_id, task_name)
+            self._write('pending', name, dict(build=build, setup=setup,
+                                              subject_id=subject_id,
+                                              task_name=task_name,
+                                              workdir=workdir,
+                                              build_kwargs=kwargs,
+                                              resources=resources or {},
+                                              matlab_cmd=matlab_cmd,
+                                              attempts=0,
+                                              max_attempts=max_attempts,
+                                              errors=[]))
+            names.append(name)
+        return names
+
+    def claim(self, worker_id):
+        """Moves the first pending job to running and returns (name,
+        job), or None when nothing is pending."""
+        self.requeue_lost()
+        for name in self._jobs('pending'):
+            claimed = '%s@%s' % (name, worker_id)
+            try:
+                # the lease of the job starts now (see requeue_lost)
+                os.utime(self._path('pending', name), None)
+                os.rename(self._path('pending', name), self._path('running', claimed))
+            except OSError:
+                # another worker was faster
+                continue
+            return claimed, self._read('running', claimed)
+        return None
+
+    def touch(self, claimed):
+        """Renews the lease of a running job. Returns whether the job is
+        still claimed by its worker (it is not once requeue_lost gave up
+        on it)."""
+        try:
+            os.utime(self._path('running', claimed), None)
+        except OSError:
+            return False
+        return True
+
+    def requeue_lost(self):
+        """Counts the running jobs whose lease ran out as failed
+        attempts."""
+        for claimed in self._jobs('running'):
+            if not _expired(self._path('running', claimed), self.lease):
+                continue
+            # renamed first, so that only one process requeues the job
+            lost = '.lost-' + claimed
+            try:
+                os.rename(self._path('running', claimed), self._path('running', lost))
+            except OSError:
+                continue
+            job = self._read('running', lost)
+            os.remove(self._path('running', lost))
+            self._failed(claimed.split('@')[0], job,
+                         'worker %s lost (no heartbeat for %d s)'
+                         % (claimed.split('@')[-1], self.lease))
+
+    def finish(self, claimed, job, error=None):
+        """Records the result of a claimed job, unless the worker lost
+        its claim: the job was then given up on (see requeue_lost) and
+        queued again, and the result of its next run counts."""
+        name = claimed.split('@')[0]
+        try:
+            os.remove(self._path('running', claimed))
+        except OSError:
+            return
+        if error is None:
+            self._write('done', name, job)
+        else:
+            self._failed(name, job, error)
+
+    def _failed(self, name, job, error):
+        job['attempts'] += 1
+        job['errors'].append(error)
+        if job['attempts'] < job['max_attempts']:
+            self._write('pending', name, job)
+        else:
+            self._write('failed', name, job)
+
+    def status(self):
+        return dict([(state, len(self._jobs(state))) for state in _states])
+
+    def wait(self, poll=5.):
+        """Blocks until no job is pending or running. Returns the
+        failed jobs as {name: [errors]}."""
+        while True:
+            self.requeue_lost()
+            status = self.status()
+            if status['pending'] == 0 and status['running'] == 0:
+                break
+            time.sleep(poll)
+        failed = {}
+        for name in self._jobs('failed'):
+            failed[name] = self._read('failed', name)['errors']
+        return failed
+
+
+def run_job(queue, job):
+    if job['setup']:
+        _import(job['setup'])()
+    if job.get('matlab_cmd'):
+        # e.g. the client of a matlab_server, which setup would replace
+        mlab.MatlabCommandLine.matlab_cmd = job['matlab_cmd']
+    slots = job['resources'].get('matlab')
+    if slots:
+        parallel.limit_matlab(FileSlots(os.path.join(queue.directory, 'slots', 'matlab'),
+                                        slots, lease=queue.lease))
+    pipeline = _import(job['build'])(subjects=[job['subject_id']],
+                                     selected_tasks=[job['task_name']],
+                                     workdir=os.path.join(job['workdir'], job['task_name']),
+                                     **job['build_kwargs'])
+    pipeline.run()
+    if loaded(sink):
+        sink.wait()
+
+
+def worker(directory, poll=5., exit_when_empty=False, lease=LEASE):
+    """Runs jobs from the queue in directory, one at a time, in a child
+    process each (so that every job starts from a clean interpreter
+    state)."""
+    queue = JobQueue(directory, lease)
+    worker_id = '%s-%d' % (socket.gethostname(), os.getpid())
+    while True:
+        claimed = queue.claim(worker_id)
+        if claimed is None:
+            # a job running elsewhere may still fail and be queued again
+            if exit_when_empty and queue.status()['running'] == 0:
+                return
+            time.sleep(poll)
+            continue
+        name, job = claimed
+        process = multiprocessing.Process(target=_run_in_child, args=(queue, job, name))
+        process.start()
+        while process.is_alive():
+            if not queue.touch(name):
+                # the job runs elsewhere now, this run would only get in
+                # its way
+                process.terminate()
+            process.join(lease / 10.)
+        error = None
+        if process.exitcode != 0:
+            error = _read_error(queue, name) or 'exit code %s' % process.exitcode
+        queue.finish(name, job, error)
+
+
+def _error_file(queue, name):
+    return os.path.join(queue.directory, 'running', '.%s.error' % name)
+
+
+def _run_in_child(queue, job, name):
+    try:
+        run_job(queue, job)
+    except Exception:
+        f = open(_error_file(queue, name), 'w')
+        f.write(traceback.format_exc())
+        f.close()
+        sys.exit(1)
+
+
+def _read_error(queue, name):
+    fname = _error_file(queue, name)
+    if not os.path.exists(fname):
+        return None
+    f = open(fname)
+    error = f.read()
+    f.close()
+    os.remove(fname)
+    return error
+
+
+def run_local(directory, n_workers, poll=1., lease=LEASE):
+    """Emulates n_workers hosts with local processes working through
+    the queue in directory until it is empty. Returns the failed
+    jobs."""
+    queue = JobQueue(directory, lease)
+    workers = []
+    for i in range(n_workers):
+        process = multiprocessing.Process(target=worker, args=(directory, poll, True, lease))
+        process.start()
+        workers.append(process)
+    for process in workers:
+        process.join()
+    return queue.wait(poll)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != 'worker':
+        sys.stderr.write('usage: python cluster.py worker QUEUE_DIRECTORY\n')
+        sys.exit(1)
+    worker(sys.argv[2])
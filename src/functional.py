@@ -1,34 +1,99 @@
-import nipype.interfaces.io as nio           # Data i/o 
-import nipype.interfaces.spm as spm          # spm
-import nipype.interfaces.matlab as mlab      # how to run matlab
-import nipype.interfaces.fsl as fsl          # fsl
-import nipype.interfaces.freesurfer as fs    # freesurfer
-import nipype.pipeline.node_wrapper as nw    # nodes for pypelines
-import nipype.pipeline.engine as pe          # pypeline engine
-import nipype.algorithms.rapidart as ra      # artifact detection
-import nipype.algorithms.modelgen as model   # model specification
 import os                                    # system functions
+from lazy import lazy_import
+spm = lazy_import('nipype.interfaces.spm')            # spm
+fsl = lazy_import('nipype.interfaces.fsl')            # fsl
+fs = lazy_import('nipype.interfaces.freesurfer')      # freesurfer
+nw = lazy_import('nipype.pipeline.node_wrapper')      # nodes for pypelines
+model = lazy_import('nipype.algorithms.modelgen')     # model specification
+glm = lazy_import('glm')                              # shared first level estimation
+volumes = lazy_import('volumes')                      # memory mapped volume operations
+qa = lazy_import('qa')                                # motion and intensity outliers
 
 
 def makelist(item):
     return [item]
 
+def mask_name(maskInterface):
+    if "name" in maskInterface:
+        return maskInterface["name"]
+    if maskInterface["object"] is None:
+        return maskInterface["outputFile"].replace(os.sep, "_")
+    else:
+        return maskInterface["object"].name
+
 def functional_nodes(prefix, skip_vols, total_vols, pipeline, datasource, funcRunName,
-                     subjectinfo, contrasts, maskInterfaces, datasink):
-    skip = nw.NodeWrapper(interface=fsl.ExtractRoi(), diskbased=True, name=prefix + "_Skip.fsl")
+                     subjectinfo, contrasts, maskInterfaces, datasink, estimator='spm',
+                     streaming=False, structural=None, seed=None, native=(), qa_settings=None):
+    # structural holds the (node, output) pairs of the per subject
+    # structural stage shared by all tasks (see structural_nodes). With
+    # seed, the (node, output) of a coregistered mean of another task of
+    # the same session, the mean of this task is coregistered to it
+    # instead of to the structural: a functional to functional
+    # registration (same contrast), so the tasks of a session line up
+    # with each other through a single functional to structural
+    # registration. It is still a full SPM coregistration per task, so
+    # it does not save time. The coregistered mean is returned so that
+    # it can seed the following tasks.
+    # With qa_settings (inputs of qa.MotionQA, {} for the defaults) the
+    # realigned run is checked for motion and global signal outliers,
+    # which become regressors of the model, and the estimation nodes do
+    # not run at all for a run that fails.
+    if qa_settings is None:
+        gated = lambda interface: interface
+    else:
+        gated = qa.GatedInterface
+
+    if structural is None:
+        structural = dict(struct=(datasource, 'struct'),
+                          surfaces=(datasource, 'subject_id'))
+    if seed is None:
+        target = structural['struct']
+    else:
+        target = seed
+
+    # With streaming no volume is copied before the realignment: the
+    # kept volumes are passed to Realign as frame references into a
+    # link of the original run in the node directory (so that SPM does
+    # not write next to the raw data) and the realigned volumes to
+    # Coregister as the same frames of the realigned run (SPM writes
+    # them at the frame numbers of its input), instead of being cut out
+    # and split by FSL.
+    # native names the steps ('skip', 'split', 'smooth') run in process
+    # by volumes.py instead of by FSL and SPM; without streaming a
+    # natively skipped run is a copy of the kept volumes, as the split
+    # which follows needs a file holding only those.
+    if streaming:
+        skip = nw.NodeWrapper(interface=volumes.FrameList(), diskbased=True, name=prefix + "_Skip")
+        skipped = 'outfiles'
+    elif 'skip' in native:
+        skip = nw.NodeWrapper(interface=volumes.ExtractVolumes(), diskbased=True, name=prefix + "_Skip")
+        skipped = 'outfile'
+    else:
+        skip = nw.NodeWrapper(interface=fsl.ExtractRoi(), diskbased=True, name=prefix + "_Skip.fsl")
+        skipped = 'outfile'
     skip.inputs.tmin = skip_vols
     skip.inputs.tsize = total_vols
 
     realign = nw.NodeWrapper(interface=spm.Realign(), diskbased=True, name=prefix + "_Realign.spm")
     realign.inputs.register_to_mean = True
 
-    split = nw.NodeWrapper(interface=fsl.Split(), diskbased=True, name=prefix + "_Split.fsl")
-    split.inputdimension = 't'
+    if streaming:
+        split = nw.NodeWrapper(interface=volumes.FrameList(), diskbased=True, name=prefix + "_Frames")
+        split.inputs.tmin = skip_vols
+        split.inputs.tsize = total_vols
+    elif 'split' in native:
+        split = nw.NodeWrapper(interface=volumes.SplitVolumes(), diskbased=True, name=prefix + "_Split")
+    else:
+        split = nw.NodeWrapper(interface=fsl.Split(), diskbased=True, name=prefix + "_Split.fsl")
+        split.inputdimension = 't'
 
     coregister = nw.NodeWrapper(interface=spm.Coregister(), diskbased=True, name=prefix + "_CoregisterFuncToStruct.spm")
     coregister.inputs.jobtype = 'estwrite'
 
-    smooth = nw.NodeWrapper(interface=spm.Smooth(), diskbased=True, name=prefix + "_Smooth.spm")
+    if 'smooth' in native:
+        smooth = nw.NodeWrapper(interface=volumes.Smooth(), diskbased=True, name=prefix + "_Smooth")
+    else:
+        smooth = nw.NodeWrapper(interface=spm.Smooth(), diskbased=True, name=prefix + "_Smooth.spm")
     smooth.inputs.fwhm = [2, 2, 2]
     fs.FSInfo.subjectsdir('/home/filo/data/fs/')
     surfregister = nw.NodeWrapper(interface=fs.BBRegister(), diskbased=True, name=prefix + "_SurfReg.spm")
@@ -47,13 +112,13 @@ def functional_nodes(prefix, skip_vols, total_vols, pipeline, datasource, funcRu
     modelspec.inputs.high_pass_filter_cutoff = 128
 
     pipeline.connect([(datasource, skip, [(funcRunName, 'infile')]),
-                      (skip, realign, [('outfile', 'infile')]),
+                      (skip, realign, [(skipped, 'infile')]),
                       (realign, split, [('realigned_files', 'infile')]),
                       (realign, coregister, [('mean_image', 'source')]),
                       (split, coregister, [('outfiles', 'apply_to_files')]),
-                      (datasource, coregister, [('struct', 'target')]),
+                      (target[0], coregister, [(target[1], 'target')]),
                       (coregister, surfregister, [('coregistered_source', 'sourcefile')]),
-                      (datasource, surfregister, [('subject_id','subject_id')]),
+                      (structural['surfaces'][0], surfregister, [(structural['surfaces'][1], 'subject_id')]),
 #                      (surfregister, smooth, [('outregfile','regfile')]),
                       (coregister, smooth, [('coregistered_files', 'infile')]),
                       (datasource, modelspec, [('subject_id', 'subject_id'),
@@ -62,30 +127,72 @@ def functional_nodes(prefix, skip_vols, total_vols, pipeline, datasource, funcRu
                       (smooth, modelspec, [(('smoothed_files', makelist), 'functional_runs')])
                       ])
 
-    for maskInterface in maskInterfaces:
-    	if maskInterface["object"] is None:
-    		name = maskInterface["outputFile"].replace(os.sep, "_")
-    	else:
-    		name = maskInterface["object"].name
+    if qa_settings is not None:
+        motionqa = nw.NodeWrapper(interface=qa.MotionQA(**qa_settings), diskbased=True, name=prefix + "_MotionQA")
+        pipeline.connect([(realign, motionqa, [('realignment_parameters', 'realignment_parameters')]),
+                          (split, motionqa, [('outfiles', 'realigned_files')]),
+                          (motionqa, modelspec, [('outlier_files', 'outlier_files')])])
 
-        level1design = nw.NodeWrapper(interface=spm.Level1Design(), diskbased=True, name=prefix + "_Level1Design" + name + ".spm")
+    # The model is estimated once inside the union of all masks and the
+    # T maps are restricted to every mask afterwards, instead of fitting
+    # the same time series once per mask. With estimator='numpy' the
+    # three SPM steps are replaced by glm.EstimateGLM.
+    mergemasks = nw.NodeWrapper(interface=glm.MergeMasks(len(maskInterfaces)), diskbased=True, name=prefix + "_MergeMasks")
+    if estimator == 'numpy':
+        contrastestimate = nw.NodeWrapper(interface=gated(glm.EstimateGLM()), diskbased=True, name=prefix + "_EstimateGLM")
+        contrastestimate.inputs.timing_units = modelspec.inputs.output_units
+        contrastestimate.inputs.interscan_interval = modelspec.inputs.time_repetition
+        contrastestimate.inputs.contrasts = contrasts
+        estimation = [contrastestimate]
+        pipeline.connect([(modelspec, contrastestimate, [('session_info', 'session_info')]),
+                          (mergemasks, contrastestimate, [('mask_file', 'mask_image')])])
+    else:
+        level1design = nw.NodeWrapper(interface=gated(spm.Level1Design()), diskbased=True, name=prefix + "_Level1Design.spm")
         level1design.inputs.timing_units = modelspec.inputs.output_units
         level1design.inputs.interscan_interval = modelspec.inputs.time_repetition
         level1design.inputs.bases = {'hrf':{'derivs': [0, 0]}}
-    	if maskInterface["object"] is None:
-    		level1design.inputs.mask_image = maskInterface["outputFile"]
-    		pipeline.connect([(modelspec, level1design, [('session_info', 'session_info')])])
-    	else:
-        	pipeline.connect([(modelspec, level1design, [('session_info', 'session_info')]),
-                            (maskInterface["object"], level1design, [(maskInterface["outputFile"], 'mask_image')])])
-
-        level1estimate = nw.NodeWrapper(interface=spm.EstimateModel(), diskbased=True, name=prefix + "_EstimateModel" + name + ".spm")
+
+        level1estimate = nw.NodeWrapper(interface=gated(spm.EstimateModel()), diskbased=True, name=prefix + "_EstimateModel.spm")
         level1estimate.inputs.estimation_method = {'Classical' : 1}
-        contrastestimate = nw.NodeWrapper(interface=spm.EstimateContrast(), diskbased=True, name=prefix + "_EstimateContrast" + name + ".spm")
+        contrastestimate = nw.NodeWrapper(interface=gated(spm.EstimateContrast()), diskbased=True, name=prefix + "_EstimateContrast.spm")
         contrastestimate.inputs.contrasts = contrasts
-        pipeline.connect([(level1design, level1estimate, [('spm_mat_file', 'spm_design_file')]),
+        estimation = [level1design, level1estimate, contrastestimate]
+        pipeline.connect([(modelspec, level1design, [('session_info', 'session_info')]),
+                          (mergemasks, level1design, [('mask_file', 'mask_image')]),
+                          (level1design, level1estimate, [('spm_mat_file', 'spm_design_file')]),
                           (level1estimate, contrastestimate, [('spm_mat_file', 'spm_mat_file'),
                                                               ('beta_images', 'beta_images'),
                                                               ('residual_image', 'residual_image'),
-                                                              ('RPVimage', 'RPVimage')]),
-                          (contrastestimate, datasink, [('spmT_images', 'contrasts.' + prefix + name.replace(".", "_"))])])
+                                                              ('RPVimage', 'RPVimage')])])
+
+    # the T maps, the con images and (with SPM) the beta images of the
+    # single fit are cut down to every mask, into the same folder
+    masked = [(contrastestimate, 'spmT_images', ''), (contrastestimate, 'con_images', 'Con')]
+    if estimator != 'numpy':
+        masked.append((level1estimate, 'beta_images', 'Beta'))
+    for i, maskInterface in enumerate(maskInterfaces):
+        if maskInterface["object"] is None:
+            setattr(mergemasks.inputs, 'mask%d' % i, maskInterface["outputFile"])
+        else:
+            pipeline.connect([(maskInterface["object"], mergemasks, [(maskInterface["outputFile"], 'mask%d' % i)])])
+        folder = 'contrasts.' + prefix + mask_name(maskInterface).replace(".", "_")
+
+        for estimates, images, kind in masked:
+            applymask = nw.NodeWrapper(interface=gated(glm.ApplyMask()), diskbased=True, name=prefix + "_ApplyMask" + kind + mask_name(maskInterface))
+            if maskInterface["object"] is None:
+                applymask.inputs.mask_file = maskInterface["outputFile"]
+            else:
+                pipeline.connect([(maskInterface["object"], applymask, [(maskInterface["outputFile"], 'mask_file')])])
+            if qa_settings is not None:
+                pipeline.connect([(motionqa, applymask, [('qa_file', 'qa_file')])])
+            field = folder
+            if kind:
+                field += '.@' + kind.lower()
+            pipeline.connect([(estimates, applymask, [(images, 'infiles')]),
+                              (applymask, datasink, [('outfiles', field)])])
+
+    if qa_settings is not None:
+        for node in estimation:
+            pipeline.connect([(motionqa, node, [('qa_file', 'qa_file')])])
+
+    return (coregister, 'coregistered_source')
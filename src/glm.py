@@ -0,0 +1,449 @@
+"""
+   Interfaces used to fit the first level model once for all the masks
+   of a task.
+
+   Instead of estimating the same smoothed time series once per mask,
+   the model is estimated inside the union of all masks (MergeMasks)
+   and the resulting statistical images are cut down to every single
+   mask afterwards (ApplyMask). Under the classical OLS model of
+   EstimateGLM the parameter and T values of a voxel do not depend on
+   which other voxels are in the mask. Those of SPM do: EstimateModel
+   pools the voxels of the mask for its ReML estimate of the serial
+   correlations, so the T values of a mask cut out of the union (which
+   includes the skull stripped brain) differ from those of a fit in
+   that mask alone. ApplyMask writes this into the description of
+   every image it masks.
+
+   EstimateGLM is a MATLAB free alternative to the Level1Design,
+   EstimateModel and EstimateContrast chain. It builds the design from
+   the session_info of SpecifyModel (canonical HRF, realignment
+   regressors, DCT high pass filter as in SPM) and solves all voxels
+   of a block at once with a single least squares solution. The scans
+   are memory mapped (MaskedScans) and only chunk_size voxels of all
+   scans are read and held at a time, so apart from the page cache the
+   memory needed is that of one block and of the con and T values of
+   the mask.
+"""
+import os
+from copy import deepcopy
+
+import numpy as np
+from scipy.stats import gamma
+import nifti as ni
+from nipype.interfaces.base import Interface, InterfaceResult, Bunch
+
+from atlas import save_if_changed
+import volumes
+
+
+def _split_filename(fname):
+    path, name = os.path.split(fname)
+    for ext in ['.nii.gz', '.nii', '.img', '.hdr']:
+        if name.endswith(ext):
+            return path, name[:-len(ext)], ext
+    return path, name, ''
+
+
+class MergeMasks(Interface):
+    '''
+    Returns a mask which is the union (logical or) of n_masks masks
+    given as inputs mask0, mask1, ... Any non zero voxel counts as
+    inside a mask. All masks have to be on the same grid.
+    '''
+    def __init__(self, n_masks, *args, **inputs):
+        self.n_masks = n_masks
+        self._populate_inputs()
+        self.inputs.update(**inputs)
+
+    def inputs_help(self):
+        """
+        Parameters
+        --------------------
+        mask0, mask1, ... : files
+            masks to merge
+        output_file : file
+            name of the merged mask (optional)
+        """
+        print(self.inputs_help.__doc__)
+
+    def _populate_inputs(self):
+        self.inputs = Bunch(output_file=None)
+        for i in range(self.n_masks):
+            setattr(self.inputs, 'mask%d' % i, None)
+
+    def outputs_help(self):
+        """
+        Parameters
+        --------------------
+        mask_file : file
+            union of all masks
+        """
+        print(self.outputs_help.__doc__)
+
+    def outputs(self):
+        outputs = Bunch(mask_file=None)
+        return outputs
+
+    def aggregate_outputs(self):
+        outputs = self.outputs()
+        outputs.mask_file = self._gen_output_filename()
+        return outputs
+
+    def _gen_output_filename(self):
+        if self.inputs.output_file:
+            return os.path.abspath(self.inputs.output_file)
+        return os.path.abspath('union_mask.nii')
+
+    def run(self, cwd=None):
+        first = ni.NiftiImage(self.inputs.mask0)
+        union = first.data != 0
+        for i in range(1, self.n_masks):
+            union |= ni.NiftiImage(getattr(self.inputs, 'mask%d' % i)).data != 0
+        save_if_changed(union.astype(np.uint8), first.header, self._gen_output_filename())
+
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        outputs = self.aggregate_outputs()
+        return InterfaceResult(deepcopy(self), runtime, outputs=outputs)
+
+
+class ApplyMask(Interface):
+    '''
+    Sets every voxel outside mask_file to NaN (the value SPM uses for
+    voxels outside the analysis mask) in each of the infiles. The
+    description of the masked images says that they were estimated in
+    a larger mask.
+    '''
+    def __init__(self, *args, **inputs):
+        self._populate_inputs()
+        self.inputs.update(**inputs)
+
+    def inputs_help(self):
+        """
+        Parameters
+        --------------------
+        infiles : list of files
+            statistical images estimated in a larger mask
+        mask_file : file
+            mask to restrict them to
+        """
+        print(self.inputs_help.__doc__)
+
+    def _populate_inputs(self):
+        self.inputs = Bunch(infiles=None,
+                            mask_file=None)
+
+    def outputs_help(self):
+        """
+        Parameters
+        --------------------
+        outfiles : list of files
+            masked images, in the same order as infiles
+        """
+        print(self.outputs_help.__doc__)
+
+    def outputs(self):
+        outputs = Bunch(outfiles=None)
+        return outputs
+
+    def aggregate_outputs(self):
+        outputs = self.outputs()
+        outputs.outfiles = [self._gen_output_filename(f) for f in self._infiles()]
+        return outputs
+
+    def _infiles(self):
+        if isinstance(self.inputs.infiles, str):
+            return [self.inputs.infiles]
+        return self.inputs.infiles
+
+    def _gen_output_filename(self, infile):
+        _, name, ext = _split_filename(infile)
+        return os.path.abspath(name + ext)
+
+    def run(self, cwd=None):
+        outside = ni.NiftiImage(self.inputs.mask_file).data == 0
+        for infile in self._infiles():
+            image = ni.NiftiImage(infile)
+            data = image.data.astype(np.float32)
+            data[outside] = np.nan
+            header = image.header
+            # NIfTI descriptions hold 80 characters
+            header['descrip'] = ('fit in the union of masks, cut to %s'
+                                 % os.path.basename(self.inputs.mask_file))[:80]
+            ni.NiftiImage(data, header).save(self._gen_output_filename(infile))
+
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        outputs = self.aggregate_outputs()
+        return InterfaceResult(deepcopy(self), runtime, outputs=outputs)
+
+
+_condition_columns = {}
+
+
+def spm_hrf(dt):
+    """SPM's canonical haemodynamic response sampled every dt seconds."""
+    u = np.arange(0, int(32. / dt) + 1) * dt
+    hrf = gamma.pdf(u, 6) - gamma.pdf(u, 16) / 6.
+    return hrf / hrf.sum()
+
+
+def dct_basis(n_scans, time_repetition, cutoff):
+    """Discrete cosine set of the SPM high pass filter, without the
+    constant term."""
+    order = int(2 * (n_scans * time_repetition) / cutoff + 1)
+    n = np.arange(n_scans)
+    basis = [np.sqrt(2. / n_scans) * np.cos(np.pi * (2 * n + 1) * k / (2. * n_scans))
+             for k in range(1, order)]
+    return np.array(basis).reshape(-1, n_scans).T
+
+
+def design_matrix(session, n_scans, time_repetition, timing_units='scans',
+                  microtime_resolution=16):
+    """Returns (X, names) for one session of a SpecifyModel session_info.
+
+    Columns are the conditions convolved with the canonical HRF, the
+    regressors of the session, the high pass filter and a constant.
+    """
+    dt = time_repetition / microtime_resolution
+    if timing_units == 'scans':
+        to_bins = float(microtime_resolution)
+    else:
+        to_bins = 1. / dt
+    hrf = spm_hrf(dt)
+    n_bins = n_scans * microtime_resolution
+
+    columns = []
+    names = []
+    for cond in session.get('cond', []):
+        # the timing is the same for every subject of a task, so the
+        # convolved regressor is only computed once
+        key = (tuple(np.atleast_1d(cond['onset'])), tuple(np.atleast_1d(cond['duration'])),
+               n_scans, time_repetition, timing_units, microtime_resolution)
+        if key not in _condition_columns:
+            stimulus = np.zeros(n_bins + len(hrf))
+            durations = np.atleast_1d(cond['duration'])
+            for i, onset in enumerate(np.atleast_1d(cond['onset'])):
+                duration = durations[i] if len(durations) > 1 else durations[0]
+                start = int(round(onset * to_bins))
+                stop = max(start + 1, int(round((onset + duration) * to_bins)))
+                stimulus[start:stop] = 1
+            convolved = np.convolve(stimulus, hrf)[:n_bins]
+            _condition_columns[key] = convolved[::microtime_resolution]
+        columns.append(_condition_columns[key])
+        names.append(cond['name'])
+    for regressor in session.get('regress', []):
+        columns.append(np.asarray(regressor['val'], dtype=float))
+        names.append(regressor['name'])
+    if session.get('hpf'):
+        filter_basis = dct_basis(n_scans, time_repetition, session['hpf'])
+        for k in range(filter_basis.shape[1]):
+            columns.append(filter_basis[:, k])
+            names.append('hpf%d' % (k + 1))
+    columns.append(np.ones(n_scans))
+    names.append('constant')
+    return np.array(columns).T, names
+
+
+def contrast_matrix(contrasts, names):
+    """Turns ['name', 'T', conditions, weights] contrasts into rows of
+    weights over the design columns. A condition present in several
+    sessions is weighted in all of them. Raises ValueError for a
+    condition which is not in the design, as SPM does."""
+    matrix = np.zeros((len(contrasts), len(names)))
+    for i, contrast in enumerate(contrasts):
+        for condition, weight in zip(contrast[2], contrast[3]):
+            if condition not in names:
+                raise ValueError("contrast %s: condition %s is not in the design"
+                                 % (contrast[0], condition))
+            for j, name in enumerate(names):
+                if name == condition:
+                    matrix[i, j] = weight
+    return matrix
+
+
+def estimate(data, X, C, chunk_size=20000):
+    """Ordinary least squares fit of data (scans x voxels).
+
+    Yields (voxel_slice, con, T) for consecutive blocks of at most
+    chunk_size voxels, con and T having one row per contrast in C.
+    """
+    pinvX = np.linalg.pinv(X)
+    df = X.shape[0] - np.linalg.matrix_rank(X)
+    # c (X'X)^-1 c' for every contrast
+    var_factor = (np.dot(C, pinvX) ** 2).sum(axis=1)
+    for start in range(0, data.shape[1], chunk_size):
+        block = slice(start, min(start + chunk_size, data.shape[1]))
+        Y = data[:, block].astype(np.float64)
+        B = np.dot(pinvX, Y)
+        residuals = Y - np.dot(X, B)
+        sigma2 = (residuals ** 2).sum(axis=0) / df
+        con = np.dot(C, B)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            T = con / np.sqrt(np.outer(var_factor, sigma2))
+        yield block, con, T
+
+
+def scan_frames(scans):
+    """[(file, [0 based frames])] of scans given as a file or a list of
+    3D or 4D files (all frames of a 4D file are scans) or of 'file,N'
+    frame references (see volumes.FrameList). Consecutive frames of
+    one file are grouped."""
+    if isinstance(scans, str):
+        scans = [scans]
+    frames = []
+    for scan in scans:
+        if ',' in scan:
+            fname, frame = scan.rsplit(',', 1)
+            selected = [int(frame) - 1]
+        else:
+            fname = scan
+            selected = list(range(volumes.frame_count(fname)))
+        if frames and frames[-1][0] == fname:
+            frames[-1][1].extend(selected)
+        else:
+            frames.append((fname, selected))
+    return frames
+
+
+class MaskedScans(object):
+    """The voxels of mask in a list of scans as a scans x voxels array
+    which is never held in memory: data[:, block] reads the voxels of
+    block from memory maps of the uncompressed NIfTI scans."""
+
+    def __init__(self, frames, mask):
+        self.voxels = np.flatnonzero(mask.ravel())
+        self.segments = []
+        n_scans = 0
+        for fname, selected in frames:
+            header, _, _, byteorder = volumes.read_header(fname)
+            data = volumes.memmap(fname)
+            data = data.reshape(data.shape[0], -1)
+            if data.shape[1] != mask.size:
+                raise ValueError("%s is not on the grid of the mask" % fname)
+            self.segments.append((data, selected, volumes.scaling(header, byteorder)))
+            n_scans += len(selected)
+        self.shape = (n_scans, len(self.voxels))
+
+    def __getitem__(self, index):
+        rows, block = index
+        columns = self.voxels[block]
+        values = np.empty((self.shape[0], len(columns)), dtype=np.float32)
+        row = 0
+        for data, selected, (slope, inter) in self.segments:
+            # only the columns of the block are read, for every frame
+            values[row:row + len(selected)] = data[:, columns][selected] * slope + inter
+            row += len(selected)
+        return values[rows]
+
+
+def load_session_info(session_info):
+    if isinstance(session_info, str):
+        return list(np.load(session_info)['session_info'])
+    return session_info
+
+
+class EstimateGLM(Interface):
+    '''
+    Estimates a first level model and its T contrasts with NumPy.
+
+    Takes the session_info of SpecifyModel and writes con and spmT
+    images (one of each per contrast, NaN outside the mask). The scans
+    can be files or frame references and have to be on the voxel grid
+    of the mask.
+    '''
+    def __init__(self, *args, **inputs):
+        self._populate_inputs()
+        self.inputs.update(**inputs)
+
+    def inputs_help(self):
+        """
+        Parameters
+        --------------------
+        session_info : list of dicts or file
+            output of SpecifyModel
+        mask_image : file
+            voxels to estimate the model in
+        contrasts : list
+            ['name', 'T', [conditions], [weights]] as for EstimateContrast
+        interscan_interval : float
+            TR in seconds
+        timing_units : 'scans' or 'secs'
+            units of onsets and durations in session_info
+        chunk_size : int
+            number of voxels solved at once (default 20000)
+        """
+        print(self.inputs_help.__doc__)
+
+    def _populate_inputs(self):
+        self.inputs = Bunch(session_info=None,
+                            mask_image=None,
+                            contrasts=None,
+                            interscan_interval=None,
+                            timing_units='scans',
+                            chunk_size=20000)
+
+    def outputs_help(self):
+        """
+        Parameters
+        --------------------
+        con_images : list of files
+            contrast estimates
+        spmT_images : list of files
+            T statistic images
+        """
+        print(self.outputs_help.__doc__)
+
+    def outputs(self):
+        outputs = Bunch(con_images=None,
+                        spmT_images=None)
+        return outputs
+
+    def aggregate_outputs(self):
+        outputs = self.outputs()
+        n = len(self.inputs.contrasts)
+        outputs.con_images = [os.path.abspath('con_%04d.nii' % (i + 1)) for i in range(n)]
+        outputs.spmT_images = [os.path.abspath('spmT_%04d.nii' % (i + 1)) for i in range(n)]
+        return outputs
+
+    def run(self, cwd=None):
+        sessions = load_session_info(self.inputs.session_info)
+        mask = ni.NiftiImage(self.inputs.mask_image).data != 0
+
+        # sessions are concatenated with a separate design block each
+        frames = []
+        blocks = []
+        for session in sessions:
+            session_frames = scan_frames(session['scans'])
+            X, names = design_matrix(session, sum([len(f[1]) for f in session_frames]),
+                                     self.inputs.interscan_interval,
+                                     self.inputs.timing_units)
+            frames.extend(session_frames)
+            blocks.append((X, names))
+        X = np.zeros((sum([b[0].shape[0] for b in blocks]),
+                      sum([b[0].shape[1] for b in blocks])))
+        names = []
+        row = col = 0
+        for session_X, session_names in blocks:
+            X[row:row + session_X.shape[0], col:col + session_X.shape[1]] = session_X
+            row += session_X.shape[0]
+            col += session_X.shape[1]
+            names.extend(session_names)
+        data = MaskedScans(frames, mask)
+        header = ni.NiftiImage(frames[0][0]).header
+        C = contrast_matrix(self.inputs.contrasts, names)
+
+        con = np.zeros((C.shape[0], data.shape[1]), dtype=np.float32)
+        T = np.zeros((C.shape[0], data.shape[1]), dtype=np.float32)
+        for block, block_con, block_T in estimate(data, X, C, self.inputs.chunk_size):
+            con[:, block] = block_con
+            T[:, block] = block_T
+
+        outputs = self.aggregate_outputs()
+        for values, files in [(con, outputs.con_images), (T, outputs.spmT_images)]:
+            for i, fname in enumerate(files):
+                volume = np.empty(mask.shape, dtype=np.float32)
+                volume.fill(np.nan)
+                volume[mask] = values[i]
+                ni.NiftiImage(volume, header).save(fname)
+
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        return InterfaceResult(deepcopy(self), runtime, outputs=outputs)
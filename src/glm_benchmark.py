@@ -0,0 +1,109 @@
+"""
+   Times the NumPy first level estimation (glm.EstimateGLM) against
+   the SPM Level1Design -> EstimateModel -> EstimateContrast chain on
+   synthetic 4D data with a block design like the finger tapping task.
+
+       python glm_benchmark.py            # NumPy only
+       python glm_benchmark.py --spm      # also run SPM and compare
+
+   Half of the voxels respond to the task, the rest is noise.
+"""
+import os
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+import numpy as np
+import nifti as ni
+
+import glm
+
+
+def make_data(directory, shape=(30, 64, 64), n_scans=173, time_repetition=2.5,
+              seed=0):
+    """Writes one volume per scan and a brain mask into directory.
+
+    Returns the session_info describing them.
+    """
+    rng = np.random.RandomState(seed)
+    session = dict(cond=[dict(name='Task', onset=range(6, n_scans, 24), duration=[12])],
+                   regress=[], hpf=128)
+    X, names = glm.design_matrix(session, n_scans, time_repetition)
+    effect = np.zeros(shape, dtype=np.float32)
+    effect[:, :, :shape[2] // 2] = 2.
+
+    scans = []
+    for t in range(n_scans):
+        volume = 100 + effect * X[t, 0] + rng.randn(*shape).astype(np.float32)
+        fname = os.path.join(directory, 'f%04d.nii' % t)
+        ni.NiftiImage(volume.astype(np.float32)).save(fname)
+        scans.append(fname)
+    mask = os.path.join(directory, 'mask.nii')
+    ni.NiftiImage(np.ones(shape, dtype=np.uint8)).save(mask)
+    session['scans'] = scans
+    return [session], mask
+
+
+def run_numpy(session_info, mask, contrasts, time_repetition, cwd):
+    os.chdir(cwd)
+    estimate = glm.EstimateGLM(session_info=session_info, mask_image=mask,
+                               contrasts=contrasts,
+                               interscan_interval=time_repetition)
+    return estimate.run().outputs.spmT_images
+
+
+def run_spm(session_info, mask, contrasts, time_repetition, cwd):
+    import nipype.interfaces.spm as spm
+    os.chdir(cwd)
+    design = spm.Level1Design(session_info=session_info, mask_image=mask,
+                              timing_units='scans',
+                              interscan_interval=time_repetition,
+                              bases={'hrf': {'derivs': [0, 0]}}).run()
+    model = spm.EstimateModel(spm_design_file=design.outputs.spm_mat_file,
+                              estimation_method={'Classical': 1}).run()
+    contrast = spm.EstimateContrast(spm_mat_file=model.outputs.spm_mat_file,
+                                    beta_images=model.outputs.beta_images,
+                                    residual_image=model.outputs.residual_image,
+                                    RPVimage=model.outputs.RPVimage,
+                                    contrasts=contrasts).run()
+    return contrast.outputs.spmT_images
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--spm", action="store_true", default=False,
+                      help="also run the SPM chain and compare the T maps")
+    parser.add_option("--scans", type="int", default=173)
+    options, args = parser.parse_args()
+
+    time_repetition = 2.5
+    contrasts = [['Task>Rest', 'T', ['Task'], [1]]]
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        session_info, mask = make_data(directory, n_scans=options.scans)
+        backends = [('numpy', run_numpy)]
+        if options.spm:
+            backends.append(('spm', run_spm))
+        results = {}
+        for name, run in backends:
+            outdir = os.path.join(directory, name)
+            os.mkdir(outdir)
+            start = time.time()
+            results[name] = run(session_info, mask, contrasts, time_repetition, outdir)
+            print("%-6s %8.2f s" % (name, time.time() - start))
+
+        if options.spm:
+            a = ni.NiftiImage(results['numpy'][0]).data
+            b = ni.NiftiImage(results['spm'][0]).data
+            valid = np.isfinite(a) & np.isfinite(b)
+            print("T map correlation %.4f, max abs difference %.4f" %
+                  (np.corrcoef(a[valid], b[valid])[0, 1], np.abs(a - b)[valid].max()))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+"""
+   Tracks what every node was last run with, so that a changed
+   pipeline only runs the nodes the change reaches.
+
+   The signature of a node is a digest of its interface, its own
+   parameters (input files by content) and the signatures of the
+   nodes it takes inputs from, together with which outputs it takes.
+   It does not depend on which subjects and tasks the graph was built
+   for, so the records of a parallel run (one small graph per subject
+   and task) hold for the full graph as well.
+
+   track() wraps every interface in a TrackedInterface. A successful
+   run appends a record to a manifest file, keyed by the node name and
+   the iterable values of its run (the '_<field>_<value>' directories
+   of the working directory), holding the signature, a digest of the
+   inputs the node ran with (input files by path, size and
+   modification time, as make does) and its outputs. When the node
+   comes up again with inputs of the same digest and its output files
+   are still there, the recorded outputs are returned instead of
+   running the interface (only for a run in the same node directory).
+   Every process reads the manifest once and after that only what was
+   appended to it. Adding a contrast therefore only runs the contrast
+   estimation, which finds the SPM.mat and the beta images of the
+   estimation in place. A new mask runs the ROI masks, the union of
+   the masks of its tasks (MergeMasks) and its own ApplyMask; the model
+   is only estimated again if the union changed, i.e. if the new mask
+   reaches outside the brain. Nodes without output files (the sinks)
+   and nodes not run in the working directory always run.
+
+   dry_run() compares the current signatures with the manifest and
+   lists the node runs that may execute and why::
+
+       track(l1pipeline, 'manifest.json')
+       for name, reason in dry_run(l1pipeline, 'manifest.json'):
+           print(name, reason)
+
+   It can only go by the graph and the last run of every node: a node
+   listed because an upstream node runs again is still skipped if that
+   node writes the same files, and a run is only reused in the
+   directory it was made in.
+"""
+import os
+import json
+import hashlib
+from copy import deepcopy
+
+from nipype.interfaces.base import InterfaceResult, Bunch
+
+from cache import InterfaceWrapper, describe
+
+
+def _unwrapped(interface):
+    while isinstance(interface, InterfaceWrapper):
+        interface = interface.interface
+    return interface
+
+
+def _connections(graph, node):
+    """[(upstream node, [(output, input), ...]), ...] sorted by name."""
+    connections = []
+    for upstream in graph.predecessors(node):
+        connect = graph.get_edge_data(upstream, node).get('connect', [])
+        connections.append((upstream, connect))
+    connections.sort(key=lambda c: c[0].name)
+    return connections
+
+
+def _input_name(connection):
+    return connection[1]
+
+
+def _output_name(connection):
+    # outputs can be given as (output, function) tuples
+    if isinstance(connection[0], tuple):
+        output, function = connection[0]
+        return '%s:%s' % (output, getattr(function, '__name__',
+                                          function.__class__.__name__))
+    return connection[0]
+
+
+def _files(value):
+    if isinstance(value, (list, tuple)):
+        files = []
+        for v in value:
+            files.extend(_files(v))
+        return files
+    # frames of a 4D file are given as 'file,N'
+    if isinstance(value, str) and os.path.isfile(value.split(',')[0]):
+        return [os.path.abspath(value.split(',')[0])]
+    return []
+
+
+def parameters(graph, node):
+    """The inputs of node which are not connected to another node."""
+    connected = []
+    for upstream, connect in _connections(graph, node):
+        connected.extend([_input_name(c) for c in connect])
+    interface = _unwrapped(node.interface)
+    return dict([(name, value) for name, value in interface.inputs.__dict__.items()
+                 if name not in connected])
+
+
+def signatures(pipeline):
+    """Returns {node name: (signature, parameter digest)} for every
+    node of the (not expanded) graph of pipeline. The iterables are
+    left out; they are part of the key of a run (see runs())."""
+    import networkx as nx
+    graph = pipeline._graph
+    result = {}
+    for node in nx.topological_sort(graph):
+        interface = _unwrapped(node.interface)
+        own = hashlib.sha1()
+        own.update(('%s.%s' % (interface.__class__.__module__,
+                               interface.__class__.__name__)).encode('utf-8'))
+        own.update(repr(describe(parameters(graph, node))).encode('utf-8'))
+        full = hashlib.sha1(own.hexdigest().encode('utf-8'))
+        for upstream, connect in _connections(graph, node):
+            full.update(result[upstream.name][0].encode('utf-8'))
+            full.update(repr(sorted([(_output_name(c), _input_name(c))
+                                     for c in connect])).encode('utf-8'))
+        result[node.name] = (full.hexdigest(), own.hexdigest())
+    return result
+
+
+def runs(pipeline):
+    """[(node, key)] of every run of a node of pipeline, in execution
+    order. key is the node name below the '_<field>_<value>' directories
+    of the iterables it depends on, as in the working directory."""
+    import networkx as nx
+    graph = pipeline._graph
+    iterations = {}
+    result = []
+    for node in nx.topological_sort(graph):
+        keys = ['']
+        for upstream in graph.predecessors(node):
+            if iterations[upstream] != ['']:
+                keys = iterations[upstream]
+        iterables = getattr(node, 'iterables', None)
+        if iterables:
+            field, values = iterables
+            keys = [os.path.join(key, '_%s_%s' % (field, value))
+                    for key in keys for value in values]
+        iterations[node] = keys
+        result.extend([(node, os.path.join(key, node.name)) for key in keys])
+    return result
+
+
+def run_key(name, cwd, workdir):
+    """The key of the run of node name in cwd, or None when cwd is not
+    inside workdir."""
+    path = os.path.relpath(os.path.abspath(cwd), workdir)
+    if path == os.curdir or path.startswith(os.pardir):
+        return None
+    iterations = [part for part in path.split(os.sep) if part.startswith('_')]
+    return os.path.join(*(iterations + [name]))
+
+
+def _native(value):
+    # json gives unicode strings on Python 2, the interfaces expect str
+    if isinstance(value, list):
+        return [_native(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(str(k), _native(v)) for k, v in value.items()])
+    if not isinstance(value, str) and isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+
+def _record(line):
+    if not line.strip():
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError:
+        # cut short by a killed process
+        return None
+    if 'key' not in record:
+        return None
+    return _native(record)
+
+
+def load_manifest(manifest):
+    """[record] of the successful runs of all nodes, oldest first."""
+    records = []
+    if not os.path.exists(manifest):
+        return records
+    f = open(manifest)
+    for line in f:
+        record = _record(line)
+        if record is not None:
+            records.append(record)
+    f.close()
+    return records
+
+
+# {manifest: (bytes read, {(key, directory): last record})} of this
+# process
+_manifests = {}
+
+
+def latest_runs(manifest):
+    """{(run key, directory): record of the last run there}. The
+    manifest is only read from where the last call stopped."""
+    offset, index = _manifests.get(manifest, (0, {}))
+    try:
+        size = os.path.getsize(manifest)
+    except OSError:
+        size = 0
+    if size < offset:
+        # the manifest was removed or replaced
+        offset, index = 0, {}
+    if size > offset:
+        f = open(manifest, 'rb')
+        f.seek(offset)
+        data = f.read(size - offset)
+        f.close()
+        # up to the last complete line
+        data = data[:data.rfind(b'\n') + 1]
+        offset += len(data)
+        for line in data.decode('utf-8').splitlines():
+            record = _record(line)
+            if record is not None:
+                index[(record['key'], record['directory'])] = record
+    _manifests[manifest] = (offset, index)
+    return index
+
+
+def _append(manifest, record):
+    # one write on an O_APPEND descriptor, so that the lines of
+    # parallel workers never interleave
+    fd = os.open(manifest, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 420)
+    try:
+        os.write(fd, (json.dumps(record) + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def stamp(value):
+    """Replaces every existing file (or 'file,N' frame of one) in value
+    by its path, size and modification time. Unlike cache.describe()
+    nothing is read, so a 4D run as input costs a stat and not a pass
+    over the run."""
+    if isinstance(value, (list, tuple)):
+        return [stamp(v) for v in value]
+    if isinstance(value, dict):
+        return sorted([(k, stamp(v)) for k, v in value.items()])
+    if isinstance(value, str) and ',' in value and not os.path.isfile(value):
+        fname, frame = value.rsplit(',', 1)
+        if frame.isdigit() and os.path.isfile(fname):
+            return '%s,%s' % (stamp(fname), frame)
+    if isinstance(value, str) and os.path.isfile(value):
+        stat = os.stat(value)
+        return 'file:%s:%d:%r' % (os.path.abspath(value), stat.st_size, stat.st_mtime)
+    return repr(value)
+
+
+def _reusable(record):
+    """Whether the outputs of record can be taken instead of running:
+    there are output files and they all still exist."""
+    if not record.get('files'):
+        return False
+    for fname in record['files']:
+        if not os.path.isfile(fname):
+            return False
+    return True
+
+
+class TrackedInterface(InterfaceWrapper):
+    '''
+    Runs interface unless the manifest has a run of its node with the
+    same inputs whose outputs are still there, and records a successful
+    run in manifest.
+    '''
+    def __init__(self, interface, name, signature, manifest, workdir):
+        InterfaceWrapper.__init__(self, interface)
+        self.name = name
+        self.signature = signature
+        self.manifest = manifest
+        self.workdir = workdir
+
+    def _inputs(self):
+        interface = _unwrapped(self.interface)
+        sha = hashlib.sha1()
+        sha.update(('%s.%s' % (interface.__class__.__module__,
+                               interface.__class__.__name__)).encode('utf-8'))
+        sha.update(repr(sorted([(name, stamp(value)) for name, value in
+                                self.interface.inputs.__dict__.items()])).encode('utf-8'))
+        return sha.hexdigest()
+
+    def run(self, cwd=None):
+        key = None
+        if cwd is not None:
+            key = run_key(self.name, cwd, self.workdir)
+        if key is None:
+            return self.interface.run(cwd=cwd)
+
+        # only a run in the same directory: the directories of other
+        # parallel branches may be removed under us (see retention.py)
+        record = latest_runs(self.manifest).get((key, os.path.abspath(cwd)))
+        if (record is not None and record['inputs'] == self._inputs()
+                and _reusable(record)):
+            runtime = Bunch(returncode=0,
+                            messages='outputs of the last run taken from %s' % self.manifest,
+                            errmessages=None)
+            return InterfaceResult(deepcopy(self.interface), runtime,
+                                   outputs=Bunch(**record['outputs']))
+
+        result = self.interface.run(cwd=cwd)
+        if result.runtime.returncode == 0:
+            outputs = {}
+            if result.outputs is not None:
+                outputs = dict(result.outputs.__dict__)
+            record = dict(node=self.name,
+                          key=key,
+                          directory=os.path.abspath(cwd),
+                          signature=self.signature[0],
+                          parameters=self.signature[1],
+                          # after the run: some nodes (e.g. SPM's contrast
+                          # estimation) add to their input files
+                          inputs=self._inputs(),
+                          outputs=outputs,
+                          files=_files(list(outputs.values())))
+            try:
+                _append(self.manifest, record)
+            except TypeError:
+                # outputs which are not JSON: the node always runs
+                record['outputs'] = {}
+                record['files'] = []
+                _append(self.manifest, record)
+        return result
+
+
+def track(pipeline, manifest):
+    """Wraps every node of pipeline in a TrackedInterface."""
+    manifest = os.path.abspath(manifest)
+    workdir = os.path.abspath(pipeline.config['workdir'])
+    current = signatures(pipeline)
+    for node in pipeline._graph.nodes():
+        if not isinstance(node.interface, TrackedInterface):
+            node.interface = TrackedInterface(node.interface, node.name,
+                                              current[node.name], manifest, workdir)
+    return pipeline
+
+
+def dry_run(pipeline, manifest):
+    """Returns [(run key, reason)] for the node runs that would execute,
+    in execution order (see runs())."""
+    graph = pipeline._graph
+    current = signatures(pipeline)
+    previous = {}
+    for record in load_manifest(manifest):
+        previous[record['key']] = record
+    # {node: iterable directories of its runs that execute}
+    executes = {}
+    report = []
+    for node, key in runs(pipeline):
+        iteration = os.path.dirname(key)
+        record = previous.get(key)
+        reason = None
+        if record is None:
+            reason = 'never run'
+        elif record['parameters'] != current[node.name][1]:
+            reason = 'parameters changed'
+        else:
+            changed = [upstream.name for upstream, connect in _connections(graph, node)
+                       if [i for i in executes.get(upstream, [])
+                           if os.path.join(iteration, '').startswith(os.path.join(i, ''))]]
+            if changed:
+                reason = 'inputs from %s change' % ', '.join(changed)
+            elif record['signature'] != current[node.name][0]:
+                reason = 'connections changed'
+            elif not record.get('files'):
+                reason = 'no outputs to reuse'
+            elif not _reusable(record):
+                reason = 'outputs missing'
+        if reason is not None:
+            executes.setdefault(node, []).append(iteration)
+            report.append((key, reason))
+    return report
@@ -0,0 +1,44 @@
+"""
+   Modules which are only imported when they are first used.
+
+       spm = lazy_import('nipype.interfaces.spm')
+
+   spm behaves like the module, but importing it (and everything it
+   imports, e.g. the MATLAB and SPM machinery) is put off until one of
+   its attributes is looked up. Processes that only load a cached
+   graph or run a single branch do not pay for the interfaces they
+   never touch.
+"""
+import sys
+
+
+class LazyModule(object):
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def _load(self):
+        if self._name not in sys.modules:
+            __import__(self._name)
+        return sys.modules[self._name]
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        return "<lazy module %s>" % self._name
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def loaded(module):
+    """Whether module (a lazy module or a module name) was imported,
+    i.e. whether anything of it can have been used."""
+    if isinstance(module, LazyModule):
+        module = module.__dict__['_name']
+    return module in sys.modules
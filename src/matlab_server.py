@@ -0,0 +1,268 @@
+"""
+   Keeps MATLAB running between SPM nodes.
+
+   Every SPM interface starts its own ``matlab -nodesktop -nosplash``
+   and the start up alone takes tens of seconds. This module starts a
+   small server that owns a few long lived MATLAB sessions and a
+   client that looks like the MATLAB executable to nipype::
+
+       server = start_server('/tmp/matlab.sock', 'matlab -nodesktop -nosplash')
+       mlab.MatlabCommandLine.matlab_cmd = client_command('/tmp/matlab.sock')
+
+   The client forwards the ``-r`` command of a node (without the final
+   ``exit``) together with its working directory to a free session and
+   relays the output and the exit status back. The client adds the
+   seconds the request waited for a new session to start (0 when a
+   session was running) to STARTUP_FILE in the working directory (see
+   profiling.py).
+   The MATLAB command is only a setting, so any executable that reads
+   commands from stdin and prints what fprintf tells it to can stand in
+   for MATLAB.
+"""
+import os
+import re
+import sys
+import time
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+AUTHKEY = b'fmri_tumour'
+SENTINEL = 'FMRI_TUMOUR_SESSION_DONE'
+ADDRESS_VARIABLE = 'FMRI_MATLAB_SERVER'
+PID_VARIABLE = 'FMRI_MATLAB_SERVER_PID'
+STARTUP_FILE = '.matlab_startup'
+
+_exit_re = re.compile(r'[;,\s]*\b(exit|quit)\b\s*;?\s*$')
+
+
+def strip_exit(command):
+    """Removes the trailing exit/quit nipype appends to every script."""
+    return _exit_re.sub('', command.strip())
+
+
+class MatlabSession(object):
+    """A single MATLAB process reading commands from its stdin."""
+
+    def __init__(self, matlab_cmd):
+        self.matlab_cmd = matlab_cmd
+        self.started = time.time()
+        # seconds until the session answered for the first time
+        self.startup = None
+        self.process = subprocess.Popen(matlab_cmd, shell=True,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        universal_newlines=True)
+
+    def execute(self, cwd, command):
+        """Runs command in directory cwd, returns (status, output)."""
+        if self.startup is None:
+            self._send("fprintf(1, '\\n%s %%d\\n', 0);\n" % SENTINEL)
+            self._receive()
+            self.startup = time.time() - self.started
+        script = os.path.join(cwd, 'fmri_session_script.m')
+        f = open(script, 'w')
+        f.write(strip_exit(command) + '\n')
+        f.close()
+        self._send(
+            "cd('%s'); fmri_session_status = 0; "
+            "try, run('%s'); catch fmri_session_error, "
+            "fmri_session_status = 1; disp(fmri_session_error.message); end; "
+            "fprintf(1, '\\n%s %%d\\n', fmri_session_status);\n" %
+            (cwd, script, SENTINEL))
+        result = self._receive()
+        os.remove(script)
+        return result
+
+    def _send(self, line):
+        self.process.stdin.write(line)
+        self.process.stdin.flush()
+
+    def _receive(self):
+        """Reads the output up to the sentinel line, returns (status,
+        output)."""
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise IOError("MATLAB session (%s) exited unexpectedly:\n%s" %
+                              (self.matlab_cmd, ''.join(output)))
+            if line.startswith(SENTINEL):
+                status = int(line.split()[1])
+                break
+            output.append(line)
+        return status, ''.join(output)
+
+    def close(self):
+        try:
+            self.process.stdin.write('exit\n')
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+    def kill(self):
+        """Stops the process (if it still runs) and reaps it."""
+        if self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError:
+                # exited in the meantime
+                pass
+        for pipe in [self.process.stdin, self.process.stdout]:
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+        self.process.wait()
+
+
+class SessionPool(object):
+    """Hands out at most n_sessions MATLAB sessions, started on demand."""
+
+    def __init__(self, matlab_cmd, n_sessions=1):
+        self.matlab_cmd = matlab_cmd
+        self.idle = []
+        self.sessions = []
+        self.condition = threading.Condition()
+        self.n_sessions = n_sessions
+
+    def acquire(self):
+        """Returns an idle session, starts a new one while there are
+        fewer than n_sessions, or waits for one of the two."""
+        self.condition.acquire()
+        try:
+            while not self.idle and len(self.sessions) >= self.n_sessions:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            session = MatlabSession(self.matlab_cmd)
+            self.sessions.append(session)
+            return session
+        finally:
+            self.condition.release()
+
+    def release(self, session):
+        self.condition.acquire()
+        try:
+            self.idle.append(session)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def discard(self, session):
+        """Drops a session that died and reaps its process. A request
+        waiting for a session may then start a new one."""
+        session.kill()
+        self.condition.acquire()
+        try:
+            self.sessions.remove(session)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+
+def _handle(connection, pool):
+    try:
+        cwd, command = connection.recv()
+        session = pool.acquire()
+        new = session.startup is None
+        try:
+            status, output = session.execute(cwd, command)
+        except (IOError, OSError) as e:
+            # a session that died is dropped and replaced on demand
+            pool.discard(session)
+            status, output = 1, str(e)
+        else:
+            pool.release(session)
+        startup = 0.
+        if new and session.startup is not None:
+            startup = session.startup
+        connection.send((status, output, startup))
+    finally:
+        connection.close()
+
+
+def serve(address, matlab_cmd, n_sessions=1):
+    """Accepts client requests on address until a 'shutdown' request."""
+    pool = SessionPool(matlab_cmd, n_sessions)
+    listener = Listener(address, authkey=AUTHKEY)
+    try:
+        while True:
+            connection = listener.accept()
+            if connection.poll(None) and connection.recv() == 'shutdown':
+                connection.close()
+                break
+            thread = threading.Thread(target=_handle, args=(connection, pool))
+            thread.daemon = True
+            thread.start()
+    finally:
+        listener.close()
+        pool.close()
+
+
+def start_server(address, matlab_cmd, n_sessions=1):
+    """Starts serve() in a background process and returns the process."""
+    if os.path.exists(address):
+        os.remove(address)
+    server = multiprocessing.Process(target=serve,
+                                     args=(address, matlab_cmd, n_sessions))
+    server.daemon = True
+    server.start()
+    # its sessions are not part of the memory of a node (see profiling.py)
+    os.environ[PID_VARIABLE] = str(server.pid)
+    while not os.path.exists(address):
+        if not server.is_alive():
+            # e.g. the socket path is too long for AF_UNIX
+            raise RuntimeError("MATLAB server exited with code %s before listening on %s"
+                               % (server.exitcode, address))
+        time.sleep(0.1)
+    return server
+
+
+def stop_server(address, server):
+    connection = Client(address, authkey=AUTHKEY)
+    connection.send('shutdown')
+    connection.close()
+    server.join()
+
+
+def client_command(address):
+    """Returns a matlab_cmd which sends scripts to the server at address.
+    The address is part of the command, so that it also works in
+    processes which do not inherit the environment (e.g. queue workers
+    on this host, see cluster.py)."""
+    os.environ[ADDRESS_VARIABLE] = address
+    return '%s %s --server %s' % (sys.executable, os.path.abspath(__file__), address)
+
+
+def main(argv):
+    if '-r' not in argv:
+        sys.stderr.write('matlab_server: only -r "<command>" is supported\n')
+        return 1
+    command = argv[argv.index('-r') + 1]
+    if '--server' in argv:
+        address = argv[argv.index('--server') + 1]
+    else:
+        address = os.environ[ADDRESS_VARIABLE]
+    connection = Client(address, authkey=AUTHKEY)
+    # the first message tells the server that this is a real request
+    connection.send('run')
+    connection.send((os.getcwd(), command))
+    status, output, startup = connection.recv()
+    connection.close()
+    f = open(STARTUP_FILE, 'a')
+    f.write('%f\n' % startup)
+    f.close()
+    sys.stdout.write(output)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,118 @@
+"""
+   Runs the independent parts of the first level analysis side by
+   side. After the datasource every subject and every functional task
+   is a separate branch of the graph, so the analysis is split into
+   one job per (subject, task) pair and the jobs are handed to a pool
+   of worker processes. Each job builds and runs its own small
+   pipeline.
+
+   The number of MATLAB/SPM nodes running at the same time can be
+   limited separately from the pool size (matlab_slots), because those
+   nodes are the ones that use most memory and licenses.
+
+   The builder is passed in as a function so that pipelines made of
+   stub interfaces can be run through exactly the same code.
+"""
+import os
+import traceback
+import multiprocessing
+
+from lazy import lazy_import, loaded
+mlab = lazy_import('nipype.interfaces.matlab')        # how to run matlab
+sink = lazy_import('sink')                            # background result export
+
+_matlab_slots = None
+
+
+def _limited_run(run):
+    def wrapped(self, *args, **kwargs):
+        _matlab_slots.acquire()
+        try:
+            return run(self, *args, **kwargs)
+        finally:
+            _matlab_slots.release()
+    return wrapped
+
+
+def limit_matlab(matlab_slots):
+    """Makes every MATLAB based node of this process hold one of
+    matlab_slots (anything with acquire() and release()) while it
+    runs."""
+    global _matlab_slots
+    _matlab_slots = matlab_slots
+    mlab.MatlabCommandLine.run = _limited_run(mlab.MatlabCommandLine.run)
+
+
+def _init_worker(matlab_slots):
+    if matlab_slots is not None:
+        limit_matlab(matlab_slots)
+
+
+def _run_job(job):
+    build, subject_id, task_name, workdir, build_kwargs = job
+    try:
+        pipeline = build(subjects=[subject_id], selected_tasks=[task_name],
+                         workdir=os.path.join(workdir, task_name),
+                         **build_kwargs)
+        pipeline.run()
+        # results exported in the background (sink.AsyncDataSink)
+        if loaded(sink):
+            sink.wait()
+    except Exception:
+        return (subject_id, task_name, traceback.format_exc())
+    return (subject_id, task_name, None)
+
+
+def make_jobs(build, subjects, task_names, workdir, build_kwargs=None):
+    """Returns one job for every subject and task combination.
+
+    Tasks get separate working directories so that the nodes they have
+    in common (e.g. skull stripping) do not race on the same files.
+    They only run once per subject when build finds their results in a
+    cache (pipeline.py uses one by default when running in parallel).
+    """
+    if build_kwargs is None:
+        build_kwargs = {}
+    jobs = []
+    for subject_id in subjects:
+        for task_name in task_names:
+            jobs.append((build, subject_id, task_name, workdir, build_kwargs))
+    return jobs
+
+
+def run_parallel(build, subjects, task_names, workdir, n_procs=None,
+                 matlab_slots=None, build_kwargs=None):
+    """Runs every (subject, task) branch in a pool of n_procs processes.
+
+    build is called as build(subjects=[...], selected_tasks=[...],
+    workdir=..., **build_kwargs) and has to return a pipeline. n_procs
+    defaults to the number of CPUs. matlab_slots limits how many MATLAB
+    based nodes are allowed to run at once across all workers (None
+    means no limit).
+
+    Raises RuntimeError listing the failed branches after all jobs have
+    finished.
+    """
+    if n_procs is None:
+        n_procs = multiprocessing.cpu_count()
+    if matlab_slots is not None:
+        matlab_slots = multiprocessing.Semaphore(matlab_slots)
+    jobs = make_jobs(build, subjects, task_names, workdir, build_kwargs)
+    pool = multiprocessing.Pool(processes=min(n_procs, len(jobs)),
+                                initializer=_init_worker,
+                                initargs=(matlab_slots,))
+    try:
+        # a timeout on get() keeps the pool responsive to Ctrl-C
+        results = pool.map_async(_run_job, jobs, chunksize=1).get(999999)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+
+    failed = [r for r in results if r[2] is not None]
+    if failed:
+        messages = ["%s/%s:\n%s" % failed_job for failed_job in failed]
+        raise RuntimeError("%d of %d branches failed\n%s" %
+                           (len(failed), len(jobs), "\n".join(messages)))
+    return results
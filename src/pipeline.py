@@ -3,55 +3,57 @@
    perform a first and second level analysis on a two-subject data
    set. 
 """
-from locale import normalize
-from nipype.interfaces.fsl.base import NEW_FSLCommand
-from nipype.interfaces.freesurfer.base import NEW_FSCommand
 
 
 """
-1. Tell python where to find the appropriate functions.
+1. Tell python where to find the appropriate functions. The nipype
+   modules are only imported once they are used (see lazy.py), so
+   importing this file or loading a cached graph stays cheap.
 """
 
-import nipype.interfaces.io as nio           # Data i/o 
-import nipype.interfaces.spm as spm          # spm
-import nipype.interfaces.matlab as mlab      # how to run matlab
-import nipype.interfaces.fsl as fsl          # fsl
-import nipype.pipeline.node_wrapper as nw    # nodes for pypelines
-import nipype.pipeline.engine as pe          # pypeline engine
-import nipype.algorithms.rapidart as ra      # artifact detection
-import nipype.algorithms.modelgen as model   # model specification
-import nipype.algorithms.misc as misc
 import os                                    # system functions
-from nipype.interfaces.base import Bunch
-from copy import deepcopy
+from lazy import lazy_import
+nio = lazy_import('nipype.interfaces.io')             # Data i/o
+mlab = lazy_import('nipype.interfaces.matlab')        # how to run matlab
+nw = lazy_import('nipype.pipeline.node_wrapper')      # nodes for pypelines
+pe = lazy_import('nipype.pipeline.engine')            # pypeline engine
+atlas = lazy_import('atlas')                          # multi label ROI masks
+profiling = lazy_import('profiling')                  # per node resource records
+incremental = lazy_import('incremental')              # what would run again
+sink = lazy_import('sink')                            # background result export
 from functional import functional_nodes
+from structural import structural_nodes
+from taskspec import TaskRegistry
 
 #####################################################################
 # Preliminaries
 
-"""
-1b. Confirm package dependencies are installed.  (This is only for the
-tutorial, rarely would you put this in your own code.)
-"""
-from nipype.utils.misc import package_check
-
-package_check('numpy', '1.3', 'tutorial1')
-package_check('scipy', '0.7', 'tutorial1')
-package_check('networkx', '1.0', 'tutorial1')
-package_check('IPython', '0.10', 'tutorial1')
-
-NEW_FSLCommand.set_default_outputtype('NIFTI')
-NEW_FSCommand.set_default_subjectsdir('/home/filo/data/fs/')
-
-"""
-2. Setup any package specific configuration. The output file format
-   for FSL routines is being set to uncompressed NIFTI and a specific
-   version of matlab is being used. The uncompressed format is
-   required because SPM does not handle compressed NIFTI.
-"""
-
-# setup the way matlab should be called
-mlab.MatlabCommandLine.matlab_cmd = "matlab -nodesktop -nosplash"
+def check_dependencies():
+    """
+    1b. Confirm package dependencies are installed.  (This is only for the
+    tutorial, rarely would you put this in your own code.)
+    """
+    from nipype.utils.misc import package_check
+
+    package_check('numpy', '1.3', 'tutorial1')
+    package_check('scipy', '0.7', 'tutorial1')
+    package_check('networkx', '1.0', 'tutorial1')
+    package_check('IPython', '0.10', 'tutorial1')
+
+def configure():
+    """
+    2. Setup any package specific configuration. The output file format
+    for FSL routines is being set to uncompressed NIFTI and a specific
+    version of matlab is being used. The uncompressed format is
+    required because SPM does not handle compressed NIFTI.
+    """
+    from nipype.interfaces.fsl.base import NEW_FSLCommand
+    from nipype.interfaces.freesurfer.base import NEW_FSCommand
+    NEW_FSLCommand.set_default_outputtype('NIFTI')
+    NEW_FSCommand.set_default_subjectsdir('/home/filo/data/fs/')
+
+    # setup the way matlab should be called
+    mlab.MatlabCommandLine.matlab_cmd = "matlab -nodesktop -nosplash"
 
 """
 3. The following lines of code sets up the necessary information
@@ -71,18 +73,17 @@ subject_list = ['pilot1']
 # The following info structure helps the DataSource module organize
 # nifti files into fields/attributes of a data object. With DataSource
 # this object is of type Bunch.
-info = dict(finger_tapping_func = ['5_finger_tapping'],
-            finger_foot_lips_func = ['6_finger_foot_lips'],
-            silent_verb_generation = ['3_silent_verb_generation'],
-            line_bisection = ['2_line_bisection'],
-            struct = ['fs/mri/orig'],
+# The functional runs are added from the task file (see 4c).
+info = dict(struct = ['fs/mri/orig'],
             segmentation = ['fs/mri/aparc+aseg'])
 
 ######################################################################
 # Setup preprocessing pipeline nodes
 
 """
-4. Setup various nodes for preprocessing the data. 
+4. Setup various nodes for preprocessing the data. The nodes are
+   created by build_pipeline() below so that a pipeline can be built
+   for any subset of subjects and tasks.
 """
 
 """
@@ -95,11 +96,6 @@ info = dict(finger_tapping_func = ['5_finger_tapping'],
    object and provides additional housekeeping and pipeline specific
    functionality. 
 """
-datasource = nw.NodeWrapper(interface=nio.SubjectSource(), diskbased=False)
-datasource.inputs.base_directory = data_dir
-datasource.inputs.file_layout = '%s.nii'
-datasource.inputs.subject_info = info
-
 
 """
    b. Setting up iteration over all subjects. The following line is a
@@ -110,137 +106,200 @@ datasource.inputs.subject_info = info
    entire first level preprocessing and estimation will be repeated
    for each subject contained in subject_list.
 """
-datasource.iterables = ('subject_id', subject_list)
-
-skullstrip = nw.NodeWrapper(interface=fsl.Bet(), diskbased=True)
-skullstrip.inputs.mask = True
 
 #segment = nw.NodeWrapper(interface=spm.Segment(), diskbased=True)
 #segment.inputs.gm_output_type = [1, 1, 1]
 #segment.inputs.wm_output_type = [1, 1, 1]
 #segment.inputs.csf_output_type = [1, 1, 1]
 
-fingertappingSkip = 4
-FFLSkip = 4
-SVGSkip = 4
-line_bisection_skip = 4
-
-fingertappingTotal = 177
-FFLTotal = 184
-SVGTotal = 173
-line_bisection_total = 179
-
-def subjectinfoFFL(subject_id):
-    output = []
-    names = ['Finger', 'Foot', 'Lips']
-    onsets = [range(4 - FFLSkip, FFLTotal - FFLSkip, 6 * 6),
-              range(4 + 12 - FFLSkip, FFLTotal - FFLSkip, 6 * 6),
-              range(4 + 24 - FFLSkip, FFLTotal - FFLSkip, 6 * 6)]
-    output.insert(0,
-                      Bunch(conditions=names,
-                            onsets=deepcopy(onsets),
-                            durations=[[6], [6], [6]],
-                            amplitudes=None,
-                            tmod=None,
-                            pmod=None,
-                            regressor_names=None,
-                            regressors=None))
-    return output
-
-def subjectinfoFingertapping(subject_id):
-    output = []
-    names = ['Task']
-    onsets = [range(10 - fingertappingSkip, fingertappingTotal - fingertappingSkip, 2 * 12)]
-    output.insert(0,
-                      Bunch(conditions=names,
-                            onsets=deepcopy(onsets),
-                            durations=[[12]],
-                            amplitudes=None,
-                            tmod=None,
-                            pmod=None,
-                            regressor_names=None,
-                            regressors=None))
-    return output
-
-def subjectinfoSVG(subject_id):
-    output = []
-    names = ['Task']
-    onsets = [range(4 - SVGSkip, SVGTotal - SVGSkip, 2 * 12)]#[range(4 - SVGSkip, SVGTotal - SVGSkip, 2 * 12)]
-    output.insert(0,
-                      Bunch(conditions=names,
-                            onsets=deepcopy(onsets),
-                            durations=[[12]],
-                            amplitudes=None,
-                            tmod=None,
-                            pmod=None,
-                            regressor_names=None,
-                            regressors=None))
-    return output
-
-def subjectinfoLineBisection(subject_id):
-    output = []
-    names = ['Task']
-    onsets = [range(10 - line_bisection_skip, line_bisection_total - line_bisection_skip, 2 * 12)]#[range(4 - SVGSkip, SVGTotal - SVGSkip, 2 * 12)]
-    output.insert(0,
-                      Bunch(conditions=names,
-                            onsets=deepcopy(onsets),
-                            durations=[[12]],
-                            amplitudes=None,
-                            tmod=None,
-                            pmod=None,
-                            regressor_names=None,
-                            regressors=None))
-    return output
-
-
-cont1 = ['Task>Rest', 'T', ['Task'], [1]]
-contrasts_single_task = [cont1]
-
-contFFL1 = ['Finger-Rest', 'T', ['Finger', 'Foot','Lips'], [2, -1, -1]]
-contFFL2 = ['Lips-Rest', 'T', ['Finger', 'Foot','Lips'], [-1, 2, -1]]
-contFFL3 = ['Foot-Rest', 'T', ['Finger', 'Foot','Lips'], [-1, -1, 2]]
-contFFL4 = ['Finger>Rest', 'T', ['Finger'], [1]]
-contFFL5 = ['Lips>Rest', 'T', ['Foot'], [1]]
-contFFL6 = ['Foot>Rest', 'T', ['Lips'], [1]]
-contrastsFFL = [contFFL1, contFFL2, contFFL3, contFFL4, contFFL5, contFFL6]
-
-
-l1pipeline = pe.Pipeline()
-l1pipeline.config['workdir'] = os.path.abspath('../workingdir')
-l1pipeline.config['use_parameterized_dirs'] = True
-
-l1pipeline.connect([(datasource, skullstrip, [('struct', 'infile')]),
-                  ])
-
-masks = {}
-                                             
-masks['fingerTapping'] = [nw.NodeWrapper(misc.PickAtlas(labels=1024,
-                                             dilation_size=0), 
-                                             diskbased=True, 
-                                             name= "left_precentral_gyrus_mask"),
-                          nw.NodeWrapper(misc.PickAtlas(labels=2024,
-                                             dilation_size=0),
-                                             diskbased=True,
-                                             name= "right_precentral_gyrus_mask")]
-masks['silentVerb'] = [nw.NodeWrapper(misc.PickAtlas(labels=[1018,1020],
-                                             dilation_size=0), 
-                                             diskbased=True, 
-                                             name= "left_parsopercularis_and_pars_triangularis_mask"),
-                          nw.NodeWrapper(misc.PickAtlas(labels=[2018,2020],
-                                             dilation_size=0),
-                                             diskbased=True,
-                                             name= "right_parsopercularis_and_pars_triangularis_mask")]
-maskInterfaces = {}
-for k,v in masks.iteritems():
-    maskInterfaces[k] = []
-    for mask in v:
-        l1pipeline.connect([(datasource, mask, [('segmentation', 'atlas')])])
-        maskInterfaces[k].append({"object":mask, "outputFile":'mask_file'})
+"""
+4c. The functional tasks, their contrasts and the regions of interest
+    (FreeSurfer aparc+aseg labels) are declared in tasks.json. Every
+    task becomes a branch of the graph with the arguments it needs for
+    functional_nodes. The tasks are independent of each other once the
+    datasource has run, which is what allows them to be executed in
+    parallel (see parallel.py).
+"""
+registry = TaskRegistry(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tasks.json'))
+tasks = registry.tasks
+task_names = registry.names
+masks = registry.masks
+info.update(registry.runs)
+
+workdir = os.path.abspath('../workingdir')
+
+def build_pipeline(subjects=subject_list, selected_tasks=task_names, workdir=workdir,
+                   estimator='spm', streaming=False, cache=None, profile=None,
+                   manifest=None, retention=None, seed_registration=False,
+                   native=(), qa_settings=None, task_file=None,
+                   data_directory=data_dir, output_directory=None,
+                   async_sink=False):
+    """Creates the first level pipeline for the given subjects and tasks.
+
+    estimator is 'spm' or 'numpy' and streaming replaces the FSL volume
+    skipping and splitting by frame references (see functional_nodes).
+    native lists the steps ('skip', 'split', 'smooth') computed in
+    process by volumes.py instead of by FSL and SPM. With qa_settings
+    (inputs of qa.MotionQA) every run is checked for outliers and runs
+    failing the check are not estimated.
+    With a cache (cache.ResultCache) the structural nodes shared by all
+    tasks are looked up by content before they are run. With profile
+    every node appends a record of its resource use to that file (see
+    profiling.py) and with manifest every node records what it was run
+    with and is skipped when it comes up again with the same inputs,
+    which is also what --dry_run compares against (see incremental.py).
+    With a retention (retention.Retention) the directory of every node
+    is removed once all its consumers have run. With seed_registration
+    the first selected task is coregistered to the structural and the
+    other tasks to its coregistered mean, for consistency between the
+    tasks rather than speed (see functional_nodes).
+    task_file, data_directory and output_directory replace tasks.json,
+    ../data and ../output (e.g. for synthetic data, see
+    pipeline_benchmark.py). With async_sink the results are exported by
+    background writers (see sink.py; call sink.wait() after running).
+    """
+    if task_file is None:
+        task_registry = registry
+        subject_info = info
+    else:
+        task_registry = TaskRegistry(task_file)
+        subject_info = dict(struct=info['struct'], segmentation=info['segmentation'])
+        subject_info.update(task_registry.runs)
+    tasks = task_registry.tasks
+    masks = task_registry.masks
+    if output_directory is None:
+        output_directory = os.path.abspath('../output')
+
+    if cache is None:
+        cached = lambda interface: interface
+    else:
+        cached = cache.wrap
+
+    datasource = nw.NodeWrapper(interface=nio.SubjectSource(), diskbased=False)
+    datasource.inputs.base_directory = data_directory
+    datasource.inputs.file_layout = '%s.nii'
+    datasource.inputs.subject_info = subject_info
+    datasource.iterables = ('subject_id', subjects)
+
+    l1pipeline = pe.Pipeline()
+    l1pipeline.config['workdir'] = workdir
+    l1pipeline.config['use_parameterized_dirs'] = True
+
+    structural = structural_nodes(l1pipeline, datasource, cached)
+    skullstrip = structural['brain'][0]
+
+    # all ROI masks come from a single read of the segmentation; the
+    # masks of tasks that are not selected are made as well, so that the
+    # node is the same whichever tasks are run (see incremental.py)
+    maskSets = []
+    for name in selected_tasks:
+        if tasks[name]['masks'] not in maskSets:
+            maskSets.append(tasks[name]['masks'])
+    rois = []
+    for k in sorted(masks):
+        rois.extend(masks[k])
+    roimasks = nw.NodeWrapper(interface=cached(atlas.MultiPickAtlas(label_sets=[roi[1] for roi in rois],
+                                                                   names=[roi[0] for roi in rois],
+                                                                   dilation_size=0)),
+                              diskbased=True,
+                              name="roi_masks")
+    l1pipeline.connect([(datasource, roimasks, [('segmentation', 'atlas')])])
+
+    maskInterfaces = {}
+    for k in maskSets:
+        maskInterfaces[k] = []
+        for roi in masks[k]:
+            maskInterfaces[k].append({"object":roimasks,
+                                      "outputFile":'mask_file%d' % rois.index(roi),
+                                      "name":roi[0]})
           
-    maskInterfaces[k].append({"object":skullstrip, "outputFile":'outfile'})
+        maskInterfaces[k].append({"object":skullstrip, "outputFile":structural['brain'][1]})
+
+    if async_sink:
+        datasink = nw.NodeWrapper(interface=sink.AsyncDataSink(), diskbased=False)
+    else:
+        datasink = nw.NodeWrapper(interface=nio.DataSink(),diskbased=False)
+    datasink.inputs.subject_directory = output_directory
+    l1pipeline.connect([(datasource,datasink,[('subject_id','subject_id')])])
+
+    seed = None
+    for name in selected_tasks:
+        task = tasks[name]
+        registered = functional_nodes(pipeline=l1pipeline,
+                         prefix=name,
+                         skip_vols=task['skip_vols'],
+                         total_vols=task['total_vols'],
+                         datasource=datasource,
+                         funcRunName=task['funcRunName'],
+                         subjectinfo=task['subjectinfo'],
+                         maskInterfaces=maskInterfaces[task['masks']],
+                         contrasts=task['contrasts'], datasink=datasink,
+                         estimator=estimator, streaming=streaming,
+                         structural=structural, seed=seed, native=native,
+                         qa_settings=qa_settings
+                         )
+        if seed_registration and seed is None:
+            seed = registered
+    # a node skipped by the manifest still counts as run for retention
+    if manifest:
+        incremental.track(l1pipeline, manifest)
+    if retention is not None:
+        retention.apply(l1pipeline)
+    if profile:
+        profiling.instrument(l1pipeline, profile)
+    return l1pipeline
+
+# every module build_pipeline imports (directly or through the nodes it
+# wraps) and the task file
+_graph_sources = ['pipeline.py', 'functional.py', 'structural.py', 'taskspec.py',
+                  'lazy.py', 'atlas.py', 'glm.py', 'volumes.py', 'qa.py',
+                  'cache.py', 'retention.py', 'profiling.py', 'matlab_server.py',
+                  'incremental.py', 'sink.py', 'tasks.json']
+
+def load_pipeline(subjects=subject_list, selected_tasks=task_names, workdir=workdir,
+                  **build_kwargs):
+    """Like build_pipeline, but the pipeline is pickled into workdir and
+    loaded from there as long as the arguments and the files defining
+    the graph (_graph_sources and the task_file argument) do not change.
+    """
+    import hashlib
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    sha = hashlib.sha1()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    sources = [os.path.join(directory, fname) for fname in _graph_sources]
+    if build_kwargs.get('task_file'):
+        sources.append(build_kwargs['task_file'])
+    for fname in sources:
+        f = open(fname, 'rb')
+        sha.update(f.read())
+        f.close()
+    sha.update(repr((list(subjects), list(selected_tasks), workdir,
+                     sorted(build_kwargs.items()))).encode('utf-8'))
+    graph_file = os.path.join(workdir, 'graphs', sha.hexdigest() + '.pklz')
+
+    if os.path.exists(graph_file):
+        f = open(graph_file, 'rb')
+        l1pipeline = pickle.load(f)
+        f.close()
+        return l1pipeline
+
+    l1pipeline = build_pipeline(subjects, selected_tasks, workdir, **build_kwargs)
+    if not os.path.exists(os.path.dirname(graph_file)):
+        os.makedirs(os.path.dirname(graph_file))
+    # written under a temporary name so that parallel workers never
+    # load a half written graph
+    tmp = graph_file + '.%d' % os.getpid()
+    f = open(tmp, 'wb')
+    pickle.dump(l1pipeline, f, 2)
+    f.close()
+    os.rename(tmp, graph_file)
+    return l1pipeline
 
-import nifti as ni
 def getVoxDims(volume):
+    import nifti as ni
     nii = ni.NiftiImage(volume)
     voxdims = nii.getVoxDims()
     return [voxdims[0], voxdims[1], voxdims[2]]
@@ -262,54 +321,7 @@ def getVoxDims(volume):
 #
 #for v in [os.path.abspath('../masks/ctx_lh_precentral.nii'), os.path.abspath('../masks/ctx_rh_precentral.nii')]:
 #	coregisteredReslicedMasksInt['fingerTapping'].append({"name":None, "outputFile":v})
-    
-datasink = nw.NodeWrapper(interface=nio.DataSink(),diskbased=False)
-datasink.inputs.subject_directory = os.path.abspath('../output')
-l1pipeline.connect([(datasource,datasink,[('subject_id','subject_id')])])
-
-functional_nodes(pipeline=l1pipeline,
-                 prefix="finger_tapping",
-                 skip_vols=fingertappingSkip,
-                 total_vols=fingertappingTotal,
-                 datasource=datasource,
-                 funcRunName='finger_tapping_func',
-                 subjectinfo=subjectinfoFingertapping,
-                 maskInterfaces=maskInterfaces['fingerTapping'],
-                 contrasts=contrasts_single_task, datasink=datasink
-                 )
-
-functional_nodes(pipeline=l1pipeline,
-                 prefix='finger_foot_lips',
-                 skip_vols=FFLSkip,
-                 total_vols=FFLTotal,
-                 datasource=datasource,
-                 funcRunName='finger_foot_lips_func',
-                 subjectinfo=subjectinfoFFL,
-                 maskInterfaces=maskInterfaces['fingerTapping'],
-                 contrasts=contrastsFFL, datasink=datasink
-                 )
-
-functional_nodes(pipeline=l1pipeline,
-                 prefix='silent_verb',
-                 skip_vols=SVGSkip,
-                 total_vols=SVGTotal,
-                 datasource=datasource,
-                 funcRunName='silent_verb_generation',
-                 subjectinfo=subjectinfoSVG,
-                 maskInterfaces=maskInterfaces['silentVerb'],
-                 contrasts=contrasts_single_task, datasink=datasink
-                 )
-
-functional_nodes(pipeline=l1pipeline,
-                 prefix='line_bisection',
-                 skip_vols=line_bisection_skip,
-                 total_vols=line_bisection_total,
-                 datasource=datasource,
-                 funcRunName='line_bisection',
-                 subjectinfo=subjectinfoLineBisection,
-                 maskInterfaces=maskInterfaces['fingerTapping'],
-                 contrasts=contrasts_single_task, datasink=datasink
-                 )
+
 #
 #######################################################################
 ## Setup storage of results
@@ -351,9 +363,174 @@ functional_nodes(pipeline=l1pipeline,
    processes, but does not generate any output. To actually run the
    analysis on the data the ``nipype.pipeline.engine.Pipeline.Run``
    function needs to be called. 
+
+   With --n_procs larger than one every subject/task branch is run as
+   a separate job in a pool of worker processes (see parallel.py).
 """
 if __name__ == '__main__':
-    l1pipeline.export_graph(show=True, use_execgraph=True)
-    l1pipeline.run()
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("-n", "--n_procs", type="int", default=1,
+                      help="number of branches to run in parallel")
+    parser.add_option("-m", "--matlab_slots", type="int", default=None,
+                      help="maximum number of MATLAB nodes running at once")
+    parser.add_option("-s", "--matlab_sessions", type="int", default=0,
+                      help="keep this many MATLAB sessions running and "
+                           "send all SPM scripts to them")
+    parser.add_option("-e", "--estimator", choices=['spm', 'numpy'], default='spm',
+                      help="first level estimation backend (spm or numpy)")
+    parser.add_option("--streaming", action="store_true", default=False,
+                      help="pass the kept volumes on as frame references "
+                           "into the run instead of copying and splitting "
+                           "them with FSL")
+    parser.add_option("--native", default="",
+                      help="comma separated steps (skip, split, smooth) to "
+                           "compute in process instead of with FSL and SPM")
+    parser.add_option("--qa", action="store_true", default=False,
+                      help="add motion and global signal outliers as "
+                           "regressors and do not estimate runs failing QA")
+    parser.add_option("--fd_threshold", type="float", default=0.9,
+                      help="framewise displacement (mm) of an outlier")
+    parser.add_option("--z_threshold", type="float", default=3.,
+                      help="global signal z score of an outlier")
+    parser.add_option("--max_outliers", type="float", default=0.2,
+                      help="fraction of outliers failing a run")
+    parser.add_option("--seed_registration", action="store_true", default=False,
+                      help="coregister the first task to the structural and "
+                           "the others to its coregistered mean, so that the "
+                           "tasks line up with each other (when the tasks "
+                           "run in one graph; not faster)")
+    parser.add_option("--async_sink", action="store_true", default=False,
+                      help="export the results with background writers, "
+                           "cloning (reflink) where the file system can and "
+                           "skipping unchanged files")
+    parser.add_option("-c", "--cache", default=None,
+                      help="directory of a result cache shared between runs "
+                           "(with --n_procs or --queue by default "
+                           "workingdir/cache, so that the structural nodes "
+                           "run once per subject and not once per task)")
+    parser.add_option("--cache_size", type="float", default=10,
+                      help="size limit of the cache in GB")
+    parser.add_option("-p", "--profile", default=None,
+                      help="write per node timing and resource records "
+                           "to this JSON lines file")
+    parser.add_option("-r", "--remove_intermediates", action="store_true", default=False,
+                      help="remove the directory of a node once all nodes "
+                           "using its outputs have run")
+    parser.add_option("--scratch_budget", type="float", default=None,
+                      help="hold nodes back while the working directories "
+                           "of all processes take up more GB than this "
+                           "(implies --remove_intermediates)")
+    parser.add_option("-q", "--queue", default=None,
+                      help="submit the branches to the job queue in this "
+                           "shared directory (see cluster.py)")
+    parser.add_option("--local_workers", type="int", default=0,
+                      help="work through the queue with this many local "
+                           "worker processes")
+    parser.add_option("--track", action="store_true", default=False,
+                      help="record what every node ran with in the manifest "
+                           "and skip the nodes whose inputs did not change")
+    parser.add_option("--manifest", default=os.path.join(workdir, 'manifest.json'),
+                      help="manifest of --track and --dry_run")
+    parser.add_option("--dry_run", action="store_true", default=False,
+                      help="list the nodes that would run and why, "
+                           "without running anything")
+    options, args = parser.parse_args()
+    for step in options.native.split(','):
+        if step and step not in ('skip', 'split', 'smooth'):
+            parser.error("unknown native step %r" % step)
+    if options.queue and options.matlab_sessions and not options.local_workers:
+        # the sessions listen on a unix socket of this machine, workers
+        # on other hosts could not reach them
+        parser.error("--matlab_sessions with --queue needs --local_workers")
+    if options.cache is None and (options.n_procs > 1 or options.queue):
+        # every branch has a working directory of its own (see
+        # parallel.make_jobs), the cache is what they share
+        options.cache = os.path.join(workdir, 'cache')
+    check_dependencies()
+    configure()
+    build_kwargs = dict(estimator=options.estimator,
+                        streaming=options.streaming,
+                        seed_registration=options.seed_registration,
+                        async_sink=options.async_sink,
+                        native=tuple([step for step in options.native.split(',') if step]))
+    if options.track:
+        build_kwargs['manifest'] = os.path.abspath(options.manifest)
+    if options.qa:
+        build_kwargs['qa_settings'] = dict(fd_threshold=options.fd_threshold,
+                                           z_threshold=options.z_threshold,
+                                           max_outlier_fraction=options.max_outliers)
+    if options.profile:
+        build_kwargs['profile'] = os.path.abspath(options.profile)
+    if options.cache:
+        from cache import ResultCache
+        build_kwargs['cache'] = ResultCache(options.cache,
+                                            int(options.cache_size * 2 ** 30))
+
+    if options.remove_intermediates or options.scratch_budget:
+        from retention import Retention
+        max_bytes = None
+        if options.scratch_budget:
+            max_bytes = int(options.scratch_budget * 2 ** 30)
+        build_kwargs['retention'] = Retention(os.path.join(workdir, 'scratch'), max_bytes)
+
+    l1pipeline = load_pipeline(**build_kwargs)
+    if options.dry_run:
+        report = incremental.dry_run(l1pipeline, os.path.abspath(options.manifest))
+        for name, reason in report:
+            print("%-60s %s" % (name, reason))
+        print("%d of %d node runs would execute"
+              % (len(report), len(incremental.runs(l1pipeline))))
+        raise SystemExit(0)
+
+    if options.matlab_sessions:
+        import matlab_server
+        address = os.path.join(workdir, 'matlab_server.sock')
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+        server = matlab_server.start_server(address,
+                                            mlab.MatlabCommandLine.matlab_cmd,
+                                            options.matlab_sessions)
+        mlab.MatlabCommandLine.matlab_cmd = matlab_server.client_command(address)
+
+    if options.queue:
+        import cluster
+        queue = cluster.JobQueue(options.queue)
+        resources = {}
+        if options.matlab_slots:
+            resources['matlab'] = options.matlab_slots
+        # configure() sets the plain MATLAB command; the jobs keep the
+        # one of this process (e.g. the matlab_server client)
+        queue.submit('pipeline:load_pipeline', subject_list, task_names, workdir,
+                     build_kwargs=build_kwargs, setup='pipeline:configure',
+                     resources=resources,
+                     matlab_cmd=mlab.MatlabCommandLine.matlab_cmd)
+        if options.local_workers:
+            failed = cluster.run_local(options.queue, options.local_workers)
+        else:
+            failed = queue.wait()
+        for name, errors in failed.items():
+            print("%s failed:\n%s" % (name, errors[-1]))
+    elif options.n_procs > 1:
+        from parallel import run_parallel
+        run_parallel(load_pipeline, subject_list, task_names, workdir,
+                     n_procs=options.n_procs,
+                     matlab_slots=options.matlab_slots,
+                     build_kwargs=build_kwargs)
+    else:
+        l1pipeline.export_graph(show=True, use_execgraph=True)
+        l1pipeline.run()
+        sink.wait()
+
+    if options.matlab_sessions:
+        matlab_server.stop_server(address, server)
+    if options.profile:
+        profiling.write_csv(options.profile,
+                            os.path.splitext(options.profile)[0] + '.csv')
+        print(profiling.summary(l1pipeline, options.profile))
+    if options.cache:
+        print("cache hits: %d, misses: %d" % build_kwargs['cache'].report())
+    if 'retention' in build_kwargs:
+        print(build_kwargs['retention'].report())
 #    l2pipeline.run()
 
@@ -0,0 +1,387 @@
+"""
+   Runs the first level graph on synthetic data and reports where the
+   time, the memory and the I/O go.
+
+       python pipeline_benchmark.py --subjects 2 --tasks 4 --masks 2 --volumes 60 --stub_tools
+
+   Every subject gets a structural, an aparc+aseg like segmentation
+   holding the atlas labels of the mask sets in tasks.json and one
+   4D run per task. Structural and runs share one grid, as the
+   coregistered volumes do. The graph is the one build_pipeline()
+   makes, restricted to the first --tasks tasks, the first --masks
+   masks of every mask set and --volumes volumes per run. With
+   --stub_tools the FSL, SPM and FreeSurfer nodes are replaced by
+   stubs (see stubs.py), so the benchmark runs without the tools and
+   MATLAB and measures the graph construction, the scheduling, the
+   in process nodes and the I/O.
+
+   Printed are the time to build the graph, the time to run it, the
+   wall time, volumes per second and I/O of every stage (a node of
+   functional_nodes over all tasks and subjects) and the peak memory.
+   --output keeps the node records (profile.csv) and the memory of
+   the process tree over time (memory.csv) of every run in a
+   directory of its own, named by the time and the commit.
+
+   Every run is appended to --history (a JSON lines file) with the
+   time, the git commit, the options that shape the workload and the
+   wall time of every stage. The stages are compared with the last
+   run of the same configuration; a stage taking more than
+   --regression (a fraction) longer is flagged, and the benchmark
+   then exits with status 1::
+
+       stage                                     before       now  change
+       Smooth                                      4.10      5.32  +29.8% REGRESSION
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+import numpy as np
+
+import pipeline
+import profiling
+import stubs
+import volumes
+
+# stages faster than this (in seconds, before and after) are too noisy
+# to be flagged
+MIN_SECONDS = 0.1
+
+
+def write_tasks(fname, n_tasks=None, n_masks=None, n_volumes=None):
+    """Writes a copy of tasks.json with the first n_tasks tasks, the
+    first n_masks masks of every mask set and n_volumes volumes (after
+    the skipped ones) per run."""
+    f = open(os.path.join(os.path.dirname(os.path.abspath(pipeline.__file__)), 'tasks.json'))
+    spec = json.load(f)
+    f.close()
+    if n_tasks is not None:
+        spec['tasks'] = spec['tasks'][:n_tasks]
+    if n_masks is not None:
+        for name in spec['masks']:
+            spec['masks'][name] = spec['masks'][name][:n_masks]
+    if n_volumes is not None:
+        for task in spec['tasks']:
+            task['total'] = task['skip'] + n_volumes
+    f = open(fname, 'w')
+    json.dump(spec, f, indent=4)
+    f.close()
+
+
+def nifti_header(shape, voxel_size, datatype=16, bitpix=32):
+    """A single file NIfTI-1 header (with the 4 extension bytes) for a
+    volume of shape (x, y, z[, t]) with the given voxel size in mm."""
+    header = bytearray(352)
+
+    def put(offset, dtype, values):
+        values = np.asarray(values, dtype=dtype)
+        header[offset:offset + values.nbytes] = bytearray(values.data)
+    put(0, '<i4', 348)
+    dims = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    put(40, '<i2', dims)
+    put(70, '<i2', [datatype, bitpix])
+    put(76, '<f4', [1.] + list(voxel_size) + [2.5, 1., 1., 1.])
+    put(108, '<f4', [352., 1., 0.])
+    put(252, '<i2', [0, 1])
+    put(280, '<f4', [voxel_size[0], 0, 0, -voxel_size[0] * shape[0] / 2.,
+                     0, voxel_size[1], 0, -voxel_size[1] * shape[1] / 2.,
+                     0, 0, voxel_size[2], -voxel_size[2] * shape[2] / 2.])
+    header[344:348] = b'n+1\0'
+    return header
+
+
+def write_volume(fname, data, voxel_size, datatype=16, bitpix=32):
+    """Writes data given as (x, y, z[, t])."""
+    out = volumes.create(fname, nifti_header(data.shape, voxel_size, datatype, bitpix),
+                         data.shape)
+    out[:] = data.T.reshape(out.shape)
+    out.flush()
+    del out
+
+
+def _labels(registry):
+    labels = []
+    for masks in registry.masks.values():
+        for name, label_set in masks:
+            if not isinstance(label_set, list):
+                label_set = [label_set]
+            labels.extend([l for l in label_set if l not in labels])
+    return sorted(labels)
+
+
+def make_subject(directory, registry, shape=(64, 64, 30), voxel_size=(3., 3., 4.), seed=0):
+    """Writes the structural, segmentation and runs of one subject
+    into directory, named as the datasource of pipeline.py expects."""
+    rng = np.random.RandomState(seed)
+    mri = os.path.join(directory, 'fs', 'mri')
+    if not os.path.exists(mri):
+        os.makedirs(mri)
+
+    x, y, z = np.mgrid[:shape[0], :shape[1], :shape[2]]
+    centre = np.array(shape) / 2.
+    brain = (((x - centre[0]) / (.4 * shape[0])) ** 2 +
+             ((y - centre[1]) / (.45 * shape[1])) ** 2 +
+             ((z - centre[2]) / (.4 * shape[2])) ** 2) < 1
+    struct = (brain * 400 + rng.rand(*shape) * 40).astype(np.int16)
+    write_volume(os.path.join(mri, 'orig.nii'), struct, voxel_size, 4, 16)
+
+    # every label gets a slab of the brain
+    labels = _labels(registry)
+    segmentation = np.zeros(shape, dtype=np.int16)
+    slab = np.linspace(0, shape[0], len(labels) + 1).astype(int)
+    for i, label in enumerate(labels):
+        part = brain.copy()
+        part[:slab[i]] = False
+        part[slab[i + 1]:] = False
+        segmentation[part] = label
+    write_volume(os.path.join(mri, 'aparc+aseg.nii'), segmentation, voxel_size, 4, 16)
+
+    for name in registry.names:
+        task = registry.tasks[name]
+        # total counts the skipped volumes too
+        n_volumes = task['total_vols']
+        run = (brain[..., np.newaxis] * 1000 +
+               rng.randn(shape[0], shape[1], shape[2], n_volumes) * 20).astype(np.int16)
+        fname = registry.runs[task['funcRunName']][0] + '.nii'
+        write_volume(os.path.join(directory, fname), run, voxel_size, 4, 16)
+
+
+def build(subjects, selected_tasks, workdir, stub_seconds=None, **build_kwargs):
+    """build_pipeline, with the tools replaced by stubs unless
+    stub_seconds is None."""
+    l1pipeline = pipeline.build_pipeline(subjects, selected_tasks, workdir, **build_kwargs)
+    if stub_seconds is not None:
+        stubs.stub_tools(l1pipeline, stub_seconds)
+    return l1pipeline
+
+
+def stage(node, task_names):
+    for name in task_names:
+        if node.startswith(name + '_'):
+            return node[len(name) + 1:]
+    return node
+
+
+def stage_totals(records, task_names):
+    """{stage: [runs, wall time, bytes read, bytes written, peak rss]}"""
+    stages = {}
+    for record in records:
+        totals = stages.setdefault(stage(record['node'], task_names), [0, 0., 0, 0, 0])
+        totals[0] += 1
+        totals[1] += record['wall_time']
+        totals[2] += record['bytes_read']
+        totals[3] += record['bytes_written']
+        totals[4] = max(totals[4], record['peak_rss'])
+    return stages
+
+
+def stage_table(records, task_names, n_volumes):
+    stages = stage_totals(records, task_names)
+    lines = ['%-40s %5s %9s %9s %9s %9s %9s' % ('stage', 'runs', 'wall [s]', 'vol/s',
+                                              'read MB', 'write MB', 'rss MB')]
+    for name, totals in sorted(stages.items(), key=lambda s: -s[1][1]):
+        runs, wall, read, written, rss = totals
+        lines.append('%-40s %5d %9.2f %9.1f %9.1f %9.1f %9.1f'
+                     % (name, runs, wall, runs * n_volumes / max(wall, 1e-6),
+                        read / 2. ** 20, written / 2. ** 20, rss / 2. ** 20))
+    return '\n'.join(lines)
+
+
+def git_commit():
+    """The commit checked out where this file is, or None."""
+    devnull = open(os.devnull, 'w')
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    finally:
+        devnull.close()
+    return commit.decode('ascii').strip()
+
+
+def previous_run(history, configuration):
+    """The last record of history (a JSON lines file) with the same
+    configuration, or None."""
+    if not os.path.exists(history):
+        return None
+    previous = None
+    f = open(history)
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # a run interrupted while writing
+            continue
+        if record.get('configuration') == configuration:
+            previous = record
+    f.close()
+    return previous
+
+
+def append_run(history, record):
+    f = open(history, 'a')
+    f.write(json.dumps(record, sort_keys=True) + '\n')
+    f.close()
+
+
+def _seconds(value):
+    if value is None:
+        return '-'
+    return '%.2f' % value
+
+
+def compare(previous, record, threshold):
+    """Returns (table, regressions): the wall time of every stage of
+    previous and record, and the stages that took more than threshold
+    (a fraction) longer."""
+    lines = ['%-40s %9s %9s %7s' % ('stage', 'before', 'now', 'change')]
+    regressions = []
+    stages = [('total', previous['wall'], record['wall'])]
+    for name in sorted(set(previous['stages']) | set(record['stages'])):
+        stages.append((name, previous['stages'].get(name), record['stages'].get(name)))
+    for name, before, now in stages:
+        if before is None or now is None:
+            # a stage added or removed since
+            lines.append('%-40s %9s %9s' % (name, _seconds(before), _seconds(now)))
+            continue
+        change = (now - before) / max(before, 1e-6)
+        line = '%-40s %9.2f %9.2f %+6.1f%%' % (name, before, now, change * 100)
+        if change > threshold and max(before, now) >= MIN_SECONDS:
+            line += ' REGRESSION'
+            regressions.append(name)
+        lines.append(line)
+    return '\n'.join(lines), regressions
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--subjects", type="int", default=1)
+    parser.add_option("--tasks", type="int", default=None,
+                      help="number of tasks of tasks.json (default all)")
+    parser.add_option("--masks", type="int", default=None,
+                      help="masks per mask set (default all)")
+    parser.add_option("--volumes", type="int", default=60,
+                      help="volumes per run after the skipped ones")
+    parser.add_option("--shape", default="64,64,30")
+    parser.add_option("-n", "--n_procs", type="int", default=1)
+    parser.add_option("-e", "--estimator", choices=['spm', 'numpy'], default='numpy')
+    parser.add_option("--native", default="",
+                      help="comma separated steps computed in process")
+    parser.add_option("--streaming", action="store_true", default=False)
+    parser.add_option("--stub_tools", action="store_true", default=False,
+                      help="replace FSL, SPM and FreeSurfer by stubs")
+    parser.add_option("--stub_seconds", type="float", default=0.,
+                      help="time every stub takes")
+    parser.add_option("--interval", type="float", default=0.1,
+                      help="memory sampling interval in seconds")
+    parser.add_option("-o", "--output", default=None,
+                      help="keep profile.csv and memory.csv of every run "
+                           "in a directory of its own in this directory")
+    parser.add_option("--history", default="benchmark_history.jsonl",
+                      help="JSON lines file every run is appended to and "
+                           "compared with")
+    parser.add_option("--regression", type="float", default=0.2,
+                      help="flag stages taking more than this fraction "
+                           "longer than in the previous run")
+    options, args = parser.parse_args()
+    configuration = dict(subjects=options.subjects, tasks=options.tasks,
+                         masks=options.masks, volumes=options.volumes,
+                         shape=options.shape, n_procs=options.n_procs,
+                         estimator=options.estimator, native=options.native,
+                         streaming=options.streaming, stub_tools=options.stub_tools,
+                         stub_seconds=options.stub_seconds)
+    commit = git_commit()
+    regressions = []
+
+    directory = tempfile.mkdtemp()
+    try:
+        task_file = os.path.join(directory, 'tasks.json')
+        write_tasks(task_file, options.tasks, options.masks, options.volumes)
+        registry = pipeline.TaskRegistry(task_file)
+        subjects = ['synthetic%02d' % i for i in range(options.subjects)]
+        data_directory = os.path.join(directory, 'data')
+        start = time.time()
+        for i, subject in enumerate(subjects):
+            make_subject(os.path.join(data_directory, subject), registry,
+                         shape=tuple([int(s) for s in options.shape.split(',')]), seed=i)
+        print("synthetic data        %8.2f s" % (time.time() - start))
+
+        workdir = os.path.join(directory, 'workingdir')
+        profile = os.path.join(directory, 'profile.json')
+        build_kwargs = dict(estimator=options.estimator,
+                            streaming=options.streaming,
+                            native=tuple([step for step in options.native.split(',') if step]),
+                            task_file=task_file,
+                            data_directory=data_directory,
+                            output_directory=os.path.join(directory, 'output'),
+                            profile=profile)
+        if options.stub_tools:
+            build_kwargs['stub_seconds'] = options.stub_seconds
+
+        start = time.time()
+        l1pipeline = build(subjects, registry.names, workdir, **build_kwargs)
+        build_time = time.time() - start
+        print("build graph           %8.2f s (%d nodes)"
+              % (build_time, len(l1pipeline._graph.nodes())))
+
+        sampler = profiling.MemorySampler(options.interval, keep=True)
+        sampler.start()
+        start = time.time()
+        try:
+            if options.n_procs > 1:
+                from parallel import run_parallel
+                run_parallel(build, subjects, registry.names, workdir,
+                             n_procs=options.n_procs, build_kwargs=build_kwargs)
+            else:
+                l1pipeline.run()
+        finally:
+            wall = time.time() - start
+            sampler.stop()
+
+        records = profiling.load(profile)
+        busy = sum([r['wall_time'] for r in records])
+        print("run graph             %8.2f s (%.2f s in nodes, %.2f s elsewhere)"
+              % (wall, busy, max(wall * options.n_procs - busy, 0.)))
+        print("peak memory           %8.1f MB" % (sampler.peak / 2. ** 20))
+        print('')
+        print(stage_table(records, registry.names, options.volumes))
+
+        record = dict(time=start, commit=commit, configuration=configuration,
+                      build=build_time, wall=wall, peak_rss=sampler.peak,
+                      stages=dict([(name, totals[1]) for name, totals in
+                                   stage_totals(records, registry.names).items()]))
+        previous = previous_run(options.history, configuration)
+        if previous is not None:
+            table, regressions = compare(previous, record, options.regression)
+            print('')
+            print("against %s of %s" % (previous.get('commit') or 'unknown commit',
+                                       time.strftime('%Y-%m-%d %H:%M',
+                                                     time.localtime(previous['time']))))
+            print(table)
+        append_run(options.history, record)
+
+        if options.output:
+            output = os.path.join(options.output, '%s-%s' % (
+                time.strftime('%Y%m%d-%H%M%S', time.localtime(start)),
+                (commit or 'unknown')[:8]))
+            os.makedirs(output)
+            profiling.write_csv(profile, os.path.join(output, 'profile.csv'))
+            f = open(os.path.join(output, 'memory.csv'), 'w')
+            f.write('seconds,rss_mb\n')
+            for t, rss in sampler.samples:
+                f.write('%.3f,%.1f\n' % (t - start, rss / 2. ** 20))
+            f.close()
+    finally:
+        shutil.rmtree(directory)
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
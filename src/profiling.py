@@ -0,0 +1,294 @@
+"""
+   Per node timing and resource records for a pipeline run.
+
+   instrument() wraps the interface of every node of a pipeline in a
+   ProfiledInterface which appends one JSON record per executed node
+   to a profile file::
+
+       instrument(l1pipeline, 'profile.json')
+       l1pipeline.run()
+       write_csv('profile.json', 'profile.csv')
+       print(summary(l1pipeline, 'profile.json'))
+
+   A record holds the wall time, the CPU time of the node and of the
+   programs it started, the peak resident memory of the process tree
+   (sampled, without the sessions of a matlab_server), the bytes read
+   (size of the input files, each counted once) and written (growth of the node directory)
+   and, for MATLAB based nodes run through matlab_server, the time the
+   node waited for a MATLAB session to start (0 when it found one
+   running). Nothing is started to measure it, so it is None for the
+   other nodes and for MATLAB started by the node itself (n/a in
+   summary()).
+   Records are appended line by line, so parallel workers can share
+   one profile file.
+"""
+import os
+import time
+import json
+import resource
+import threading
+
+from cache import InterfaceWrapper
+from matlab_server import PID_VARIABLE, STARTUP_FILE
+
+
+def _page_size():
+    return os.sysconf('SC_PAGE_SIZE')
+
+
+def _process_tree(pid, exclude=()):
+    """pid and all its descendants (Linux /proc), without the processes
+    in exclude and their descendants."""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            f = open('/proc/%s/stat' % name)
+            stat = f.read()
+            f.close()
+        except IOError:
+            continue
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    tree = [pid]
+    i = 0
+    while i < len(tree):
+        tree.extend([child for child in children.get(tree[i], [])
+                     if child not in exclude])
+        i += 1
+    return tree
+
+
+def _rss(pids):
+    total = 0
+    for pid in pids:
+        try:
+            f = open('/proc/%d/statm' % pid)
+            total += int(f.read().split()[1]) * _page_size()
+            f.close()
+        except (IOError, IndexError):
+            pass
+    return total
+
+
+def _server_pids():
+    """The matlab_server process (if one was started), whose sessions
+    serve all nodes."""
+    if os.environ.get(PID_VARIABLE):
+        return [int(os.environ[PID_VARIABLE])]
+    return []
+
+
+class MemorySampler(threading.Thread):
+    """Samples the resident memory of this process and its children,
+    except for the processes in exclude and their children. With keep
+    the (time, bytes) samples are kept in samples."""
+
+    def __init__(self, interval=0.2, keep=False, exclude=()):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.keep = keep
+        self.exclude = exclude
+        self.peak = 0
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.isSet():
+            rss = _rss(_process_tree(os.getpid(), self.exclude))
+            self.peak = max(self.peak, rss)
+            if self.keep:
+                self.samples.append((time.time(), rss))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def _files(value):
+    if isinstance(value, (list, tuple)):
+        files = []
+        for v in value:
+            files.extend(_files(v))
+        return files
+    if isinstance(value, str) and os.path.isfile(value.split(',')[0]):
+        return [value.split(',')[0]]
+    return []
+
+
+def _directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fname))
+            except OSError:
+                pass
+    return total
+
+
+def _innermost(interface):
+    while isinstance(interface, InterfaceWrapper):
+        interface = interface.interface
+    return interface
+
+
+def matlab_startup(cwd):
+    """Seconds the node run in cwd waited for MATLAB sessions to start,
+    as reported by the matlab_server client (0 when a running session
+    was free), or None when no request went through a server."""
+    fname = os.path.join(cwd, STARTUP_FILE)
+    if not os.path.exists(fname):
+        return None
+    f = open(fname)
+    seconds = sum([float(line) for line in f if line.strip()])
+    f.close()
+    os.remove(fname)
+    return seconds
+
+
+class ProfiledInterface(InterfaceWrapper):
+    '''
+    Runs interface and appends a record of its resource use to
+    profile_file.
+    '''
+    def __init__(self, interface, name, profile_file):
+        InterfaceWrapper.__init__(self, interface)
+        self.name = name
+        self.profile_file = profile_file
+
+    def run(self, cwd=None):
+        if cwd is None:
+            cwd = os.getcwd()
+        # every file once, however many of its frames are inputs
+        inputs = set([os.path.abspath(f) for f in
+                      _files(list(self.interface.inputs.__dict__.values()))])
+        bytes_read = sum([os.path.getsize(f) for f in inputs])
+        size_before = _directory_size(cwd)
+        self_before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        sampler = MemorySampler(exclude=_server_pids())
+        sampler.start()
+        start = time.time()
+        try:
+            result = self.interface.run(cwd=cwd)
+        finally:
+            wall = time.time() - start
+            peak = sampler.stop()
+        startup = matlab_startup(cwd)
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = 0.
+        for before, after in [(self_before, self_after),
+                              (children_before, children_after)]:
+            cpu += (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+        record = dict(node=self.name,
+                      interface=_innermost(self.interface).__class__.__name__,
+                      directory=cwd,
+                      start=start,
+                      wall_time=wall,
+                      cpu_time=cpu,
+                      peak_rss=peak,
+                      bytes_read=bytes_read,
+                      bytes_written=max(_directory_size(cwd) - size_before, 0),
+                      matlab_startup=startup,
+                      returncode=result.runtime.returncode)
+        f = open(self.profile_file, 'a')
+        f.write(json.dumps(record) + '\n')
+        f.close()
+        return result
+
+
+def instrument(pipeline, profile_file):
+    """Wraps the interface of every node of pipeline in a
+    ProfiledInterface writing to profile_file."""
+    profile_file = os.path.abspath(profile_file)
+    for node in pipeline._graph.nodes():
+        if not isinstance(node.interface, ProfiledInterface):
+            node.interface = ProfiledInterface(node.interface, node.name, profile_file)
+    return pipeline
+
+
+def load(profile_file):
+    f = open(profile_file)
+    records = [json.loads(line) for line in f if line.strip()]
+    f.close()
+    return records
+
+
+_columns = ['node', 'interface', 'directory', 'start', 'wall_time', 'cpu_time',
+            'peak_rss', 'bytes_read', 'bytes_written', 'matlab_startup', 'returncode']
+
+
+def write_csv(profile_file, csv_file):
+    import csv
+    f = open(csv_file, 'w')
+    writer = csv.writer(f)
+    writer.writerow(_columns)
+    for record in load(profile_file):
+        writer.writerow([record[c] for c in _columns])
+    f.close()
+
+
+def critical_path(pipeline, records):
+    """Returns (total wall time, [node names]) of the longest chain of
+    nodes in the graph, weighting every node with its longest recorded
+    wall time (i.e. the slowest subject)."""
+    import networkx as nx
+    graph = getattr(pipeline, '_execgraph', None)
+    if graph is None:
+        graph = pipeline._graph
+    wall = {}
+    for record in records:
+        wall[record['node']] = max(wall.get(record['node'], 0), record['wall_time'])
+
+    finish = {}
+    previous = {}
+    for node in nx.topological_sort(graph):
+        best = None
+        for parent in graph.predecessors(node):
+            if best is None or finish[parent] > finish[best]:
+                best = parent
+        previous[node] = best
+        finish[node] = wall.get(node.name, 0)
+        if best is not None:
+            finish[node] += finish[best]
+    if not finish:
+        return 0., []
+    node = max(finish, key=lambda n: finish[n])
+    total = finish[node]
+    path = []
+    while node is not None:
+        path.insert(0, node.name)
+        node = previous[node]
+    return total, path
+
+
+def summary(pipeline, profile_file):
+    """Text summary: time per interface and the critical path."""
+    records = load(profile_file)
+    per_interface = {}
+    for record in records:
+        totals = per_interface.setdefault(record['interface'], [0, 0., 0., None])
+        totals[0] += 1
+        totals[1] += record['wall_time']
+        totals[2] += record['cpu_time']
+        if record['matlab_startup'] is not None:
+            totals[3] = (totals[3] or 0.) + record['matlab_startup']
+    lines = ['%-28s %5s %10s %10s %10s' % ('interface', 'runs', 'wall [s]',
+                                          'cpu [s]', 'matlab [s]')]
+    for name, totals in sorted(per_interface.items(), key=lambda i: -i[1][1]):
+        startup = 'n/a'
+        if totals[3] is not None:
+            startup = '%.1f' % totals[3]
+        lines.append('%-28s %5d %10.1f %10.1f %10s' % tuple([name] + totals[:3] + [startup]))
+    total, path = critical_path(pipeline, records)
+    lines.append('')
+    lines.append('critical path (%.1f s):' % total)
+    lines.extend(['    ' + name for name in path])
+    return '\n'.join(lines)
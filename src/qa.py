@@ -0,0 +1,209 @@
+"""
+   Motion and intensity quality control of a realigned run.
+
+   MotionQA computes, for all volumes at once, the framewise
+   displacement from the realignment parameters (Power et al. 2012:
+   summed absolute change of the translations plus the rotations as
+   displacement on a 50 mm sphere) and the global signal of the
+   realigned volumes. Volumes moving more than fd_threshold mm or
+   whose detrended global signal is more than z_threshold standard
+   deviations off are outliers. They are written to outlier_files in
+   the format of nipype.algorithms.rapidart (0 based volume indices,
+   one per line), so SpecifyModel adds a regressor for each of them.
+
+   A run with more than max_outlier_fraction outliers fails. Nodes
+   wrapped in a GatedInterface and connected to the qa_file of
+   MotionQA do not run for a failed run, so bad data does not cost
+   any MATLAB time.
+"""
+import os
+import json
+from copy import deepcopy
+
+import numpy as np
+from nipype.interfaces.base import Interface, InterfaceResult, Bunch
+
+from cache import InterfaceWrapper
+import volumes
+
+
+def framewise_displacement(parameters, radius=50.):
+    """Framewise displacement in mm of SPM realignment parameters
+    (n_volumes x 6: translations in mm, rotations in radians). The
+    first volume has a displacement of 0."""
+    parameters = np.asarray(parameters, dtype=np.float64)
+    change = np.abs(np.diff(parameters, axis=0))
+    change[:, 3:] *= radius
+    return np.concatenate([[0.], change.sum(axis=1)])
+
+
+def _volume_list(files):
+    if not isinstance(files, list):
+        files = [files]
+    return files
+
+
+def global_signal(files):
+    """Mean intensity of every volume inside the voxels brighter than
+    an eighth of the mean image (as spm_global). files are 4D files,
+    volumes or 'file,N' frame references."""
+    frames = {}
+    order = []
+    for fname in _volume_list(files):
+        frame = None
+        if ',' in fname:
+            fname, frame = fname.rsplit(',', 1)
+            frame = int(frame) - 1
+        if fname not in frames:
+            frames[fname] = []
+            order.append(fname)
+        frames[fname].append(frame)
+
+    blocks = []
+    for fname in order:
+        data = volumes.memmap(fname)
+        selected = [f for f in frames[fname] if f is not None]
+        if selected:
+            data = data[selected]
+        blocks.append(np.asarray(data, dtype=np.float32).reshape(data.shape[0], -1))
+    data = np.concatenate(blocks)
+    mean = data.mean(axis=0)
+    inside = mean > mean.mean() / 8.
+    return data[:, inside].mean(axis=1)
+
+
+def intensity_z(signal):
+    """z scores of signal after removing a linear trend."""
+    signal = np.asarray(signal, dtype=np.float64)
+    x = np.arange(len(signal))
+    residual = signal - np.polyval(np.polyfit(x, signal, 1), x)
+    std = residual.std()
+    if std == 0:
+        return np.zeros(len(signal))
+    return residual / std
+
+
+def read_parameters(parameter_files):
+    return np.concatenate([np.atleast_2d(np.loadtxt(f))
+                           for f in _volume_list(parameter_files)])
+
+
+def passed(qa_file):
+    """Whether the run described by the qa_file of MotionQA passed."""
+    f = open(qa_file)
+    statistics = json.load(f)
+    f.close()
+    return statistics['passed']
+
+
+class MotionQA(Interface):
+    '''
+    Finds motion and global intensity outliers of a realigned run and
+    decides whether the run is good enough to be estimated.
+    '''
+    def __init__(self, *args, **inputs):
+        self._populate_inputs()
+        self.inputs.update(**inputs)
+
+    def inputs_help(self):
+        """
+        Parameters
+        --------------------
+        realignment_parameters : file
+            SPM realignment parameters (rp_*.txt) of the run
+        realigned_files : files
+            realigned run (4D file, volumes or frame references)
+        fd_threshold : float
+            framewise displacement (mm) above which a volume is an
+            outlier (default 0.9)
+        z_threshold : float
+            global signal z score above which a volume is an outlier
+            (default 3)
+        max_outlier_fraction : float
+            fraction of outliers above which the run fails (default
+            0.2)
+        radius : float
+            radius (mm) converting rotations to displacement (default
+            50)
+        """
+        print(self.inputs_help.__doc__)
+
+    def _populate_inputs(self):
+        self.inputs = Bunch(realignment_parameters=None,
+                            realigned_files=None,
+                            fd_threshold=0.9,
+                            z_threshold=3.,
+                            max_outlier_fraction=0.2,
+                            radius=50.)
+
+    def outputs_help(self):
+        """
+        Parameters
+        --------------------
+        outlier_files : file
+            0 based indices of the outlier volumes (rapidart format)
+        qa_file : file
+            JSON with the framewise displacement, global signal z
+            scores, outliers and whether the run passed
+        """
+        print(self.outputs_help.__doc__)
+
+    def outputs(self):
+        outputs = Bunch(outlier_files=None,
+                        qa_file=None)
+        return outputs
+
+    def aggregate_outputs(self):
+        outputs = self.outputs()
+        outputs.outlier_files = os.path.abspath('outliers.txt')
+        outputs.qa_file = os.path.abspath('qa.json')
+        return outputs
+
+    def run(self, cwd=None):
+        fd = framewise_displacement(read_parameters(self.inputs.realignment_parameters),
+                                    self.inputs.radius)
+        z = intensity_z(global_signal(self.inputs.realigned_files))
+        if len(fd) != len(z):
+            raise ValueError("%d realignment parameters for %d volumes" % (len(fd), len(z)))
+        outliers = np.flatnonzero((fd > self.inputs.fd_threshold) |
+                                  (np.abs(z) > self.inputs.z_threshold))
+        fraction = len(outliers) / float(len(fd))
+
+        outputs = self.aggregate_outputs()
+        np.savetxt(outputs.outlier_files, outliers, fmt='%d')
+        f = open(outputs.qa_file, 'w')
+        json.dump(dict(framewise_displacement=fd.tolist(),
+                       intensity_z=z.tolist(),
+                       outliers=outliers.tolist(),
+                       outlier_fraction=fraction,
+                       mean_framewise_displacement=float(fd.mean()),
+                       passed=bool(fraction <= self.inputs.max_outlier_fraction)), f)
+        f.close()
+
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        return InterfaceResult(deepcopy(self), runtime, outputs=outputs)
+
+
+class GatedInterface(InterfaceWrapper):
+    '''
+    Runs interface only if the run described by its qa_file input
+    (connected from MotionQA) passed. Otherwise the node succeeds
+    without running and all its outputs are None.
+    '''
+    def __init__(self, interface):
+        InterfaceWrapper.__init__(self, interface)
+        self.interface.inputs.qa_file = None
+
+    def run(self, cwd=None):
+        inputs = self.interface.inputs.__dict__
+        qa_file = inputs.pop('qa_file', None)
+        try:
+            if qa_file is not None and not passed(qa_file):
+                runtime = Bunch(returncode=0,
+                                messages='not run: the run failed QA (%s)' % qa_file,
+                                errmessages=None)
+                return InterfaceResult(deepcopy(self.interface), runtime,
+                                       outputs=self.interface.outputs())
+            return self.interface.run(cwd=cwd)
+        finally:
+            inputs['qa_file'] = qa_file
@@ -0,0 +1,337 @@
+"""
+   Keeps the working directory small while the pipeline runs.
+
+   Every node of the pipeline is disk based, so the skipped runs, the
+   realigned, split, coregistered and smoothed volumes of every task
+   and subject stay in the working directory long after they were
+   used. Retention removes the directory of a node as soon as every
+   node consuming its files has run; what the datasink collects has
+   been copied to the output directory by then (the writers of an
+   AsyncDataSink are waited for, see sink.drain())::
+
+       retention = Retention('../workingdir/scratch', max_bytes=50 * 2 ** 30)
+       retention.apply(l1pipeline)
+       l1pipeline.run()
+       print(retention.report())
+
+   Files named inside other files count as well: the scans listed in
+   the session_info of SpecifyModel and in the SPM.mat written from it
+   keep the smoothed runs until EstimateModel and EstimateContrast (or
+   glm.EstimateGLM) have run.
+
+   Directories are only ever removed inside the working directory of
+   the pipeline, and the directories of nodes nothing consumes are
+   kept. A node whose outputs were removed runs again when the
+   pipeline is run a second time (a ResultCache still finds it).
+
+   With max_bytes a node waits before it runs while the node
+   directories alive in all processes sharing the retention directory
+   add up to more than max_bytes. The process holding the most space
+   is always let through, so that the waiting cannot deadlock: it
+   frees its intermediates as it goes. Every process rewrites its
+   record at least every lease / 10 seconds; a record older than lease
+   (of a process that died, on any host) holds nothing any more.
+"""
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+
+from cache import InterfaceWrapper
+from lazy import lazy_import, loaded
+sink = lazy_import('sink')                            # background result export
+glm = lazy_import('glm')                              # reads session_info files
+
+# outputs naming files that the nodes receiving them read as well
+REFERENCES = ('session_info', 'spm_mat_file')
+
+# {retention directory: _Ledger} of this process; kept outside the
+# wrappers since the engine copies the nodes of every iteration
+_ledgers = {}
+# {retention directory: pid of the process whose thread keeps its
+# record fresh}
+_heartbeats = {}
+_publishing = threading.Lock()
+
+
+def _files(value):
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        files = []
+        for v in value:
+            files.extend(_files(v))
+        return files
+    # frames of a 4D file are given as 'file,N'
+    if isinstance(value, str) and os.path.isfile(value.split(',')[0]):
+        return [os.path.abspath(value.split(',')[0])]
+    return []
+
+
+def _session_files(values):
+    """Files of the session_info in values (a dict of inputs or
+    outputs), which is either the list of sessions or a file of it."""
+    session_info = values.get('session_info')
+    if isinstance(session_info, str) and os.path.isfile(session_info):
+        session_info = glm.load_session_info(session_info)
+    return _files(session_info)
+
+
+def _source(connection):
+    # a connection may pass the output through a function first
+    if isinstance(connection[0], tuple):
+        return connection[0][0]
+    return connection[0]
+
+
+def _directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fname))
+            except OSError:
+                pass
+    return total
+
+
+def _inside(path, directory):
+    return path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class _Ledger(object):
+    """The node directories of this process which are still alive and
+    the nodes that still have to consume their files."""
+
+    def __init__(self):
+        self.pending = {}
+        self.sizes = {}
+        # {SPM.mat: the files it names}
+        self.references = {}
+        self.peak = 0
+        self.freed = 0
+
+    def owner(self, fname):
+        best = None
+        for directory in self.pending:
+            if _inside(fname, directory) and (best is None or len(directory) > len(best)):
+                best = directory
+        return best
+
+    def produced(self, cwd, files, consumers):
+        self.pending.setdefault(cwd, set()).update(consumers)
+        self.sizes[cwd] = _directory_size(cwd)
+        # outputs written next to the inputs keep the upstream
+        # directory alive as well
+        self.keep(files, consumers)
+
+    def keep(self, files, consumers):
+        """Keeps the directories of files until consumers have run."""
+        for fname in files:
+            owner = self.owner(fname)
+            if owner is not None:
+                self.pending[owner].update(consumers)
+
+    def consumed(self, name, files):
+        """Returns the directories nothing is waiting for any more.
+        Directories of nodes without consumers never are."""
+        done = []
+        for owner in set([self.owner(fname) for fname in files]):
+            if owner is None or name not in self.pending[owner]:
+                continue
+            self.pending[owner].discard(name)
+            if not self.pending[owner]:
+                done.append(owner)
+        return done
+
+    def remove(self, directory):
+        shutil.rmtree(directory, ignore_errors=True)
+        del self.pending[directory]
+        self.freed += self.sizes.pop(directory, 0)
+
+    def live(self):
+        return sum(self.sizes.values())
+
+
+class Retention(object):
+    """Removes intermediate node directories and bounds the space the
+    working directory takes up."""
+
+    def __init__(self, directory, max_bytes=None, poll=5., lease=600.):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.poll = poll
+        self.lease = lease
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def __repr__(self):
+        return 'Retention(%r, max_bytes=%r)' % (self.directory, self.max_bytes)
+
+    def ledger(self):
+        return _ledgers.setdefault(self.directory, _Ledger())
+
+    def _process(self):
+        return '%s-%d' % (socket.gethostname(), os.getpid())
+
+    def publish(self):
+        """Writes the space held by this process for the others to see."""
+        ledger = self.ledger()
+        ledger.peak = max(ledger.peak, self.usage())
+        tmp = os.path.join(self.directory, '.' + self._process())
+        _publishing.acquire()
+        try:
+            f = open(tmp, 'w')
+            f.write(json.dumps(dict(live=ledger.live(), peak=ledger.peak,
+                                    freed=ledger.freed, time=time.time())))
+            f.close()
+            os.rename(tmp, os.path.join(self.directory, self._process()))
+            if _heartbeats.get(self.directory) != os.getpid():
+                # keeps the record fresh while a long node runs
+                _heartbeats[self.directory] = os.getpid()
+                thread = threading.Thread(target=self._beat)
+                thread.daemon = True
+                thread.start()
+        finally:
+            _publishing.release()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.lease / 10.)
+            self.publish()
+
+    def _records(self):
+        records = {}
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            host, pid = name.rsplit('-', 1)
+            if host == socket.gethostname() and not _alive(int(pid)):
+                # a finished process holds nothing any more
+                live = 0
+            else:
+                live = None
+            try:
+                f = open(os.path.join(self.directory, name))
+                record = json.loads(f.read())
+                f.close()
+            except (IOError, ValueError):
+                continue
+            if time.time() - record.get('time', 0) > self.lease:
+                # not rewritten for a lease: the process died
+                live = 0
+            if live is not None:
+                record['live'] = live
+            records[name] = record
+        return records
+
+    def usage(self):
+        """Bytes held by the node directories of all processes."""
+        records = self._records()
+        records[self._process()] = dict(live=self.ledger().live())
+        return sum([r['live'] for r in records.values()])
+
+    def wait(self):
+        """Blocks while the working directory is over max_bytes, unless
+        this process holds the most space."""
+        if self.max_bytes is None:
+            return
+        while True:
+            records = self._records()
+            own = self.ledger().live()
+            others = [r['live'] for name, r in records.items() if name != self._process()]
+            if own + sum(others) <= self.max_bytes or own >= max(others + [0]):
+                return
+            time.sleep(self.poll)
+
+    def apply(self, pipeline):
+        """Wraps every node of pipeline in a RetainedInterface."""
+        workdir = os.path.abspath(pipeline.config['workdir'])
+        graph = pipeline._graph
+        for node in graph.nodes():
+            if isinstance(node.interface, RetainedInterface):
+                continue
+            consumers = sorted([n.name for n in graph.successors(node)])
+            carriers = []
+            for successor in graph.successors(node):
+                connect = graph.get_edge_data(node, successor).get('connect', [])
+                if [c for c in connect if _source(c) in REFERENCES]:
+                    carriers.append(successor.name)
+            node.interface = RetainedInterface(node.interface, node.name,
+                                               consumers, workdir, self,
+                                               sorted(carriers))
+        return pipeline
+
+    def report(self):
+        """Peak space held at once and bytes removed, over all
+        processes."""
+        records = self._records().values()
+        peak = max([r['peak'] for r in records] + [0])
+        freed = sum([r['freed'] for r in records])
+        return ('peak working directory use %.1f MB, %.1f MB of intermediates removed'
+                % (peak / 2. ** 20, freed / 2. ** 20))
+
+
+class RetainedInterface(InterfaceWrapper):
+    '''
+    Runs interface, records the directory it ran in and removes the
+    directories of upstream nodes once it was their last consumer.
+
+    The files named in a session_info or SPM.mat input are carried on
+    to carriers, the consumers receiving the session_info or SPM.mat
+    outputs of the node.
+    '''
+    def __init__(self, interface, name, consumers, workdir, retention, carriers=()):
+        InterfaceWrapper.__init__(self, interface)
+        self.name = name
+        self.consumers = consumers
+        self.workdir = workdir
+        self.retention = retention
+        self.carriers = carriers
+
+    def run(self, cwd=None):
+        if cwd is None:
+            cwd = os.getcwd()
+        cwd = os.path.abspath(cwd)
+        ledger = self.retention.ledger()
+        values = self.interface.inputs.__dict__
+        inputs = _files(list(values.values()))
+        carried = _session_files(values)
+        for fname in inputs:
+            carried.extend(ledger.references.get(fname, []))
+        inputs.extend(carried)
+        self.retention.wait()
+        result = self.interface.run(cwd=cwd)
+        if result.runtime.returncode != 0:
+            return result
+        if _inside(cwd, self.workdir):
+            outputs = []
+            references = []
+            if result.outputs is not None:
+                values = result.outputs.__dict__
+                outputs = _files(list(values.values())) + _session_files(values)
+                references = _files([values.get(name) for name in REFERENCES])
+                for fname in _files(values.get('spm_mat_file')):
+                    ledger.references[fname] = carried
+            ledger.produced(cwd, outputs, self.consumers)
+            if references:
+                # a node skipped by qa.GatedInterface passes nothing on
+                ledger.keep(carried, self.carriers)
+            self.retention.publish()
+        for directory in ledger.consumed(self.name, inputs):
+            if loaded(sink):
+                # an AsyncDataSink may still be copying from it
+                sink.drain(directory)
+            ledger.remove(directory)
+        self.retention.publish()
+        return result
@@ -0,0 +1,267 @@
+"""
+   A DataSink which exports the results in the background.
+
+   nio.DataSink copies its inputs when it runs, so a branch waits for
+   the output directory (often on network storage) before the next
+   node starts. AsyncDataSink takes the same inputs (subject_directory,
+   subject_id and 'directory[.[@]subdir]' fields) but only queues the
+   files for a pool of writer threads and returns::
+
+       datasink = nw.NodeWrapper(interface=AsyncDataSink(), diskbased=False)
+       ...
+       l1pipeline.run()
+       wait()          # before the process exits
+
+   A writer skips a file whose destination has the same size and
+   content digest, and otherwise tries, in this order, a reflink
+   (copy on write clone), a hard link (only with link=True) and a copy,
+   always through a temporary name so that the destination is never
+   seen half written. Hard links are off by default: a rerun rewrites
+   the working directory files in place, which would change the linked
+   results as well. Files smaller than batch_bytes of one node are
+   written as one batch by a single writer. wait() blocks until
+   everything queued is written and raises RuntimeError if any file
+   could not be; drain(directory) only until the files queued from
+   directory are (see retention.py, which removes node directories).
+"""
+import os
+import shutil
+import threading
+from copy import deepcopy
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from nipype.interfaces.base import Interface, InterfaceResult, Bunch
+
+from cache import file_digest
+
+_FICLONE = 0x40049409
+_writers = []
+_queue = Queue()
+_errors = []
+_lock = threading.Lock()
+# {source file: times queued and not yet written}
+_pending = {}
+_written = threading.Condition(_lock)
+
+
+def reflink(source, target):
+    """Makes target a copy on write clone of source (IOError or OSError
+    where the file system cannot clone)."""
+    import fcntl
+    src = open(source, 'rb')
+    try:
+        dst = open(target, 'wb')
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+
+def same_content(source, target):
+    if not os.path.isfile(target):
+        return False
+    if os.path.getsize(source) != os.path.getsize(target):
+        return False
+    return file_digest(source) == file_digest(target)
+
+
+def export(source, target, link=False):
+    """Writes source to target unless target already holds the same
+    content. Returns 'unchanged', 'reflink', 'link' or 'copy'."""
+    if same_content(source, target):
+        return 'unchanged'
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # made by another writer in the meantime
+            pass
+    tmp = os.path.join(directory, '.%s.%d.%d' % (os.path.basename(target), os.getpid(),
+                                                threading.current_thread().ident))
+    how = None
+    try:
+        reflink(source, tmp)
+        how = 'reflink'
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    if how is None and link:
+        try:
+            os.link(source, tmp)
+            how = 'link'
+        except OSError:
+            pass
+    if how is None:
+        shutil.copyfile(source, tmp)
+        how = 'copy'
+    os.rename(tmp, target)
+    return how
+
+
+def _write():
+    while True:
+        batch, link = _queue.get()
+        try:
+            for source, target in batch:
+                try:
+                    export(source, target, link)
+                except (IOError, OSError) as e:
+                    _lock.acquire()
+                    _errors.append('%s -> %s: %s' % (source, target, e))
+                    _lock.release()
+                finally:
+                    _written.acquire()
+                    _pending[source] -= 1
+                    if not _pending[source]:
+                        del _pending[source]
+                    _written.notify_all()
+                    _written.release()
+        finally:
+            _queue.task_done()
+
+
+def start(n_threads):
+    """Starts writer threads until there are n_threads of them."""
+    _lock.acquire()
+    try:
+        while len(_writers) < n_threads:
+            writer = threading.Thread(target=_write)
+            writer.daemon = True
+            writer.start()
+            _writers.append(writer)
+    finally:
+        _lock.release()
+
+
+def submit(files, link=False, batch_bytes=2 ** 20):
+    """Queues [(source, target)]. Files under batch_bytes go as one
+    batch, the others one by one."""
+    batches = []
+    small = []
+    for source, target in files:
+        if os.path.getsize(source) < batch_bytes:
+            small.append((source, target))
+        else:
+            batches.append([(source, target)])
+    if small:
+        batches.append(small)
+    _written.acquire()
+    for source, target in files:
+        _pending[source] = _pending.get(source, 0) + 1
+    _written.release()
+    for batch in batches:
+        _queue.put((batch, link))
+
+
+def wait():
+    """Blocks until all queued files are written."""
+    _queue.join()
+    _lock.acquire()
+    errors = list(_errors)
+    del _errors[:]
+    _lock.release()
+    if errors:
+        raise RuntimeError("could not export:\n" + '\n'.join(errors))
+
+
+def drain(directory):
+    """Blocks until no file under directory waits to be written."""
+    prefix = os.path.join(os.path.abspath(directory), '')
+    _written.acquire()
+    try:
+        while [source for source in _pending if source.startswith(prefix)]:
+            _written.wait()
+    finally:
+        _written.release()
+
+
+def _files(value):
+    if isinstance(value, (list, tuple)):
+        files = []
+        for v in value:
+            files.extend(_files(v))
+        return files
+    if isinstance(value, str) and os.path.isfile(value):
+        return [value]
+    return []
+
+
+def destination(base, field):
+    """Directory of a 'directory[.[@]subdir]' field under base."""
+    parts = field.split('.')
+    path = [part for part in parts if not part.startswith('@')]
+    return os.path.join(base, *path)
+
+
+class AsyncDataSink(Interface):
+    '''
+    Exports the files of its inputs to subject_directory/subject_id
+    through the background writers of this module (see wait()).
+    '''
+    def __init__(self, *args, **inputs):
+        self._populate_inputs()
+        self.inputs.update(**inputs)
+
+    def inputs_help(self):
+        """
+        Parameters
+        --------------------
+        subject_directory : directory
+            where the subject directories are created
+        subject_id : str
+            name of the subject directory
+        n_threads : int
+            writer threads of this process (default 4)
+        link : bool
+            hard link when a reflink is not possible (default False;
+            a hard linked result changes with its source file)
+        batch_bytes : int
+            files smaller than this are written in one batch per node
+        directory[.[@]subdir] : files
+            files to export to directory (or directory/subdir)
+        """
+        print(self.inputs_help.__doc__)
+
+    def _populate_inputs(self):
+        self.inputs = Bunch(subject_directory=None,
+                            subject_id=None,
+                            n_threads=4,
+                            link=False,
+                            batch_bytes=2 ** 20)
+
+    def outputs_help(self):
+        """
+        No outputs; the files are written in the background.
+        """
+        print(self.outputs_help.__doc__)
+
+    def outputs(self):
+        return Bunch()
+
+    def aggregate_outputs(self):
+        return self.outputs()
+
+    def run(self, cwd=None):
+        base = os.path.join(self.inputs.subject_directory, self.inputs.subject_id)
+        settings = ['subject_directory', 'subject_id', 'n_threads', 'link', 'batch_bytes']
+        files = []
+        for field, value in sorted(self.inputs.__dict__.items()):
+            if field in settings:
+                continue
+            directory = destination(base, field)
+            for fname in _files(value):
+                files.append((os.path.abspath(fname),
+                              os.path.join(directory, os.path.basename(fname))))
+        start(self.inputs.n_threads)
+        submit(files, self.inputs.link, self.inputs.batch_bytes)
+
+        runtime = Bunch(returncode=0,
+                        messages='%d files queued for export' % len(files),
+                        errmessages=None)
+        return InterfaceResult(deepcopy(self), runtime, outputs=self.outputs())
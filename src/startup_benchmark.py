@@ -0,0 +1,49 @@
+"""
+   Measures the fixed cost a process pays before the pipeline starts
+   running: importing pipeline.py, building the graph and loading the
+   pickled graph that load_pipeline() keeps in the working directory.
+
+       python startup_benchmark.py [repeats]
+
+   Every measurement runs in a fresh python process, as the per
+   subject jobs of the scheduler do.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+_steps = [('import pipeline', 'import pipeline'),
+          ('build graph', 'import pipeline; pipeline.build_pipeline(workdir=%(workdir)r)'),
+          ('load cached graph', 'import pipeline; pipeline.load_pipeline(workdir=%(workdir)r)')]
+
+
+def measure(statement, repeats):
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(repeats=3):
+    workdir = tempfile.mkdtemp()
+    try:
+        # the first load writes the cached graph
+        subprocess.check_call([sys.executable, '-c', _steps[2][1] % dict(workdir=workdir)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+        for name, statement in _steps:
+            print("%-20s %6.2f s" % (name, measure(statement % dict(workdir=workdir), repeats)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    repeats = 3
+    if len(sys.argv) > 1:
+        repeats = int(sys.argv[1])
+    main(repeats)
@@ -0,0 +1,32 @@
+from lazy import lazy_import
+fsl = lazy_import('nipype.interfaces.fsl')            # fsl
+nw = lazy_import('nipype.pipeline.node_wrapper')      # nodes for pypelines
+
+
+def structural_nodes(pipeline, datasource, cached=None):
+    """Creates the per subject structural stage every task branch uses.
+
+    Returns {name: (node, output)} with
+        struct  - the structural image, target of the coregistration
+        brain   - the skull stripped structural (also used as a mask)
+        surfaces - the FreeSurfer subject whose surfaces and white
+                  matter boundary BBRegister registers to
+
+    The nodes are created once per graph, so with several tasks in one
+    graph they run once per subject. With a cache (cache.ResultCache)
+    parallel jobs building one task each find the result of the first
+    job that ran them.
+    """
+    if cached is None:
+        cached = lambda interface: interface
+
+    # named, as the default name would come from the cache wrapper and
+    # the masks of the datasink are named after this node (see
+    # functional.mask_name); it is the default of a plain fsl.Bet
+    skullstrip = nw.NodeWrapper(interface=cached(fsl.Bet()), diskbased=True, name="Bet.fsl")
+    skullstrip.inputs.mask = True
+    pipeline.connect([(datasource, skullstrip, [('struct', 'infile')])])
+
+    return dict(struct=(datasource, 'struct'),
+                brain=(skullstrip, 'outfile'),
+                surfaces=(datasource, 'subject_id'))
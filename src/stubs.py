@@ -0,0 +1,234 @@
+"""
+   Stand-ins for the FSL, SPM and FreeSurfer interfaces of the
+   pipeline, for benchmarking the graph where the tools (or MATLAB)
+   are not installed.
+
+       stub_tools(l1pipeline, seconds=0.5)
+
+   replaces every external tool of the graph by a StubInterface which
+   waits seconds and writes outputs of the right kind: copies of the
+   input volumes (frame references are kept), mean images, realignment
+   parameters, registration files and statistical images on the grid
+   of the mask. The in process interfaces (volumes.py, glm.py,
+   atlas.py, SpecifyModel, the datasource and the datasink) keep
+   running for real, so their cost, the scheduling and the I/O of the
+   working directory are measured as they are.
+"""
+import os
+import json
+import time
+import shutil
+from copy import deepcopy
+
+import numpy as np
+from nipype.interfaces.base import InterfaceResult, Bunch
+
+from cache import InterfaceWrapper
+import volumes
+
+_tool_modules = ['nipype.interfaces.spm', 'nipype.interfaces.fsl',
+                 'nipype.interfaces.freesurfer']
+
+
+def _list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _split_reference(fname):
+    if ',' in fname:
+        fname, frame = fname.rsplit(',', 1)
+        return fname, ',' + frame
+    return fname, ''
+
+
+def _copy(files, prefix):
+    """Copies the files (or the files of frame references) into the
+    working directory with prefix. Returns the copies in the same
+    structure."""
+    copies = []
+    for reference in _list(files):
+        fname, frame = _split_reference(reference)
+        target = os.path.abspath(prefix + os.path.basename(fname))
+        if not os.path.exists(target):
+            shutil.copyfile(fname, target)
+        copies.append(target + frame)
+    if isinstance(files, list):
+        return copies
+    return copies[0]
+
+
+def _mean(files, prefix='mean'):
+    fname = _split_reference(_list(files)[0])[0]
+    header, dims, _, byteorder = volumes.read_header(fname)
+    target = os.path.abspath(prefix + os.path.basename(fname))
+    out = volumes.create(target, volumes.float32_header(header, byteorder),
+                         dims[:3], byteorder)
+    out[0] = np.asarray(volumes.memmap(fname), dtype=np.float32).mean(axis=0)
+    out.flush()
+    del out
+    return target
+
+
+def _volume_count(files):
+    count = 0
+    for reference in _list(files):
+        fname, frame = _split_reference(reference)
+        if frame:
+            count += 1
+        else:
+            count += volumes.frame_count(fname)
+    return count
+
+
+def _statistical_images(mask, names, seed=0):
+    header, dims, _, byteorder = volumes.read_header(mask)
+    rng = np.random.RandomState(seed)
+    images = []
+    for name in names:
+        target = os.path.abspath(name + '.nii')
+        out = volumes.create(target, volumes.float32_header(header, byteorder),
+                             dims[:3], byteorder)
+        out[:] = rng.randn(*out.shape)
+        out.flush()
+        del out
+        images.append(target)
+    return images
+
+
+def _text(name, content):
+    target = os.path.abspath(name)
+    f = open(target, 'w')
+    f.write(content)
+    f.close()
+    return target
+
+
+def _design(fname):
+    f = open(fname)
+    design = json.load(f)
+    f.close()
+    return design
+
+
+def _bet(inputs, outputs):
+    base = os.path.splitext(os.path.basename(inputs.infile))[0]
+    outputs.outfile = os.path.abspath(base + '_brain.nii')
+    shutil.copyfile(inputs.infile, outputs.outfile)
+
+
+def _extract_roi(inputs, outputs):
+    outputs.outfile = volumes.ExtractVolumes(infile=inputs.infile, tmin=inputs.tmin,
+                                             tsize=inputs.tsize).run().outputs.outfile
+
+
+def _split(inputs, outputs):
+    outputs.outfiles = volumes.SplitVolumes(infile=inputs.infile).run().outputs.outfiles
+
+
+def _realign(inputs, outputs):
+    outputs.realigned_files = _copy(inputs.infile, 'r')
+    outputs.mean_image = _mean(inputs.infile)
+    n_volumes = _volume_count(inputs.infile)
+    rng = np.random.RandomState(n_volumes)
+    parameters = np.cumsum(rng.randn(n_volumes, 6) * [.02, .02, .02, .0003, .0003, .0003], axis=0)
+    name = os.path.splitext(os.path.basename(_split_reference(_list(inputs.infile)[0])[0]))[0]
+    outputs.realignment_parameters = os.path.abspath('rp_%s.txt' % name)
+    np.savetxt(outputs.realignment_parameters, parameters)
+
+
+def _coregister(inputs, outputs):
+    outputs.coregistered_source = _copy(inputs.source, 'r')
+    if inputs.apply_to_files is not None:
+        outputs.coregistered_files = _copy(inputs.apply_to_files, 'r')
+
+
+def _smooth(inputs, outputs):
+    outputs.smoothed_files = _copy(inputs.infile, 's')
+
+
+def _bbregister(inputs, outputs):
+    outputs.outregfile = _text('register.dat', '%s\n1 0 0 0\n0 1 0 0\n0 0 1 0\n0 0 0 1\n'
+                               % inputs.subject_id)
+
+
+def _level1design(inputs, outputs):
+    outputs.spm_mat_file = _text('SPM.mat', json.dumps(dict(mask_image=inputs.mask_image)))
+
+
+def _estimate_model(inputs, outputs):
+    design = _design(inputs.spm_design_file)
+    outputs.spm_mat_file = _text('SPM.mat', json.dumps(design))
+    images = _statistical_images(design['mask_image'], ['beta_0001', 'ResMS', 'RPV'])
+    outputs.beta_images = images[:1]
+    outputs.residual_image = images[1]
+    outputs.RPVimage = images[2]
+
+
+def _estimate_contrast(inputs, outputs):
+    design = _design(inputs.spm_mat_file)
+    n = len(inputs.contrasts)
+    outputs.con_images = _statistical_images(design['mask_image'],
+                                             ['con_%04d' % (i + 1) for i in range(n)])
+    outputs.spmT_images = _statistical_images(design['mask_image'],
+                                              ['spmT_%04d' % (i + 1) for i in range(n)])
+
+
+# interface class name -> function(inputs, outputs) filling outputs
+_stubs = {'Bet': _bet,
+          'ExtractRoi': _extract_roi,
+          'Split': _split,
+          'Realign': _realign,
+          'Coregister': _coregister,
+          'Smooth': _smooth,
+          'BBRegister': _bbregister,
+          'Level1Design': _level1design,
+          'EstimateModel': _estimate_model,
+          'EstimateContrast': _estimate_contrast}
+
+
+class StubInterface(InterfaceWrapper):
+    '''
+    Takes the inputs of interface, waits seconds and writes outputs of
+    the kind interface would write, without running the tool.
+    '''
+    def __init__(self, interface, seconds=0.):
+        InterfaceWrapper.__init__(self, interface)
+        self.seconds = seconds
+        name = interface.__class__.__name__
+        if name not in _stubs:
+            raise ValueError("no stub for %s.%s" % (interface.__class__.__module__, name))
+        self.stub = _stubs[name]
+
+    def run(self, cwd=None):
+        if cwd is not None:
+            os.chdir(cwd)
+        time.sleep(self.seconds)
+        outputs = self.interface.outputs()
+        self.stub(self.interface.inputs, outputs)
+        runtime = Bunch(returncode=0, messages='stub', errmessages=None)
+        return InterfaceResult(deepcopy(self.interface), runtime, outputs=outputs)
+
+
+def is_tool(interface):
+    module = interface.__class__.__module__
+    return any([module.startswith(m) for m in _tool_modules])
+
+
+def stub_tools(pipeline, seconds=0.):
+    """Replaces every FSL, SPM and FreeSurfer interface of pipeline
+    (also inside InterfaceWrappers) by a StubInterface."""
+    for node in pipeline._graph.nodes():
+        parent = None
+        interface = node.interface
+        while isinstance(interface, InterfaceWrapper):
+            parent = interface
+            interface = interface.interface
+        if not is_tool(interface):
+            continue
+        if parent is None:
+            node.interface = StubInterface(interface, seconds)
+        else:
+            parent.interface = StubInterface(interface, seconds)
+    return pipeline
@@ -0,0 +1,88 @@
+"""
+   Reads the functional tasks of the analysis from a JSON file.
+
+   A task declares its run, the number of volumes to skip and to keep,
+   its blocks (first onset in scans of the original run, period and
+   duration), the name of its contrast set and of its mask set::
+
+       {"name": "finger_tapping", "run": "finger_tapping_func",
+        "file": "5_finger_tapping", "skip": 4, "total": 177,
+        "conditions": [{"name": "Task", "first_onset": 10,
+                        "period": 24, "duration": 12}],
+        "contrasts": "single_task", "masks": "fingerTapping"}
+
+   Contrast sets are lists of ['name', 'T', [conditions], [weights]]
+   and mask sets lists of [mask name, atlas label(s)]. The onsets of
+   every task are computed once when the file is loaded and every
+   subject gets a copy of them.
+"""
+import json
+from copy import deepcopy
+
+from nipype.interfaces.base import Bunch
+
+
+def _str(value):
+    # json returns unicode, the rest of the pipeline expects str
+    if isinstance(value, list):
+        return [_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(_str(k), _str(v)) for k, v in value.items()])
+    if not isinstance(value, (str, int, float, bool)) and value is not None:
+        return str(value)
+    return value
+
+
+def onsets(condition, skip, total):
+    """Block onsets in scans of the run after skip volumes were removed."""
+    return list(range(condition['first_onset'] - skip, total - skip, condition['period']))
+
+
+class SubjectInfo(object):
+    """The subject_info of a task; the same for every subject."""
+
+    def __init__(self, task):
+        conditions = task['conditions']
+        self.info = [Bunch(conditions=[c['name'] for c in conditions],
+                           onsets=[onsets(c, task['skip'], task['total']) for c in conditions],
+                           durations=[[c['duration']] for c in conditions],
+                           amplitudes=None,
+                           tmod=None,
+                           pmod=None,
+                           regressor_names=None,
+                           regressors=None)]
+
+    def __call__(self, subject_id):
+        return deepcopy(self.info)
+
+
+class TaskRegistry(object):
+    """Tasks, mask sets and datasource runs read from a task file.
+
+    tasks maps a task name to the keyword arguments of
+    functional_nodes, names keeps the order of the file, masks maps a
+    mask set name to (mask name, labels) pairs and runs maps the run
+    names to the files the datasource should provide.
+    """
+
+    def __init__(self, filename):
+        f = open(filename)
+        spec = _str(json.load(f))
+        f.close()
+        self.masks = {}
+        for name, masks in spec['masks'].items():
+            self.masks[name] = [tuple(mask) for mask in masks]
+        self.tasks = {}
+        self.names = []
+        self.runs = {}
+        for task in spec['tasks']:
+            if task['masks'] not in self.masks:
+                raise ValueError("task %s: unknown mask set %s" % (task['name'], task['masks']))
+            self.names.append(task['name'])
+            self.runs[task['run']] = [task['file']]
+            self.tasks[task['name']] = dict(skip_vols=task['skip'],
+                                            total_vols=task['total'],
+                                            funcRunName=task['run'],
+                                            subjectinfo=SubjectInfo(task),
+                                            masks=task['masks'],
+                                            contrasts=spec['contrasts'][task['contrasts']])
@@ -0,0 +1,509 @@
+"""
+   In process volume operations on uncompressed NIfTI files.
+
+   The data block of an uncompressed NIfTI file is a plain array, so
+   it can be memory mapped and sliced along time without loading the
+   run into memory. ExtractVolumes replaces fsl.ExtractRoi for the
+   volume skipping and FrameList replaces both: instead of copying the
+   kept volumes or writing one file per volume it returns SPM frame
+   references ('run.nii,5', 'run.nii,6', ...) into the 4D file, which
+   SPM accepts wherever it accepts a list of volumes. SPM writes the
+   volumes it resamples at the frame numbers of its input, so the
+   frames kept from the run are the frames to take from the realigned
+   run as well. The references point at a link of the run in the node
+   directory (see link()), since SPM writes next to its input.
+
+   SplitVolumes writes one file per volume like fsl.Split, for
+   consumers which need real files, and Smooth replaces spm.Smooth
+   with a separable Gaussian applied to many volumes at once in a few
+   threads.
+"""
+import os
+from copy import deepcopy
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from scipy import ndimage
+from scipy.special import erf
+from nipype.interfaces.base import Interface, InterfaceResult, Bunch
+
+from sink import reflink
+
+_datatypes = {2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32,
+              64: np.float64, 256: np.int8, 512: np.uint16, 768: np.uint32}
+
+
+def read_header(fname):
+    """Returns (header bytes up to the data, dims, dtype, byte order)."""
+    f = open(fname, 'rb')
+    try:
+        raw = f.read(348)
+        byteorder = '<'
+        if np.frombuffer(raw[:4], dtype='<i4')[0] != 348:
+            byteorder = '>'
+        dims = np.frombuffer(raw[40:56], dtype=byteorder + 'i2')
+        datatype = np.frombuffer(raw[70:72], dtype=byteorder + 'i2')[0]
+        vox_offset = int(np.frombuffer(raw[108:112], dtype=byteorder + 'f4')[0])
+        f.seek(0)
+        header = f.read(vox_offset)
+    finally:
+        f.close()
+    if datatype not in _datatypes:
+        raise ValueError("%s: unsupported NIfTI datatype %d" % (fname, datatype))
+    dtype = np.dtype(_datatypes[datatype]).newbyteorder(byteorder)
+    return header, [int(d) for d in dims[1:dims[0] + 1]], dtype, byteorder
+
+
+def memmap(fname, mode='r'):
+    """Maps the data of an uncompressed NIfTI file as a (t, z, y, x)
+    array (dimensions of size one are kept)."""
+    header, dims, dtype, _ = read_header(fname)
+    dims = (dims + [1, 1, 1, 1])[:4]
+    return np.memmap(fname, dtype=dtype, mode=mode, offset=len(header),
+                     shape=tuple(reversed(dims)))
+
+
+def create(fname, header, shape, byteorder='<'):
+    """Writes header (with its dims replaced by shape, given as
+    x, y, z, t) and returns the memory mapped, empty data block."""
+    header = bytearray(header)
+    dims = np.zeros(8, dtype=byteorder + 'i2')
+    dims[0] = len(shape)
+    dims[1:len(shape) + 1] = shape
+    header[40:56] = bytearray(dims.data)
+    f = open(fname, 'wb')
+    f.write(header)
+    f.close()
+    _, _, dtype, _ = read_header(fname)
+    size = len(header) + int(np.prod(shape)) * dtype.itemsize
+    f = open(fname, 'r+b')
+    f.truncate(size)
+    f.close()
+    return memmap(fname, mode='r+')
+
+
+def voxel_size(header, byteorder='<'):
+    """x, y, z voxel size in mm (pixdim) of a header."""
+    pixdim = np.frombuffer(header[76:108], dtype=byteorder + 'f4')
+    return [abs(float(d)) for d in pixdim[1:4]]
+
+
+def scaling(header, byteorder='<'):
+    """(slope, intercept) of the data, (1, 0) when it is not scaled."""
+    slope, inter = np.frombuffer(header[112:120], dtype=byteorder + 'f4')
+    if slope == 0 or not np.isfinite(slope):
+        return 1., 0.
+    return float(slope), float(inter)
+
+
+def float32_header(header, byteorder='<'):
+    """header changed to unscaled float32 data."""
+    header = bytearray(header)
+    header[70:74] = bytearray(np.array([16, 32], dtype=byteorder + 'i2').data)
+    header[112:120] = bytearray(np.array([1, 0], dtype=byteorder + 'f4').data)
+    return header
+
+
+def frame_count(fname):
+    _, dims, _, _ = read_header(fname)
+    if len(dims) < 4:
+        return 1
+    return dims[3]
+
+
+def frame_range(n_volumes, tmin=0, tsize=None):
+    """(start, stop) of the volumes tmin .. tmin + tsize - 1 (all
+    remaining ones for a tsize of None or -1) of n_volumes."""
+    stop = n_volumes
+    if tsize is not None and tsize >= 0:
+        stop = min(n_volumes, tmin + tsize)
+    return tmin, stop
+
+
+def link(source, target):
+    """Makes target a copy on write clone (reflink) of source, where the
+    file system cannot clone a hard link and across file systems a
+    symbolic link. Nothing is done when target is source. Only a clone
+    keeps the header of source from changes written into the header of
+    target (SPM's Realign writes the orientation of its input)."""
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        reflink(source, target)
+        return
+    except (IOError, OSError):
+        if os.path.exists(target):
+            os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        os.symlink(os.path.abspath(source), target)
+
+
+class ExtractVolumes(Interface):
+    '''
+    Copies volumes tmin .. tmin + tsize - 1 of a 4D uncompressed NIfTI
+    file into a new file using memory maps (same inputs as
+    fsl.ExtractRoi for the time dimension).
+    '''
+    def __init__(self, *args, **inputs):
+        self._populate_inputs()
+        self.inputs.update(**inputs)
+
+    def inputs_help(self):
+        """
+        Parameters
+        --------------------
+        infile : file
+            4D uncompressed NIfTI file
+        tmin : int
+            first volume to keep (0 based)
+        tsize : int
+            number of volumes to keep (-1 or None for all remaining,
+            at most the number of volumes left)
+        """
+        print(self.inputs_help.__doc__)
+
+    def _populate_inputs(self):
+        self.inputs = Bunch(infile=None,
+                            tmin=0,
+                            tsize=None)
+
+    def outputs_help(self):
+        """
+        Parameters
+        --------------------
+        outfile : file
+            the extracted volumes
+        """
+        print(self.outputs_help.__doc__)
+
+    def outputs(self):
+        outputs = Bunch(outfile=None)
+        return outputs
+
+    def aggregate_outputs(self):
+        outputs = self.outputs()
+        outputs.outfile = self._gen_output_filename()
+        return outputs
+
+    def _gen_output_filename(self):
+        name = os.path.basename(self.inputs.infile)
+        if name.endswith('.nii'):
+            name = name[:-4]
+        return os.path.abspath(name + '_roi.nii')
+
+    def run(self, cwd=None):
+        header, dims, _, byteorder = read_header(self.inputs.infile)
+        data = memmap(self.inputs.infile)
+        start, stop = frame_range(data.shape[0], self.inputs.tmin, self.inputs.tsize)
+        out = create(self._gen_output_filename(), header,
+                     list(dims[:3]) + [stop - start], byteorder)
+        out[:] = data[start:stop]
+        out.flush()
+        del out
+
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        outputs = self.aggregate_outputs()
+        return InterfaceResult(deepcopy(self), runtime, outputs=outputs)
+
+
+class FrameList(Interface):
+    '''
+    Returns SPM frame references to the volumes tmin .. tmin + tsize - 1
+    (default all) of a 4D file; only the header is read. Can be used in
+    place of fsl.ExtractRoi and fsl.Split when the volumes are passed
+    on to SPM. The file is linked into the working directory and the
+    references point at the link, so that what SPM writes next to its
+    input (the .mat file, the resliced and mean images, rp_*.txt) ends
+    up there and not next to the source, e.g. the raw data.
+    '''
+    def __init__(self, *args, **inputs):
+        self._populate_inputs()
+        self.inputs.update(**inputs)
+
+    def inputs_help(self):
+        """
+        Parameters
+        --------------------
+        infile : file
+            4D NIfTI file (a list of the file or of frame references
+            into it is accepted too)
+        tmin : int
+            first volume (0 based)
+        tsize : int
+            number of volumes (-1 or None for all remaining)
+        """
+        print(self.inputs_help.__doc__)
+
+    def _populate_inputs(self):
+        self.inputs = Bunch(infile=None,
+                            tmin=0,
+                            tsize=None)
+
+    def outputs_help(self):
+        """
+        Parameters
+        --------------------
+        outfiles : list of str
+            'link,tmin+1', 'link,tmin+2', ... where link is the link of
+            infile in the working directory
+        """
+        print(self.outputs_help.__doc__)
+
+    def outputs(self):
+        outputs = Bunch(outfiles=None)
+        return outputs
+
+    def _infile(self):
+        infile = self.inputs.infile
+        if isinstance(infile, list):
+            infile = infile[0]
+        return infile.split(',')[0]
+
+    def _gen_output_filename(self):
+        return os.path.abspath(os.path.basename(self._infile()))
+
+    def aggregate_outputs(self):
+        outputs = self.outputs()
+        start, stop = frame_range(frame_count(self._infile()), self.inputs.tmin, self.inputs.tsize)
+        outputs.outfiles = ['%s,%d' % (self._gen_output_filename(), i + 1)
+                            for i in range(start, stop)]
+        return outputs
+
+    def run(self, cwd=None):
+        link(self._infile(), self._gen_output_filename())
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        outputs = self.aggregate_outputs()
+        return InterfaceResult(deepcopy(self), runtime, outputs=outputs)
+
+
+class SplitVolumes(Interface):
+    '''
+    Writes every volume of a 4D uncompressed NIfTI file into a file of
+    its own (vol0000.nii, vol0001.nii, ... as fsl.Split with
+    dimension t).
+    '''
+    def __init__(self, *args, **inputs):
+        self._populate_inputs()
+        self.inputs.update(**inputs)
+
+    def inputs_help(self):
+        """
+        Parameters
+        --------------------
+        infile : file
+            4D uncompressed NIfTI file (a list with a single file is
+            accepted too)
+        """
+        print(self.inputs_help.__doc__)
+
+    def _populate_inputs(self):
+        self.inputs = Bunch(infile=None)
+
+    def outputs_help(self):
+        """
+        Parameters
+        --------------------
+        outfiles : list of files
+            one file per volume
+        """
+        print(self.outputs_help.__doc__)
+
+    def outputs(self):
+        outputs = Bunch(outfiles=None)
+        return outputs
+
+    def _infile(self):
+        if isinstance(self.inputs.infile, list):
+            return self.inputs.infile[0]
+        return self.inputs.infile
+
+    def aggregate_outputs(self):
+        outputs = self.outputs()
+        outputs.outfiles = [os.path.abspath('vol%04d.nii' % i)
+                            for i in range(frame_count(self._infile()))]
+        return outputs
+
+    def run(self, cwd=None):
+        header, dims, _, byteorder = read_header(self._infile())
+        data = memmap(self._infile())
+        outputs = self.aggregate_outputs()
+        for i, fname in enumerate(outputs.outfiles):
+            out = create(fname, header, list(dims[:3]), byteorder)
+            out[0] = data[i]
+            out.flush()
+            del out
+
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        return InterfaceResult(deepcopy(self), runtime, outputs=outputs)
+
+
+def smoothing_kernel(fwhm):
+    """SPM's Gaussian kernel (spm_smoothkern, integrated over the voxel
+    with linear interpolation) for a fwhm given in voxels, cut off at
+    six standard deviations."""
+    s1 = fwhm / np.sqrt(8 * np.log(2))
+    x = np.arange(-round(6 * s1), round(6 * s1) + 1)
+    s = s1 ** 2 + np.finfo(float).eps
+    w1 = 1 / np.sqrt(2 * s)
+    w2 = -0.5 / s
+    w3 = np.sqrt(s / 2 / np.pi)
+    kernel = (0.5 * (erf(w1 * (x + 1)) * (x + 1) + erf(w1 * (x - 1)) * (x - 1)
+                     - 2 * erf(w1 * x) * x)
+              + w3 * (np.exp(w2 * (x + 1) ** 2) + np.exp(w2 * (x - 1) ** 2)
+                      - 2 * np.exp(w2 * x ** 2)))
+    kernel[kernel < 0] = 0
+    return kernel / kernel.sum()
+
+
+def smooth(data, kernels, out):
+    """Convolves the (t, z, y, x) block data with the x, y and z
+    kernels into out (outside the volume counts as zero, as in
+    spm_conv_vol)."""
+    volume = np.asarray(data, dtype=np.float32)
+    for axis, kernel in zip([3, 2, 1], kernels):
+        if len(kernel) > 1:
+            volume = ndimage.convolve1d(volume, kernel, axis=axis,
+                                        mode='constant', cval=0.)
+    out[:] = volume
+
+
+def _smooth_block(block):
+    (data, kernels, (slope, inter), out), frames, start = block
+    target = np.empty((len(frames),) + out.shape[1:], dtype=np.float32)
+    smooth(data[frames] * slope + inter, kernels, target)
+    out[start:start + len(frames)] = target
+
+
+class Smooth(Interface):
+    '''
+    Gaussian smoothing like spm.Smooth, computed in process. The
+    volumes of every file are smoothed in blocks (one separable
+    convolution per axis over all volumes of a block) and the blocks
+    of all files are spread over n_threads threads, so a run split
+    into one file per volume is shared out as well as the frames of a
+    4D file. Volumes can be given as files or as frame references
+    ('run.nii,3'); the frames of one file are written to one 4D
+    float32 file and returned as frame references.
+    '''
+    def __init__(self, *args, **inputs):
+        self._populate_inputs()
+        self.inputs.update(**inputs)
+
+    def inputs_help(self):
+        """
+        Parameters
+        --------------------
+        infile : list of files
+            volumes to smooth (files or 'file,N' frame references)
+        fwhm : float or list of 3 floats
+            full width at half maximum of the kernel in mm
+        n_threads : int
+            threads to use (default: number of processors)
+        block_size : int
+            volumes convolved at once
+        out_prefix : str
+            prefix of the output files (default 's')
+        """
+        print(self.inputs_help.__doc__)
+
+    def _populate_inputs(self):
+        self.inputs = Bunch(infile=None,
+                            fwhm=[8, 8, 8],
+                            n_threads=None,
+                            block_size=8,
+                            out_prefix='s')
+
+    def outputs_help(self):
+        """
+        Parameters
+        --------------------
+        smoothed_files : list of str
+            smoothed volumes, in the order of infile
+        """
+        print(self.outputs_help.__doc__)
+
+    def outputs(self):
+        outputs = Bunch(smoothed_files=None)
+        return outputs
+
+    def _volumes(self):
+        """[(file, frame or None)] in the order of infile."""
+        infiles = self.inputs.infile
+        if not isinstance(infiles, list):
+            infiles = [infiles]
+        volumes = []
+        for infile in infiles:
+            if ',' in infile:
+                fname, frame = infile.rsplit(',', 1)
+                volumes.append((fname, int(frame)))
+            else:
+                volumes.append((infile, None))
+        return volumes
+
+    def _frames(self):
+        """{file: [frames used, in order]} (frame 1 for plain files)."""
+        frames = {}
+        for fname, frame in self._volumes():
+            used = frames.setdefault(fname, [])
+            if (frame or 1) not in used:
+                used.append(frame or 1)
+        return frames
+
+    def _gen_output_filename(self, fname):
+        return os.path.abspath(self.inputs.out_prefix + os.path.basename(fname))
+
+    def aggregate_outputs(self):
+        outputs = self.outputs()
+        frames = self._frames()
+        outputs.smoothed_files = []
+        for fname, frame in self._volumes():
+            if frame is None:
+                outputs.smoothed_files.append(self._gen_output_filename(fname))
+            else:
+                outputs.smoothed_files.append('%s,%d' % (self._gen_output_filename(fname),
+                                                         frames[fname].index(frame) + 1))
+        return outputs
+
+    def _kernels(self, header, byteorder):
+        fwhm = self.inputs.fwhm
+        if not isinstance(fwhm, (list, tuple)):
+            fwhm = [fwhm] * 3
+        return [smoothing_kernel(float(f) / v)
+                for f, v in zip(fwhm, voxel_size(header, byteorder))]
+
+    def run(self, cwd=None):
+        n_threads = self.inputs.n_threads
+        if not n_threads:
+            import multiprocessing
+            n_threads = multiprocessing.cpu_count()
+        blocks = []
+        outs = []
+        for fname, frames in self._frames().items():
+            header, dims, _, byteorder = read_header(fname)
+            shape = list(dims[:3])
+            if len(frames) > 1 or frame_count(fname) > 1:
+                shape.append(len(frames))
+            out = create(self._gen_output_filename(fname),
+                         float32_header(header, byteorder), shape, byteorder)
+            outs.append(out)
+            source = (memmap(fname), self._kernels(header, byteorder),
+                      scaling(header, byteorder), out)
+            index = np.array(frames) - 1
+            for start in range(0, len(index), self.inputs.block_size):
+                blocks.append((source, index[start:start + self.inputs.block_size], start))
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(_smooth_block, blocks)
+        finally:
+            pool.close()
+        for out in outs:
+            out.flush()
+        del blocks, outs
+
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        outputs = self.aggregate_outputs()
+        return InterfaceResult(deepcopy(self), runtime, outputs=outputs)
@@ -0,0 +1,157 @@
+"""
+   Times the in process volume operations of volumes.py against the
+   FSL and SPM tools they replace on a synthetic run, and checks that
+   both give the same volumes.
+
+       python volumes_benchmark.py              # in process only
+       python volumes_benchmark.py --fsl --spm  # also run and compare the tools
+
+   The exit status is 1 when a volume differs from the one of the tool
+   by more than --tolerance times the largest value of the tool's
+   volume (SPM writes the smoothed volumes in the data type of its
+   input, so differences up to that rounding are expected).
+
+   The run has the size of the finger tapping run (64 x 64 x 30, 180
+   volumes, 3 x 3 x 4 mm) and the steps are those of functional_nodes:
+   skip the first volumes, split the run, smooth with a 2 mm kernel.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+import numpy as np
+import nifti as ni
+
+import volumes
+
+
+def make_run(directory, shape=(180, 30, 64, 64), voxel_size=(3., 3., 4.), seed=0):
+    rng = np.random.RandomState(seed)
+    data = (1000 + 100 * rng.randn(*shape)).astype(np.int16)
+    image = ni.NiftiImage(data)
+    image.setPixDims(list(voxel_size) + [2.5])
+    fname = os.path.join(directory, 'run.nii')
+    image.save(fname)
+    return fname
+
+
+def run_native(run, skip_vols, total_vols, fwhm, cwd):
+    os.chdir(cwd)
+    times = []
+    start = time.time()
+    skipped = volumes.ExtractVolumes(infile=run, tmin=skip_vols, tsize=total_vols).run().outputs.outfile
+    times.append(('skip', time.time() - start))
+    start = time.time()
+    split = volumes.SplitVolumes(infile=skipped).run().outputs.outfiles
+    times.append(('split', time.time() - start))
+    start = time.time()
+    smoothed = volumes.Smooth(infile=split, fwhm=fwhm).run().outputs.smoothed_files
+    times.append(('smooth', time.time() - start))
+    return times, skipped, split, smoothed
+
+
+def run_tools(run, skip_vols, total_vols, fwhm, cwd, fsl=True, spm=True):
+    """The same steps with FSL and/or SPM. Without FSL the volumes are
+    split in process so that SPM has its input."""
+    os.chdir(cwd)
+    times = []
+    skipped = split = smoothed = None
+    if fsl:
+        import nipype.interfaces.fsl as fsl_interfaces
+        from nipype.interfaces.fsl.base import NEW_FSLCommand
+        NEW_FSLCommand.set_default_outputtype('NIFTI')
+        start = time.time()
+        skipped = fsl_interfaces.ExtractRoi(infile=run, tmin=skip_vols,
+                                            tsize=total_vols).run().outputs.outfile
+        times.append(('skip', time.time() - start))
+        start = time.time()
+        splitter = fsl_interfaces.Split(infile=skipped)
+        splitter.inputdimension = 't'
+        split = splitter.run().outputs.outfiles
+        times.append(('split', time.time() - start))
+    if spm:
+        import nipype.interfaces.spm as spm_interfaces
+        if split is None:
+            split = volumes.SplitVolumes(
+                infile=volumes.ExtractVolumes(infile=run, tmin=skip_vols,
+                                              tsize=total_vols).run().outputs.outfile
+            ).run().outputs.outfiles
+        start = time.time()
+        smoothed = spm_interfaces.Smooth(infile=split, fwhm=fwhm).run().outputs.smoothed_files
+        times.append(('smooth', time.time() - start))
+    return times, skipped, split, smoothed
+
+
+def _volume(fname):
+    if ',' in fname:
+        fname, frame = fname.rsplit(',', 1)
+        return ni.NiftiImage(fname).data[int(frame) - 1].astype(np.float64)
+    return ni.NiftiImage(fname).data.astype(np.float64)
+
+
+def compare(name, a, b):
+    """Prints and returns the largest difference relative to the
+    largest value of b."""
+    difference = np.abs(a - b).max()
+    relative = difference / max(np.abs(b).max(), 1e-12)
+    print("%-8s max abs difference %.3g (relative %.3g)" % (name, difference, relative))
+    return relative
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--fsl", action="store_true", default=False,
+                      help="also run fsl.ExtractRoi and fsl.Split")
+    parser.add_option("--spm", action="store_true", default=False,
+                      help="also run spm.Smooth")
+    parser.add_option("--skip", type="int", default=4)
+    parser.add_option("--total", type="int", default=173)
+    parser.add_option("--tolerance", type="float", default=1e-3,
+                      help="largest relative difference accepted")
+    options, args = parser.parse_args()
+
+    fwhm = [2, 2, 2]
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    differences = []
+    try:
+        run = make_run(directory)
+        outdir = os.path.join(directory, 'native')
+        os.mkdir(outdir)
+        native = run_native(run, options.skip, options.total, fwhm, outdir)
+        for step, seconds in native[0]:
+            print("native %-8s %8.2f s" % (step, seconds))
+
+        if options.fsl or options.spm:
+            outdir = os.path.join(directory, 'tools')
+            os.mkdir(outdir)
+            tools = run_tools(run, options.skip, options.total, fwhm, outdir,
+                              options.fsl, options.spm)
+            saved = 0.
+            for (step, seconds) in tools[0]:
+                mine = dict(native[0])[step]
+                saved += seconds - mine
+                print("tool   %-8s %8.2f s (%.2f s saved)" % (step, seconds, seconds - mine))
+            print("saved per run %.2f s" % saved)
+
+            if options.fsl:
+                differences.append(compare('skip', _volume(native[1]), _volume(tools[1])))
+                differences.append(compare('split', _volume(native[2][-1]),
+                                           _volume(tools[2][-1])))
+            if options.spm:
+                for i in [0, len(native[3]) // 2, len(native[3]) - 1]:
+                    differences.append(compare('smooth', _volume(native[3][i]),
+                                               _volume(tools[3][i])))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    if differences and max(differences) > options.tolerance:
+        print("volumes differ by more than %g" % options.tolerance)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""
+   Stands in for MATLAB in the matlab_server tests: reads commands
+   from stdin like ``matlab -nodesktop -nosplash`` does, runs the
+   script a session command names by printing it, and answers with
+   the sentinel line. A script containing 'die' kills the process.
+"""
+import os
+import re
+import sys
+
+SENTINEL = 'FMRI_TUMOUR_SESSION_DONE'
+
+for line in iter(sys.stdin.readline, ''):
+    if line.strip() == 'exit':
+        break
+    match = re.search(r"run\('([^']*)'\)", line)
+    if match is not None:
+        f = open(match.group(1))
+        script = f.read()
+        f.close()
+        if 'die' in script:
+            os._exit(3)
+        sys.stdout.write('%d ran %s' % (os.getpid(), script))
+    sys.stdout.write('\n%s 0\n' % SENTINEL)
+    sys.stdout.flush()
@@ -0,0 +1,91 @@
+import os
+import socket
+import time
+
+from cluster import FileSlots, JobQueue, run_local
+
+SUBJECTS = ['synthetic00', 'synthetic01']
+
+
+class Branch(object):
+    """A pipeline that writes a file, fails or kills its worker."""
+
+    def __init__(self, workdir, subject_id, task_name):
+        self.workdir = workdir
+        self.subject_id = subject_id
+        self.task_name = task_name
+
+    def run(self):
+        if self.task_name == 'bad':
+            raise ValueError('bad task')
+        if not os.path.exists(self.workdir):
+            os.makedirs(self.workdir)
+        killed = os.path.join(self.workdir, 'killed_' + self.subject_id)
+        if self.task_name == 'lost' and not os.path.exists(killed):
+            open(killed, 'w').close()
+            # the worker dies with its job running
+            os.kill(os.getppid(), 9)
+            os._exit(1)
+        f = open(os.path.join(self.workdir, self.subject_id), 'w')
+        f.write('done')
+        f.close()
+
+
+def build(subjects, selected_tasks, workdir):
+    return Branch(workdir, subjects[0], selected_tasks[0])
+
+
+def test_local_workers(tmpdir):
+    queue = JobQueue(str(tmpdir.join('queue')), lease=2.)
+    names = queue.submit('test_cluster:build', SUBJECTS, ['good', 'bad', 'lost'],
+                         str(tmpdir.join('workingdir')), max_attempts=2)
+    assert len(names) == 6
+
+    failed = run_local(queue.directory, 3, poll=0.2, lease=2.)
+    assert queue.status() == dict(pending=0, running=0, done=4, failed=2)
+    assert sorted(failed) == ['%s__bad' % s for s in SUBJECTS]
+    for errors in failed.values():
+        assert len(errors) == 2
+        assert 'bad task' in errors[-1]
+    for subject in SUBJECTS:
+        # lost once, then run again by another worker
+        job = queue._read('done', '%s__lost' % subject)
+        assert job['attempts'] == 1
+        assert 'lost' in job['errors'][0]
+        assert tmpdir.join('workingdir', 'lost', subject).read() == 'done'
+
+
+def test_slots_of_dead_owners_are_taken_over(tmpdir):
+    directory = str(tmpdir.join('slots'))
+    slots = FileSlots(directory, 1, poll=0.1, lease=1.)
+    tmpdir.join('slots', 'slot0').write('%s:%d\n' % (socket.gethostname(), 999999))
+    slots.acquire()
+    assert tmpdir.join('slots', 'slot0').read().strip() == \
+        '%s:%d' % (socket.gethostname(), os.getpid())
+
+    # on another host the owner cannot be asked, only its lease runs out
+    tmpdir.join('slots', 'slot1').write('elsewhere:1\n')
+    other = FileSlots(directory, 2, poll=0.1, lease=1.)
+    start = time.time()
+    other.acquire()
+    assert time.time() - start >= 0.5
+    assert other.held == [os.path.join(directory, 'slot1')]
+    slots.release()
+    other.release()
+    assert tmpdir.join('slots').listdir() == []
+
+
+def test_results_of_lost_claims_are_dropped(tmpdir):
+    queue = JobQueue(str(tmpdir.join('queue')), lease=1.)
+    queue.submit('test_cluster:build', SUBJECTS[:1], ['good'],
+                 str(tmpdir.join('workingdir')))
+    name, job = queue.claim('stalled')
+    assert queue.touch(name)
+    # the worker stalls beyond its lease, the job is queued again
+    os.utime(queue._path('running', name), (0, 0))
+    queue.requeue_lost()
+    assert not queue.touch(name)
+    queue.finish(name, job)
+    queue.finish(name, job, 'too late')
+    assert queue.status() == dict(pending=1, running=0, done=0, failed=0)
+    assert queue._read('pending', SUBJECTS[0] + '__good')['attempts'] == 1
@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('nipype')
+pytest.importorskip('nifti')
+
+import glm
+import volumes
+from pipeline_benchmark import write_volume
+
+SESSION = {'cond': [{'name': 'finger', 'onset': [10, 50], 'duration': [10]},
+                    {'name': 'foot', 'onset': [30, 70], 'duration': [10]}],
+           'regress': [{'name': 'drift', 'val': list(np.linspace(-1, 1, 100))}],
+           'hpf': 128}
+CONTRASTS = [['finger>foot', 'T', ['finger', 'foot'], [1, -1]],
+             ['finger', 'T', ['finger'], [1]]]
+
+
+def test_design_matrix_shape():
+    X, names = glm.design_matrix(SESSION, 100, 2.5)
+    # two conditions, one regressor, int(2 * 250 / 128 + 1) - 1 cosines
+    # and the constant
+    assert X.shape == (100, 7)
+    assert names == ['finger', 'foot', 'drift', 'hpf1', 'hpf2', 'hpf3', 'constant']
+    # the response starts with the first block and peaks after it
+    assert np.all(X[:10, 0] == 0)
+    assert 10 < np.argmax(X[:40, 0]) < 25
+    filter_basis = X[:, 3:6]
+    assert np.allclose(np.dot(filter_basis.T, filter_basis), np.eye(3))
+    assert np.allclose(filter_basis.sum(axis=0), 0)
+
+
+def test_hrf_is_normalised():
+    hrf = glm.spm_hrf(2.5 / 16)
+    assert abs(hrf.sum() - 1) < 1e-12
+    # the canonical response peaks at about 5 seconds
+    assert 4 < np.argmax(hrf) * 2.5 / 16 < 6
+
+
+def test_unknown_condition_is_an_error():
+    X, names = glm.design_matrix(SESSION, 100, 2.5)
+    with pytest.raises(ValueError):
+        glm.contrast_matrix([['typo', 'T', ['fingr'], [1]]], names)
+
+
+def fit(n_voxels, chunk_size, seed=0):
+    rng = np.random.RandomState(seed)
+    X, names = glm.design_matrix(SESSION, 100, 2.5)
+    C = glm.contrast_matrix(CONTRASTS, names)
+    data = np.dot(X, rng.randn(X.shape[1], n_voxels)) + rng.randn(100, n_voxels)
+    con = np.zeros((len(C), n_voxels))
+    T = np.zeros((len(C), n_voxels))
+    for block, block_con, block_T in glm.estimate(data, X, C, chunk_size):
+        con[:, block] = block_con
+        T[:, block] = block_T
+    return X, C, data, con, T
+
+
+def test_estimate_matches_lstsq():
+    X, C, data, con, T = fit(50, 20000)
+    B, _, rank, _ = np.linalg.lstsq(X, data, rcond=-1)
+    df = X.shape[0] - rank
+    sigma2 = ((data - np.dot(X, B)) ** 2).sum(axis=0) / df
+    var_factor = np.diag(np.dot(np.dot(C, np.linalg.inv(np.dot(X.T, X))), C.T))
+    assert np.allclose(con, np.dot(C, B))
+    assert np.allclose(T, np.dot(C, B) / np.sqrt(np.outer(var_factor, sigma2)))
+
+
+def test_chunks_do_not_change_the_estimate():
+    _, _, _, con, T = fit(50, 20000)
+    _, _, _, chunked_con, chunked_T = fit(50, 7)
+    # the same up to the rounding of the matrix products
+    assert np.allclose(con, chunked_con, rtol=1e-12, atol=1e-12)
+    assert np.allclose(T, chunked_T, rtol=1e-12, atol=1e-12)
+
+
+def test_estimate_glm_reads_scans_block_by_block(tmpdir):
+    rng = np.random.RandomState(0)
+    shape = (6, 5, 4)
+    X, _ = glm.design_matrix(SESSION, 100, 2.5)
+    data = np.dot(rng.randn(np.prod(shape), X.shape[1]), X.T) * 10 + 1000
+    data = data.reshape(shape + (100,)) + rng.randn(*(shape + (100,)))
+    run = str(tmpdir.join('run.nii'))
+    write_volume(run, data.astype(np.float32), (3., 3., 4.))
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[1:5, 1:4, 1:3] = 1
+    mask_file = str(tmpdir.join('mask.nii'))
+    write_volume(mask_file, mask, (3., 3., 4.), 2, 8)
+    session = dict(SESSION, scans=['%s,%d' % (run, i + 1) for i in range(100)])
+
+    results = []
+    for chunk_size in [20000, 5]:
+        os.chdir(str(tmpdir.mkdir('chunks%d' % chunk_size)))
+        outputs = glm.EstimateGLM(session_info=[session], mask_image=mask_file,
+                                  contrasts=CONTRASTS, interscan_interval=2.5,
+                                  chunk_size=chunk_size).run().outputs
+        results.append([np.asarray(volumes.memmap(f)) for f in
+                        outputs.con_images + outputs.spmT_images])
+    for whole, chunked in zip(*results):
+        inside = np.isfinite(whole)
+        assert inside.sum() == mask.sum()
+        assert np.array_equal(np.isfinite(chunked), inside)
+        assert np.allclose(whole[inside], chunked[inside])
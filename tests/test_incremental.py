@@ -0,0 +1,133 @@
+import os
+
+import pytest
+
+pytest.importorskip('nipype')
+nx = pytest.importorskip('networkx')
+from nipype.interfaces.base import InterfaceResult, Bunch
+
+import incremental
+
+
+class Scale(object):
+    """Writes its infile times factor; counts its runs in runs."""
+
+    def __init__(self, runs, factor=1):
+        self.runs = runs
+        self.inputs = Bunch(infile=None, factor=factor)
+
+    def outputs(self):
+        return Bunch(outfile=None)
+
+    def run(self, cwd=None):
+        self.runs.append(cwd)
+        f = open(self.inputs.infile)
+        value = float(f.read())
+        f.close()
+        outfile = os.path.join(cwd, 'out.txt')
+        f = open(outfile, 'w')
+        f.write('%f' % (value * self.inputs.factor))
+        f.close()
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        return InterfaceResult(self, runtime, outputs=Bunch(outfile=outfile))
+
+
+class Node(object):
+
+    def __init__(self, name, interface):
+        self.name = name
+        self.interface = interface
+        self.iterables = None
+
+
+class Pipeline(object):
+    """first -> second, both Scale, as build_pipeline would connect
+    them."""
+
+    def __init__(self, workdir, infile, factor=2):
+        self.runs = []
+        self.config = dict(workdir=workdir)
+        self.first = Node('first', Scale(self.runs, factor))
+        self.first.interface.inputs.infile = infile
+        self.second = Node('second', Scale(self.runs, 3))
+        self._graph = nx.DiGraph()
+        self._graph.add_edge(self.first, self.second, connect=[('outfile', 'infile')])
+
+    def run(self):
+        for node in [self.first, self.second]:
+            cwd = os.path.join(self.config['workdir'], node.name)
+            if not os.path.isdir(cwd):
+                os.makedirs(cwd)
+            result = node.interface.run(cwd=cwd)
+            if node is self.first:
+                self.second.interface.inputs.infile = result.outputs.outfile
+
+
+@pytest.fixture
+def infile(tmpdir):
+    fname = tmpdir.join('value.txt')
+    fname.write('1')
+    return str(fname)
+
+
+def test_signatures_follow_the_graph(tmpdir, infile):
+    workdir = str(tmpdir.join('workingdir'))
+    before = incremental.signatures(Pipeline(workdir, infile))
+    after = incremental.signatures(Pipeline(workdir, infile, factor=4))
+    # the parameters of first changed, those of second did not, but it
+    # gets its inputs from first
+    assert after['first'] != before['first']
+    assert after['second'][0] != before['second'][0]
+    assert after['second'][1] == before['second'][1]
+    assert incremental.signatures(Pipeline(workdir, infile)) == before
+
+
+def test_unchanged_runs_are_skipped(tmpdir, infile):
+    workdir = str(tmpdir.join('workingdir'))
+    manifest = str(tmpdir.join('manifest.json'))
+    pipeline = incremental.track(Pipeline(workdir, infile), manifest)
+    pipeline.run()
+    assert len(pipeline.runs) == 2
+    assert tmpdir.join('workingdir', 'second', 'out.txt').read() == '6.000000'
+
+    pipeline = incremental.track(Pipeline(workdir, infile), manifest)
+    pipeline.run()
+    assert pipeline.runs == []
+
+    # a changed input runs the nodes again; second, whose input was
+    # rewritten by first, as well
+    tmpdir.join('value.txt').write('2')
+    os.utime(infile, (1, 1))
+    pipeline = incremental.track(Pipeline(workdir, infile), manifest)
+    pipeline.run()
+    assert len(pipeline.runs) == 2
+    assert tmpdir.join('workingdir', 'second', 'out.txt').read() == '12.000000'
+
+    # so does a missing output
+    tmpdir.join('workingdir', 'second', 'out.txt').remove()
+    pipeline = incremental.track(Pipeline(workdir, infile), manifest)
+    pipeline.run()
+    assert pipeline.runs == [os.path.join(workdir, 'second')]
+
+
+def test_dry_run_reasons(tmpdir, infile):
+    workdir = str(tmpdir.join('workingdir'))
+    manifest = str(tmpdir.join('manifest.json'))
+    assert incremental.dry_run(Pipeline(workdir, infile), manifest) == \
+        [('first', 'never run'), ('second', 'never run')]
+    incremental.track(Pipeline(workdir, infile), manifest).run()
+    assert incremental.dry_run(Pipeline(workdir, infile), manifest) == []
+    assert incremental.dry_run(Pipeline(workdir, infile, factor=4), manifest) == \
+        [('first', 'parameters changed'), ('second', 'inputs from first change')]
+
+
+def test_runs_are_keyed_by_iteration(tmpdir, infile):
+    pipeline = Pipeline(str(tmpdir), infile)
+    pipeline.first.iterables = ('subject_id', ['s1', 's2'])
+    assert [(node.name, key) for node, key in incremental.runs(pipeline)] == \
+        [('first', os.path.join('_subject_id_s1', 'first')),
+         ('first', os.path.join('_subject_id_s2', 'first')),
+         ('second', os.path.join('_subject_id_s1', 'second')),
+         ('second', os.path.join('_subject_id_s2', 'second'))]
+    assert incremental.run_key('second', os.path.join(str(tmpdir), '_subject_id_s2', 'second'),
+                               str(tmpdir)) == os.path.join('_subject_id_s2', 'second')
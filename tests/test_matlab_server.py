@@ -0,0 +1,89 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import subprocess
+
+import pytest
+
+import matlab_server
+
+FAKE_MATLAB = '%s %s' % (sys.executable,
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      'fake_matlab.py'))
+
+
+@pytest.fixture
+def server():
+    # AF_UNIX paths are short, the pytest tmpdir may be too long
+    directory = tempfile.mkdtemp()
+    address = os.path.join(directory, 'matlab.sock')
+    process = matlab_server.start_server(address, FAKE_MATLAB, 1)
+    yield matlab_server.client_command(address)
+    matlab_server.stop_server(address, process)
+    shutil.rmtree(directory)
+
+
+def run(command, cwd, script):
+    """Runs script the way nipype does, returns (status, output)."""
+    process = subprocess.Popen('%s -nodesktop -nosplash -r "%s; exit"' % (command, script),
+                               shell=True, cwd=cwd, stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    output = process.communicate()[0]
+    return process.returncode, output
+
+
+def test_strip_exit():
+    assert matlab_server.strip_exit("spm_jobman('run', jobs);\nexit;") == \
+        "spm_jobman('run', jobs)"
+    assert matlab_server.strip_exit('a = 1, exit') == 'a = 1'
+    assert matlab_server.strip_exit('exit_code = 1') == 'exit_code = 1'
+
+
+def test_scripts_run_in_one_session(server, tmpdir):
+    outputs = []
+    for i in range(2):
+        cwd = tmpdir.mkdir('node%d' % i)
+        status, output = run(server, str(cwd), 'disp(%d)' % i)
+        assert status == 0
+        assert output.split(None, 2)[2].strip() == 'disp(%d)' % i
+        # the script is written into the node directory and removed
+        assert not cwd.join('fmri_session_script.m').exists()
+        outputs.append(output)
+    # the same MATLAB process ran both
+    assert outputs[0].split()[0] == outputs[1].split()[0]
+
+
+def test_startup_is_reported_for_every_request(server, tmpdir):
+    first, second = tmpdir.mkdir('first'), tmpdir.mkdir('second')
+    run(server, str(first), 'disp(1)')
+    run(server, str(second), 'disp(2)')
+    assert float(first.join(matlab_server.STARTUP_FILE).read()) > 0
+    # measured as well: the session was running
+    assert float(second.join(matlab_server.STARTUP_FILE).read()) == 0
+
+
+def test_dead_session_is_replaced(server, tmpdir):
+    results = {}
+
+    def request(name, script):
+        results[name] = run(server, str(tmpdir.mkdir(name)), script)
+    threads = [threading.Thread(target=request, args=('dies', 'die')),
+               threading.Thread(target=request, args=('first', 'disp(1)')),
+               threading.Thread(target=request, args=('second', 'disp(2)'))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+        assert not thread.is_alive()
+    assert results['dies'][0] == 1
+    assert 'exited unexpectedly' in results['dies'][1]
+    for name in ['first', 'second']:
+        assert results[name][0] == 0
+
+
+def test_server_that_cannot_listen_raises():
+    with pytest.raises(RuntimeError):
+        matlab_server.start_server(os.path.join(tempfile.gettempdir(), 'x' * 200),
+                                   FAKE_MATLAB, 1)
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from parallel import make_jobs, run_parallel
+
+SUBJECTS = ['synthetic00', 'synthetic01']
+
+
+class Branch(object):
+    """A pipeline that has nothing to run."""
+
+    def run(self):
+        pass
+
+
+def broken_build(subjects, selected_tasks, workdir, broken=None):
+    if selected_tasks[0] == broken:
+        raise ValueError('cannot build %s' % selected_tasks[0])
+    return Branch()
+
+
+def test_one_job_per_subject_and_task():
+    jobs = make_jobs(broken_build, SUBJECTS, ['a', 'b', 'c'], '/work')
+    assert [(job[1], job[2]) for job in jobs] == [(s, t) for s in SUBJECTS for t in 'abc']
+
+
+def test_failed_branches_are_reported(tmpdir):
+    with pytest.raises(RuntimeError) as error:
+        run_parallel(broken_build, SUBJECTS, ['a', 'b'], str(tmpdir), n_procs=2,
+                     build_kwargs=dict(broken='b'))
+    assert '2 of 4 branches failed' in str(error.value)
+    assert 'synthetic01/b:' in str(error.value)
+    assert 'cannot build b' in str(error.value)
+
+
+def test_branches_run_in_parallel_with_stubs(tmpdir):
+    pytest.importorskip('nipype.pipeline.engine')
+    import pipeline
+    import pipeline_benchmark
+
+    os.chdir(str(tmpdir))
+    task_file = str(tmpdir.join('tasks.json'))
+    pipeline_benchmark.write_tasks(task_file, n_tasks=2, n_masks=1, n_volumes=40)
+    registry = pipeline.TaskRegistry(task_file)
+    data_directory = str(tmpdir.join('data'))
+    for i, subject in enumerate(SUBJECTS):
+        pipeline_benchmark.make_subject(os.path.join(data_directory, subject), registry,
+                                        shape=(16, 16, 8), seed=i)
+    build_kwargs = dict(estimator='numpy',
+                        task_file=task_file,
+                        data_directory=data_directory,
+                        output_directory=str(tmpdir.join('output')),
+                        async_sink=True,
+                        stub_seconds=0.)
+
+    results = run_parallel(pipeline_benchmark.build, SUBJECTS, registry.names,
+                           str(tmpdir.join('workingdir')), n_procs=2,
+                           matlab_slots=1, build_kwargs=build_kwargs)
+    assert sorted([(r[0], r[1]) for r in results]) == \
+        sorted([(s, t) for s in SUBJECTS for t in registry.names])
+    assert [r[2] for r in results] == [None] * len(results)
+    for subject in SUBJECTS:
+        contrasts = os.listdir(str(tmpdir.join('output', subject, 'contrasts')))
+        for name in registry.names:
+            assert [c for c in contrasts if c.startswith(name)]
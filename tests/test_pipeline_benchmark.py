@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip('nipype')
+
+import pipeline_benchmark
+
+CONFIGURATION = dict(subjects=1, tasks=2, estimator='numpy')
+
+
+def run(wall, commit='abc', configuration=CONFIGURATION, **stages):
+    return dict(time=0., commit=commit, configuration=configuration,
+                wall=wall, stages=stages)
+
+
+def test_runs_are_compared_with_the_last_of_their_configuration(tmpdir):
+    history = str(tmpdir.join('history.jsonl'))
+    assert pipeline_benchmark.previous_run(history, CONFIGURATION) is None
+    pipeline_benchmark.append_run(history, run(10., commit='first'))
+    pipeline_benchmark.append_run(history, run(11., commit='second'))
+    pipeline_benchmark.append_run(history, run(5., commit='other',
+                                               configuration=dict(CONFIGURATION, subjects=2)))
+    assert pipeline_benchmark.previous_run(history, CONFIGURATION)['commit'] == 'second'
+    assert pipeline_benchmark.previous_run(history, dict(CONFIGURATION, tasks=1)) is None
+
+
+def test_regressions_are_flagged_above_the_threshold():
+    previous = run(10., Smooth=4., Realign=2., Skip=0.01)
+    now = run(10.5, Smooth=5.2, Realign=2.2, Skip=0.05, MotionQA=1.)
+    table, regressions = pipeline_benchmark.compare(previous, now, 0.2)
+    # Skip quintupled, but in too little time to tell
+    assert regressions == ['Smooth']
+    lines = dict([(line.split()[0], line) for line in table.split('\n')])
+    assert lines['Smooth'].split()[1:] == ['4.00', '5.20', '+30.0%', 'REGRESSION']
+    assert lines['Realign'].split()[1:] == ['2.00', '2.20', '+10.0%']
+    assert lines['total'].split()[1:] == ['10.00', '10.50', '+5.0%']
+    assert lines['MotionQA'].split()[1:] == ['-', '1.00']
+    _, regressions = pipeline_benchmark.compare(previous, now, 0.05)
+    assert regressions == ['Realign', 'Smooth']
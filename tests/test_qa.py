@@ -0,0 +1,149 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip('nipype')
+from nipype.interfaces.base import InterfaceResult, Bunch
+
+import qa
+from pipeline_benchmark import write_volume
+
+N_VOLUMES = 20
+
+
+def parameters():
+    """Still except for a 1 mm jump in x at volume 5 and a 0.01 rad
+    turn about z at volume 12."""
+    parameters = np.zeros((N_VOLUMES, 6))
+    parameters[5:, 0] = 1.
+    parameters[12:, 5] = 0.01
+    return parameters
+
+
+def write_run(directory, spike=None):
+    rng = np.random.RandomState(0)
+    data = 1000 + rng.randn(8, 7, 6, N_VOLUMES)
+    # background, which the global signal leaves out
+    data[:2] = 10
+    if spike is not None:
+        data[2:, :, :, spike] += 200
+    fname = os.path.join(directory, 'run.nii')
+    write_volume(fname, data.astype(np.float32), (3., 3., 4.))
+    return fname
+
+
+def write_parameters(directory, values):
+    fname = os.path.join(directory, 'rp_run.txt')
+    np.savetxt(fname, values)
+    return fname
+
+
+def test_framewise_displacement():
+    fd = qa.framewise_displacement(parameters())
+    expected = np.zeros(N_VOLUMES)
+    expected[5] = 1.
+    # a rotation is displacement on a sphere of 50 mm
+    expected[12] = 0.5
+    assert np.allclose(fd, expected)
+    assert np.allclose(qa.framewise_displacement(parameters(), radius=80.)[12], 0.8)
+
+
+def test_global_signal_of_a_run_and_of_its_frames(tmpdir):
+    run = write_run(str(tmpdir), spike=7)
+    signal = qa.global_signal(run)
+    assert signal.shape == (N_VOLUMES,)
+    # the mean of the brain voxels only
+    assert np.allclose(np.delete(signal, 7), 1000, atol=1)
+    assert np.allclose(signal[7], 1200, atol=1)
+    frames = ['%s,%d' % (run, i + 1) for i in range(N_VOLUMES)]
+    assert np.allclose(qa.global_signal(frames), signal)
+    assert np.allclose(qa.global_signal(frames[5:8]), signal[5:8])
+    z = qa.intensity_z(signal)
+    assert np.argmax(np.abs(z)) == 7
+    assert abs(z[7]) > 3
+
+
+def run_qa(tmpdir, values, spike=None, **settings):
+    directory = str(tmpdir)
+    os.chdir(directory)
+    interface = qa.MotionQA(realignment_parameters=write_parameters(directory, values),
+                            realigned_files=write_run(directory, spike), **settings)
+    outputs = interface.run().outputs
+    f = open(outputs.qa_file)
+    statistics = json.load(f)
+    f.close()
+    return outputs, statistics
+
+
+def test_motion_qa_finds_the_outliers(tmpdir):
+    outputs, statistics = run_qa(tmpdir, parameters(), spike=15)
+    assert statistics['outliers'] == [5, 15]
+    assert list(np.atleast_1d(np.loadtxt(outputs.outlier_files))) == [5, 15]
+    assert statistics['outlier_fraction'] == 0.1
+    assert statistics['passed']
+    assert qa.passed(outputs.qa_file)
+    assert np.allclose(statistics['mean_framewise_displacement'], 1.5 / N_VOLUMES)
+
+    # a lower threshold counts the turn as well
+    _, statistics = run_qa(tmpdir, parameters(), spike=15, fd_threshold=0.4)
+    assert statistics['outliers'] == [5, 12, 15]
+
+
+def test_motion_qa_fails_runs_with_too_many_outliers(tmpdir):
+    outputs, statistics = run_qa(tmpdir, parameters(), spike=15, max_outlier_fraction=0.1)
+    assert statistics['passed']
+    outputs, statistics = run_qa(tmpdir, parameters(), spike=15, max_outlier_fraction=0.05)
+    assert not statistics['passed']
+    assert not qa.passed(outputs.qa_file)
+
+
+def test_motion_qa_checks_the_number_of_volumes(tmpdir):
+    with pytest.raises(ValueError):
+        run_qa(tmpdir, parameters()[:-1])
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.inputs = Bunch(infile=None)
+        self.runs = 0
+
+    def outputs(self):
+        return Bunch(outfile=None)
+
+    def run(self, cwd=None):
+        self.runs += 1
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        return InterfaceResult(self, runtime, outputs=Bunch(outfile='out.nii'))
+
+
+def write_qa(directory, passed):
+    fname = os.path.join(directory, 'qa_%s.json' % passed)
+    f = open(fname, 'w')
+    json.dump(dict(passed=passed), f)
+    f.close()
+    return fname
+
+
+def test_gated_interface(tmpdir):
+    counter = Counter()
+    gated = qa.GatedInterface(counter)
+
+    # not connected to MotionQA: always runs
+    assert gated.run().outputs.outfile == 'out.nii'
+    assert counter.runs == 1
+
+    gated.inputs.qa_file = write_qa(str(tmpdir), True)
+    assert gated.run().outputs.outfile == 'out.nii'
+    assert counter.runs == 2
+
+    gated.inputs.qa_file = write_qa(str(tmpdir), False)
+    result = gated.run()
+    assert counter.runs == 2
+    assert result.runtime.returncode == 0
+    assert result.outputs.outfile is None
+    assert 'failed QA' in result.runtime.messages
+    # the qa_file is put back after the run
+    assert gated.inputs.qa_file.endswith('qa_False.json')
@@ -0,0 +1,163 @@
+import os
+
+import pytest
+
+pytest.importorskip('nipype')
+nx = pytest.importorskip('networkx')
+from nipype.interfaces.base import InterfaceResult, Bunch
+
+from retention import Retention
+
+
+def write(fname):
+    f = open(fname, 'w')
+    f.write('x' * 1000)
+    f.close()
+    return fname
+
+
+def require(fnames):
+    for fname in fnames:
+        if not os.path.isfile(fname):
+            raise IOError('%s was removed too early' % fname)
+
+
+def write_mat(fname, scans):
+    f = open(fname, 'w')
+    f.write('\n'.join(scans))
+    f.close()
+    return fname
+
+
+def read_mat(fname):
+    f = open(fname)
+    scans = f.read().split('\n')
+    f.close()
+    return scans
+
+
+class Fake(object):
+    """Calls step(inputs, cwd), which checks the files it reads and
+    returns the outputs."""
+
+    def __init__(self, step, **inputs):
+        self.step = step
+        self.inputs = Bunch(**inputs)
+
+    def run(self, cwd=None):
+        outputs = self.step(self.inputs, cwd)
+        runtime = Bunch(returncode=0, messages=None, errmessages=None)
+        return InterfaceResult(self, runtime, outputs=Bunch(**outputs))
+
+
+def smooth(inputs, cwd):
+    return dict(smoothed_files=[write(os.path.join(cwd, 'srun%d.nii' % i))
+                                for i in range(3)])
+
+
+def modelspec(inputs, cwd):
+    require(inputs.functional_runs)
+    return dict(session_info=[dict(scans=inputs.functional_runs,
+                                   cond=[dict(name='finger', onset=[10], duration=[10])],
+                                   hpf=128)])
+
+
+def level1design(inputs, cwd):
+    scans = inputs.session_info[0]['scans']
+    require(scans)
+    return dict(spm_mat_file=write_mat(os.path.join(cwd, 'SPM.mat'), scans))
+
+
+def estimate(inputs, cwd):
+    require(read_mat(inputs.spm_design_file))
+    return dict(spm_mat_file=write_mat(os.path.join(cwd, 'SPM.mat'),
+                                       read_mat(inputs.spm_design_file)),
+                beta_images=[write(os.path.join(cwd, 'beta_0001.img'))])
+
+
+def contrast(inputs, cwd):
+    require(read_mat(inputs.spm_mat_file))
+    require(inputs.beta_images)
+    return dict(spm_mat_file=write_mat(os.path.join(cwd, 'SPM.mat'),
+                                       read_mat(inputs.spm_mat_file)),
+                con_images=[write(os.path.join(cwd, 'con_0001.img'))])
+
+
+def estimate_glm(inputs, cwd):
+    require(inputs.session_info[0]['scans'])
+    return dict(con_images=[write(os.path.join(cwd, 'con_0001.img'))])
+
+
+def applymask(inputs, cwd):
+    require(inputs.infiles)
+    return dict(outfiles=[write(os.path.join(cwd, 'masked_con_0001.img'))])
+
+
+class Node(object):
+
+    def __init__(self, name, step):
+        self.name = name
+        self.interface = Fake(step)
+
+
+class Pipeline(object):
+    """Runs the nodes in the order they were connected, passing the
+    outputs on as the engine would."""
+
+    def __init__(self, workdir, connections):
+        self.config = dict(workdir=workdir)
+        self._graph = nx.DiGraph()
+        self.nodes = []
+        for upstream, node, connect in connections:
+            self._graph.add_edge(upstream, node, connect=connect)
+            for n in (upstream, node):
+                if n not in self.nodes:
+                    self.nodes.append(n)
+
+    def run(self):
+        for node in self.nodes:
+            for upstream in self._graph.predecessors(node):
+                for out, name in self._graph.get_edge_data(upstream, node)['connect']:
+                    setattr(node.interface.inputs, name,
+                            getattr(upstream.result.outputs, out))
+            cwd = os.path.join(self.config['workdir'], node.name)
+            os.makedirs(cwd)
+            node.result = node.interface.run(cwd=cwd)
+
+
+def run(tmpdir, connections):
+    workdir = str(tmpdir.join('workingdir'))
+    pipeline = Pipeline(workdir, connections)
+    retention = Retention(str(tmpdir.join('scratch')))
+    retention.apply(pipeline)
+    pipeline.run()
+    return sorted(os.listdir(workdir))
+
+
+def test_scans_are_kept_until_spm_estimated_the_model(tmpdir):
+    nodes = dict([(name, Node(name, step)) for name, step in
+                  [('smooth', smooth), ('modelspec', modelspec),
+                   ('level1design', level1design), ('estimate', estimate),
+                   ('contrast', contrast), ('applymask', applymask)]])
+    left = run(tmpdir, [
+        (nodes['smooth'], nodes['modelspec'], [('smoothed_files', 'functional_runs')]),
+        (nodes['modelspec'], nodes['level1design'], [('session_info', 'session_info')]),
+        (nodes['level1design'], nodes['estimate'], [('spm_mat_file', 'spm_design_file')]),
+        (nodes['estimate'], nodes['contrast'], [('spm_mat_file', 'spm_mat_file'),
+                                                ('beta_images', 'beta_images')]),
+        (nodes['contrast'], nodes['applymask'], [('con_images', 'infiles')])])
+    # every step found its scans, and they went once the model was
+    # estimated (modelspec passes no file on, nothing consumes its
+    # directory)
+    assert left == ['applymask', 'modelspec']
+
+
+def test_scans_are_kept_until_the_numpy_glm_ran(tmpdir):
+    nodes = dict([(name, Node(name, step)) for name, step in
+                  [('smooth', smooth), ('modelspec', modelspec),
+                   ('estimate_glm', estimate_glm), ('applymask', applymask)]])
+    left = run(tmpdir, [
+        (nodes['smooth'], nodes['modelspec'], [('smoothed_files', 'functional_runs')]),
+        (nodes['modelspec'], nodes['estimate_glm'], [('session_info', 'session_info')]),
+        (nodes['estimate_glm'], nodes['applymask'], [('con_images', 'infiles')])])
+    assert left == ['applymask', 'modelspec']
@@ -0,0 +1,130 @@
+import os
+from distutils.spawn import find_executable
+
+import numpy as np
+import pytest
+
+pytest.importorskip('nipype')
+from scipy import ndimage
+
+import volumes
+from pipeline_benchmark import write_volume
+
+VOXEL_SIZE = (3., 3., 4.)
+FWHM = [6, 6, 6]
+
+
+def make_run(directory, n_volumes=6, shape=(20, 18, 10)):
+    rng = np.random.RandomState(0)
+    data = (1000 + 100 * rng.randn(*(shape + (n_volumes,)))).astype(np.int16)
+    fname = os.path.join(directory, 'run.nii')
+    write_volume(fname, data, VOXEL_SIZE, 4, 16)
+    return fname, data
+
+
+def reference(volume):
+    """spm_conv_vol: the separable kernels applied as one 3D kernel."""
+    kernels = [volumes.smoothing_kernel(f / v) for f, v in zip(FWHM, VOXEL_SIZE)]
+    kernel = np.einsum('i,j,k->ijk', *kernels)
+    return ndimage.convolve(volume.astype(np.float64), kernel, mode='constant', cval=0.)
+
+
+def read(volume):
+    """A file or 'file,N' frame reference as an (x, y, z) array."""
+    fname, frame = volume, '1'
+    if ',' in volume:
+        fname, frame = volume.rsplit(',', 1)
+    return np.asarray(volumes.memmap(fname)[int(frame) - 1], dtype=np.float64).T
+
+
+def test_kernel_is_normalised_and_symmetric():
+    for fwhm in [0.5, 2 / 3., 2., 7.3]:
+        kernel = volumes.smoothing_kernel(fwhm)
+        assert abs(kernel.sum() - 1) < 1e-12
+        assert np.allclose(kernel, kernel[::-1])
+
+
+def test_smooth_matches_3d_convolution(tmpdir):
+    os.chdir(str(tmpdir))
+    run, data = make_run(str(tmpdir))
+    frames = volumes.FrameList(infile=run).run().outputs.outfiles
+    smoothed = volumes.Smooth(infile=frames, fwhm=FWHM, block_size=4,
+                              n_threads=2).run().outputs.smoothed_files
+    assert len(smoothed) == data.shape[3]
+    for i, fname in enumerate(smoothed):
+        expected = reference(data[..., i])
+        assert np.abs(read(fname) - expected).max() < 1e-4 * np.abs(expected).max()
+
+
+def test_split_files_smooth_like_frames(tmpdir):
+    os.chdir(str(tmpdir))
+    run, data = make_run(str(tmpdir))
+    split = volumes.SplitVolumes(infile=run).run().outputs.outfiles
+    frames = volumes.FrameList(infile=run).run().outputs.outfiles
+    from_files = volumes.Smooth(infile=split, fwhm=FWHM, n_threads=3).run().outputs.smoothed_files
+    from_frames = volumes.Smooth(infile=frames, fwhm=FWHM, n_threads=1).run().outputs.smoothed_files
+    assert [os.path.basename(f) for f in from_files] == ['svol%04d.nii' % i
+                                                         for i in range(len(split))]
+    for a, b in zip(from_files, from_frames):
+        assert np.array_equal(read(a), read(b))
+
+
+@pytest.mark.skipif(find_executable('matlab') is None, reason='MATLAB is not installed')
+def test_smooth_matches_spm(tmpdir):
+    spm = pytest.importorskip('nipype.interfaces.spm')
+    run, data = make_run(str(tmpdir))
+    native = tmpdir.mkdir('native')
+    os.chdir(str(native))
+    split = volumes.SplitVolumes(infile=run).run().outputs.outfiles
+    mine = volumes.Smooth(infile=split, fwhm=FWHM).run().outputs.smoothed_files
+    tool = tmpdir.mkdir('spm')
+    os.chdir(str(tool))
+    theirs = spm.Smooth(infile=split, fwhm=FWHM).run().outputs.smoothed_files
+    for a, b in zip(mine, theirs):
+        expected = read(b)
+        # SPM writes the data type of its input, i.e. rounds to integers
+        assert np.abs(read(a) - expected).max() <= 0.5 + 1e-3 * np.abs(expected).max()
+
+
+def test_frame_references_point_into_the_node_directory(tmpdir):
+    data_directory = tmpdir.mkdir('data')
+    run, data = make_run(str(data_directory))
+    raw = sorted(data_directory.listdir())
+    node = tmpdir.mkdir('node')
+    os.chdir(str(node))
+    for i in range(2):
+        # the second run finds the link of the first
+        frames = volumes.FrameList(infile=run, tmin=2, tsize=3).run().outputs.outfiles
+        assert frames == ['%s,%d' % (node.join('run.nii'), frame) for frame in [3, 4, 5]]
+    for i, frame in enumerate(frames):
+        assert np.array_equal(read(frame), data[..., 2 + i].astype(np.float64))
+
+    # what SPM's Realign writes next to its input
+    directory = os.path.dirname(frames[0].split(',')[0])
+    for name in ['run.mat', 'rrun.nii', 'meanrun.nii', 'rp_run.txt']:
+        open(os.path.join(directory, name), 'w').close()
+    assert sorted(data_directory.listdir()) == raw
+
+
+def test_streaming_leaves_the_raw_data_alone(tmpdir):
+    pytest.importorskip('nipype.pipeline.engine')
+    import pipeline
+    import pipeline_benchmark
+
+    os.chdir(str(tmpdir))
+    task_file = str(tmpdir.join('tasks.json'))
+    pipeline_benchmark.write_tasks(task_file, n_tasks=1, n_masks=1, n_volumes=20)
+    registry = pipeline.TaskRegistry(task_file)
+    subject = tmpdir.join('data', 'synthetic00')
+    pipeline_benchmark.make_subject(str(subject), registry, shape=(16, 16, 8))
+    raw = sorted([str(path) for path in subject.visit()])
+
+    l1pipeline = pipeline_benchmark.build(['synthetic00'], registry.names,
+                                          str(tmpdir.join('workingdir')),
+                                          stub_seconds=0., estimator='numpy',
+                                          streaming=True, task_file=task_file,
+                                          data_directory=str(tmpdir.join('data')),
+                                          output_directory=str(tmpdir.join('output')))
+    l1pipeline.run()
+    assert sorted([str(path) for path in subject.visit()]) == raw
+    assert tmpdir.join('output', 'synthetic00', 'contrasts').listdir()